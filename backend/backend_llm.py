@@ -4,22 +4,52 @@ from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 from typing import List
-import backend_vision
+import threading
 
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=API_KEY)
+# when set (e.g. http://127.0.0.1:9300), gemini calls go to this local stand-in instead (see standins/fake_gemini.py)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+
+GEMINI_MODEL = "gemini-2.5-flash"
+# bump it when the prompt below (or the way the images are prepared for it) changes: cached gemini answers are
+# keyed by it together with the model (score_cache.llm_key), so answers to the old prompt aren't reused
+PROMPT_VERSION = 1
+CACHE_VERSION = f"{GEMINI_MODEL}:prompt-{PROMPT_VERSION}"
+
+# created on first use instead of at import time, so importing this module stays cheap
+client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                http_options = types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+                client = genai.Client(api_key=API_KEY, http_options=http_options)
+    return client
+
+def is_ready() -> bool:
+    return client is not None
 
 def sanitize_gemini_output(output: str) -> str:
     return output[8:-3]
 
-def get_scores(images: List[dict], text_descr: str) -> dict:
+def get_scores(images: List[dict], text_descr: str, timeout: float = None) -> dict:
+    # timeout in seconds for the gemini request, None for the client's default
     arr = []
     for i in range(0, len(images)):
-        with open(images[i]['file_location'], "rb") as f:
-            b = f.read()
+        # the ingest pipeline already gives us a downsized jpeg in memory, only fall back to the file on disk without it
+        if images[i].get('llm_bytes') is not None:
+            b = images[i]['llm_bytes']
+            mime_type = images[i]['llm_mime_type']
+        else:
+            with open(images[i]['file_location'], "rb") as f:
+                b = f.read()
+            mime_type = images[i]['mime_type']
         arr.append(
-            types.Part.from_bytes(data=b, mime_type=images[i]['mime_type'])
+            types.Part.from_bytes(data=b, mime_type=mime_type)
         )
     arr.append(
         f"""
@@ -55,11 +85,12 @@ def get_scores(images: List[dict], text_descr: str) -> dict:
         """
     )
 
-    res = client.models.generate_content(
-        model="gemini-2.5-flash",
+    res = get_client().models.generate_content(
+        model=GEMINI_MODEL,
         contents=arr,
         config=types.GenerateContentConfig(
             thinking_config=types.ThinkingConfig(thinking_budget=0),
+            http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
 
         )
     )
@@ -1,11 +1,37 @@
-import tensorflow as tf
 import numpy as np
-import cv2
 import os
+import threading
+import time
 from PIL import Image
 import pillow_avif
+from vision_batcher import MicroBatcher
+import score_cache
+import vision_remote
+import vision_scoring
 MODEL_PATH = "../trainedModels/ssd_mobilenet_innference_graph.pb"  # Fixed typo in filename
-CONFIDENCE_THRESHOLD = 0.4
+# which runtime runs the ssd: tf (the frozen graph in a tf1 session), tflite or onnx (models made from the frozen
+# graph by convert_model.py, see vision_backends/). picked once at startup, VISION_MODEL_PATH overrides the file.
+VISION_BACKEND = os.getenv("VISION_BACKEND", "tf")
+VISION_MODEL_PATH = os.getenv("VISION_MODEL_PATH")
+MODEL_PATHS = {
+    "tf": MODEL_PATH,
+    "tflite": "../trainedModels/ssd_mobilenet_int8.tflite",
+    "onnx": "../trainedModels/ssd_mobilenet.onnx",
+}
+CONFIDENCE_THRESHOLD = vision_scoring.CONFIDENCE_THRESHOLD
+
+# images are resized to the ssd input resolution before inference so that images coming from
+# different posts (and different phones) have the same shape and can be stacked into one batch.
+MODEL_INPUT_SIZE = (300, 300)
+VISION_MAX_BATCH_SIZE = int(os.getenv("VISION_MAX_BATCH_SIZE", "8"))
+VISION_MAX_WAIT_MS = float(os.getenv("VISION_MAX_WAIT_MS", "15"))
+# threads of the model runtime, 0 = one per core. set them when several model processes share a machine
+# (backfill.py workers), or they all spin up a thread per core and fight over them.
+VISION_INTRA_OP_THREADS = int(os.getenv("VISION_INTRA_OP_THREADS", "0"))
+VISION_INTER_OP_THREADS = int(os.getenv("VISION_INTER_OP_THREADS", "0"))
+# with a socket the model runs in inference_server.py instead of in this process (see vision_remote.py)
+VISION_INFERENCE_SOCKET = os.getenv("VISION_INFERENCE_SOCKET")
+VISION_INFERENCE_TIMEOUT = float(os.getenv("VISION_INFERENCE_TIMEOUT", "30"))
 
 
 CLASS_MAP = {
@@ -19,42 +45,124 @@ CLASS_MAP = {
     8: "D44"   # White line blur
 }
 
-detection_graph = tf.Graph()
-with detection_graph.as_default():
-    od_graph_def = tf.compat.v1.GraphDef()
-    with tf.compat.v1.gfile.GFile(MODEL_PATH,"rb") as fid:  # Fixed deprecated tf.io.Gfile to tf.compat.v1.gfile.GFile
-        serialized_graph = fid.read()
-        od_graph_def.ParseFromString(serialized_graph)
-        tf.import_graph_def(od_graph_def, name="")
-sess = tf.compat.v1.Session(graph=detection_graph)
-
-print("Model loaded successfully")
-
-image_tensor = detection_graph.get_tensor_by_name("image_tensor:0")
-boxes_tensor = detection_graph.get_tensor_by_name("detection_boxes:0")
-scores_tensor = detection_graph.get_tensor_by_name("detection_scores:0")
-classes_tensor = detection_graph.get_tensor_by_name("detection_classes:0")
-num_tensor = detection_graph.get_tensor_by_name("num_detections:0")
-
-def analyze_damage(image_path: str):
+# the model is loaded lazily (or in the background at startup, see main.py) because importing
+# tensorflow / onnx runtime and parsing the model takes seconds and most endpoints don't need it.
+model = None
+
+_load_lock = threading.Lock()
+warmed_up = False
+load_error = None
+
+def create_backend(name: str, model_path: str = None, intra_op_threads: int = 0, inter_op_threads: int = 0):
+    # the runtimes are only imported for the backend that is used
+    if name == "tf":
+        from vision_backends.tf_session import TFSessionBackend as backend
+    elif name == "tflite":
+        from vision_backends.tflite import TFLiteBackend as backend
+    elif name == "onnx":
+        from vision_backends.onnx_runtime import OnnxBackend as backend
+    else:
+        raise ValueError(f"unknown VISION_BACKEND {name!r}, expected one of {sorted(MODEL_PATHS)}")
+    return backend(model_path or MODEL_PATHS[name], intra_op_threads, inter_op_threads)
+
+_identity = None
+
+def model_identity() -> str:
+    # what the detections depend on: the runtime and the model file (name, size, mtime). part of the vision score
+    # cache key, so switching VISION_BACKEND or converting a new model doesn't reuse the old detections
+    global _identity
+    if _identity is None:
+        path = VISION_MODEL_PATH or MODEL_PATHS.get(VISION_BACKEND, "")
+        try:
+            st = os.stat(path)
+            _identity = f"{VISION_BACKEND}:{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}"
+        except OSError:
+            _identity = f"{VISION_BACKEND}:{os.path.basename(path)}"
+    return _identity
+
+def _cache_model():
+    # with an inference server its model counts, it tells us which one in the ping (None until it answered one)
+    if remote is not None:
+        remote.recheck()
+        return remote.model
+    return model_identity()
+
+def load_model():
+    global model, load_error
+    if model is not None:
+        return
+    with _load_lock:
+        if model is not None:
+            return
+        try:
+            model = create_backend(VISION_BACKEND, VISION_MODEL_PATH, VISION_INTRA_OP_THREADS, VISION_INTER_OP_THREADS)
+            load_error = None
+        except Exception as e:
+            load_error = str(e)
+            raise
+
+    print(f"Model loaded successfully ({model.name}: {model.model_path})")
+
+remote = vision_remote.RemoteVision(VISION_INFERENCE_SOCKET, VISION_INFERENCE_TIMEOUT) if VISION_INFERENCE_SOCKET else None
+
+def warm_up():
+    # the first run is much slower than the rest (graph optimization, memory allocation),
+    # so run a blank batch once before real traffic gets here.
+    global warmed_up, load_error
+    if remote is not None:
+        # the inference server warms itself up, just check that it answers
+        try:
+            remote.ping()
+            load_error = None
+        except Exception as e:
+            load_error = f"inference server {VISION_INFERENCE_SOCKET}: {e}"
+            raise
+        warmed_up = True
+        return
+    load_model()
+    if not warmed_up:
+        detect_many([np.zeros((MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0], 3), dtype=np.uint8)])
+        warmed_up = True
+
+def is_ready() -> bool:
+    if remote is not None:
+        return remote.recheck()
+    return model is not None and warmed_up
+
+def _run_batch(images):
+    # images of the same shape are stacked and given to the model in a single run call
+    load_model()
+    results = [None] * len(images)
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(i)
+
+    for indices in groups.values():
+        batch = np.stack([images[i] for i in indices], axis=0)
+        (boxes, scores, classes, num) = model.run(batch)
+        for row, i in enumerate(indices):
+            results[i] = (boxes[row], scores[row], classes[row], num[row])
+
+    return results
+
+batcher = MicroBatcher(_run_batch, max_batch_size=VISION_MAX_BATCH_SIZE, max_wait_ms=VISION_MAX_WAIT_MS, name="vision-batcher")
+
+def load_image(image_path: str):
     try:
         image = Image.open(image_path).convert("RGB")
-    except:
+    except Exception as e:
         print(f"[ERROR] Could not load image: {e}")
         return None
-    image_np_expanded = np.expand_dims(image,axis=0)
-
-    (boxes, scores, classes,num) = sess.run(
-        [boxes_tensor,scores_tensor,classes_tensor,num_tensor],
-        feed_dict={image_tensor: image_np_expanded}
-    )
+    return np.asarray(image.resize(MODEL_INPUT_SIZE), dtype=np.uint8)
 
+def to_detections(result):
+    boxes, scores, classes, num = result
     detections = []
-    for i in range(int(num[0])):
-        score = scores[0][i]
+    for i in range(int(num)):
+        score = scores[i]
         if score < CONFIDENCE_THRESHOLD:
             continue
-        class_id = int(classes[0][i])
+        class_id = int(classes[i])
         detections.append({
             "class": CLASS_MAP.get(class_id,"Unknown"),
             "confidence": float(score)
@@ -62,174 +170,69 @@ def analyze_damage(image_path: str):
 
     return detections
 
+def run_many(images, timeout: float = None):
+    # submit everything first so the images of one post can share a batch with each other
+    # (and with images from other concurrent posts), then wait for all of them. -> raw (boxes, scores, classes, num) per image.
+    # raises TimeoutError when they aren't all done within `timeout` seconds
+    if remote is not None:
+        # one round trip per call, the server batches across its connections
+        return remote.detect([image for image in images if image is not None], timeout)
+    futures = [batcher.submit(image) for image in images if image is not None]
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    return [f.result(max(deadline - time.monotonic(), 0) if deadline is not None else None) for f in futures]
 
-def get_scores_cv(images):
-
-    all_detections = []
-    for img in images:
-        detections = analyze_damage(img["file_location"])
-        all_detections.extend(detections)
-
-    summary = {}
-
-    for d in all_detections:
-        summary[d["class"]] = summary.get(d["class"],0) + 1
-    
-    # START OF CHANGES: Added vision-based scoring for all 5 categories
-    surface_damage_score = compute_surface_damage_score(all_detections)
-    traffic_safety_score = compute_traffic_safety_score(all_detections)
-    ride_discomfort_score = compute_ride_discomfort_score(all_detections)
-    # Waterlogging score from text description if available, otherwise default
-    waterlogging_score = compute_waterlogging_score(all_detections)
-    urgency_score = compute_urgency_score(all_detections)
-    # END OF CHANGES
-    
-    return {
-        #comented out as not needed for now.
-        # "detections": all_detections,
-        # "summary": summary,
-        # "total_detections": len(all_detections),
-        "surface_damage": surface_damage_score,
-        "traffic_safety_risk": traffic_safety_score,
-        "ride_discomfort": ride_discomfort_score,
-        "waterlogging": waterlogging_score,
-        "urgency_for_repair": urgency_score
-    }
-
-# START OF CHANGES: Added helper functions to map vision detections to 5 scoring categories
-def compute_surface_damage_score(detections):
-    """
-    Calculate surface damage score based on detected damage types
-    Weighted scoring where more severe damage types contribute higher scores
-    """
-    if len(detections) == 0:
-        return 0
-    
-    # Weights for different damage types
-    weights = {
-        "D00": 8,   # Longitudinal crack (wheel mark)
-        "D01": 8,   # Longitudinal crack (construction joint)
-        "D10": 10,  # Lateral crack (equal interval)
-        "D11": 10,  # Lateral crack (construction joint)
-        "D20": 25,  # Alligator crack (severe)
-        "D40": 40,  # Rutting/bump/pothole/separation (most severe)
-        "D43": 5,   # Crosswalk blur (minimal surface impact)
-        "D44": 5    # White line blur (minimal surface impact)
-    }
-    
-    total_weight = sum(weights.get(d["class"], 5) * d["confidence"] for d in detections)
-    # Average weighted score normalized to 0-100 scale
-    score = min(100, (total_weight / len(detections)) * 2)  # Multiply by 2 to get to 0-100 scale
-    return round(score, 2)
-
-def compute_traffic_safety_score(detections):
-    """
-    Calculate traffic safety risk based on damage types that affect safety
-    """
-    if len(detections) == 0:
-        return 0
-    
-    # Safety-critical damage types
-    safety_weights = {
-        "D40": 50,  # Potholes/bumps are major safety hazards
-        "D20": 30,  # Alligator cracks can cause accidents
-        "D43": 15,  # Crosswalk blur affects pedestrian safety
-        "D44": 10,  # White line blur affects vehicle guidance
-        "D00": 5,   # Longitudinal cracks less critical for safety
-        "D01": 5,
-        "D10": 5,
-        "D11": 5
-    }
-    
-    total_weight = sum(safety_weights.get(d["class"], 0) * d["confidence"] for d in detections if d["class"] in safety_weights)
-    if len(detections) == 0:
-        return 0
-    
-    score = min(100, total_weight / len(detections))
-    return round(score, 2)
-
-def compute_ride_discomfort_score(detections):
-    """
-    Calculate ride comfort score based on surface irregularities
-    """
-    if len(detections) == 0:
-        return 0
-    
-    # All surface damages affect ride comfort
-    comfort_weights = {
-        "D00": 5,   # Longitudinal cracks
-        "D01": 5,
-        "D10": 8,   # Lateral cracks (more jarring)
-        "D11": 8,
-        "D20": 20,  # Alligator cracks (very uncomfortable)
-        "D40": 45,  # Potholes (extremely uncomfortable)
-        "D43": 2,   # Crosswalk blur (minimal comfort impact)
-        "D44": 2    # White line blur (minimal comfort impact)
-    }
-    
-    total_weight = sum(comfort_weights.get(d["class"], 2) * d["confidence"] for d in detections)
-    score = min(100, (total_weight / len(detections)) * 1.8)  # Scaled to 0-100
-    return round(score, 2)
-
-
-#Change this to use potholes instead of text.
-def compute_waterlogging_score(detections):
-    if len(detections) == 0:
-        return 0
-    # All surface damages affect ride comfort
-    comfort_weights = {
-        "D00": 0,   # Longitudinal cracks
-        "D01": 0,
-        "D10": 10,   # Lateral cracks (more jarring)
-        "D11": 8,
-        "D20": 15,  # Alligator cracks (very uncomfortable)
-        "D40": 70,  # Potholes (extremely uncomfortable)
-        "D43": 0,   # Crosswalk blur (minimal comfort impact)
-        "D44": 0    # White line blur (minimal comfort impact)
-    }
-    
-    total_weight = sum(comfort_weights.get(d["class"], 2) * d["confidence"] for d in detections)
-    score = min(100, (total_weight / len(detections)) * 1.8)
-    return round(score, 2)
-
-def compute_urgency_score(detections):
-    """
-    Calculate repair urgency based on damage severity and safety impact
-    """
-    if len(detections) == 0:
-        return 0
-    
-    # Urgency weights (higher for immediate repair needs)
-    urgency_weights = {
-        "D40": 100, # Potholes need immediate attention
-        "D20": 70,  # Alligator cracks indicate structural issues
-        "D10": 25,  # Lateral cracks (structural concern)
-        "D11": 25,  # Construction joint cracks
-        "D00": 15,  # Longitudinal cracks (less urgent)
-        "D01": 15,
-        "D43": 20,  # Crosswalk blur affects safety
-        "D44": 10   # White line blur affects guidance
-    }
-    
-    total_weight = sum(urgency_weights.get(d["class"], 10) * d["confidence"] for d in detections)
-    score = min(100, total_weight / len(detections))
-    return round(score, 2)
-# END OF CHANGES
-
-def compute_quality_score(detections):
-    #will change based on whats seems right just a starting point.
-    weights = {
-        "D00": 10, "D01": 10,
-        "D10": 15, "D11": 15,  
-        "D20": 30,             
-        "D40": 50,             
-        "D43": 5, "D44": 5   
-    }
-
-    if len(detections) == 0:
-        return 0
-    
-    total_weight = sum(weights.get(d["class"], 10) * d["confidence"] for d in detections)
-    score = min(100, total_weight / len(detections))
-    return round(score, 2)
+def detect_many(images):
+    return [to_detections(result) for result in run_many(images)]
 
+def analyze_damage(image_path: str):
+    image = load_image(image_path)
+    if image is None:
+        return None
+    return detect_many([image])[0]
+
+def _cached_sums(value):
+    # the cache holds {"sums": per class confidence sums, "count": detections} per image, entries written
+    # before that hold the detection list
+    if isinstance(value, dict):
+        return np.asarray(value["sums"], dtype=np.float64), value["count"]
+    sums = np.zeros(len(vision_scoring.CLASSES))
+    for d in value:
+        name = d["class"]
+        sums[vision_scoring.CLASSES.index(name) if name in vision_scoring.CLASSES else 0] += d["confidence"]
+    return sums, len(value)
+
+def image_sums(images, timeout: float = None):
+    # per image class sums (vision_scoring.class_sums) for prepared images, from the score cache or the model.
+    # images that can't be loaded are left out.
+    sums, counts = [], []
+    # detections are cached per image content hash and model, only the images we haven't seen before go to the model
+    model_id = _cache_model()
+    keys = [score_cache.vision_key(img.get("sha256"), model_id) for img in images]
+    cached = [score_cache.get("vision", key) if key else None for key in keys]
+    for value in cached:
+        if value is not None:
+            s, c = _cached_sums(value)
+            sums.append(s)
+            counts.append(c)
+
+    missing = [(img, key) for img, key, c in zip(images, keys, cached) if c is None]
+    arrays = [img["model_input"] if img.get("model_input") is not None else load_image(img["file_location"]) for img, _ in missing]
+    loaded = [key for (_, key), a in zip(missing, arrays) if a is not None]
+    results = run_many(arrays, timeout)
+    if results:
+        # one pass over the stacked arrays of all new images, each image its own row
+        new_sums, new_counts = vision_scoring.class_sums(np.stack([r[1] for r in results]), np.stack([r[2] for r in results]),
+                                                         np.stack([r[3] for r in results]), np.arange(len(results)), len(results))
+        for key, s, c in zip(loaded, new_sums, new_counts):
+            if key:
+                score_cache.put("vision", key, {"sums": s.tolist(), "count": int(c)})
+            sums.append(s)
+            counts.append(int(c))
+    return sums, counts
+
+def get_scores_cv(images, text_descr=None, timeout: float = None):
+    sums, counts = image_sums(images, timeout)
+    if not sums:
+        return vision_scoring.to_dict(np.zeros(len(vision_scoring.CATEGORIES)))
+    # the detections of all images of the post are averaged together
+    return vision_scoring.to_dict(vision_scoring.category_scores(np.sum(sums, axis=0), [sum(counts)])[0])
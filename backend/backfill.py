@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+from dotenv import load_dotenv
+import backend_llm
+import backend_vision
+import image_pipeline
+import location_cache
+import post_service
+import score_cache
+import scoring
+import vision_scoring
+from storage import blobs
+from database import db
+
+load_dotenv()
+
+# re-scores the posts already in the database after the vision weights (vision_scoring.py), the model or the
+# gemini prompt changed, then recomputes location_scores from them.
+#   - posts are read in keyset order (id > last id) in chunks, up to the highest id when the run started
+#   - their images are reloaded from the blob store (or uploads/<images_dir>/ for older posts) and run through
+#     the ssd model in a pool of worker processes, each with its own tensorflow session and a share of the cores
+#   - the llm part: with --llm gemini is asked again (rate limited, --llm-rps), without it the post keeps the
+#     cached gemini answer for its photos + text (score_cache, persisted with SCORE_CACHE_PERSIST=1) if it is from the
+#     current model and prompt (backend_llm.PROMPT_VERSION). a post whose old scores include a scorer that can't be
+#     redone keeps its old scores and is counted as "kept" (ids in <checkpoint>.kept)
+#   - changed posts are written set-wise per chunk (db.updatePostScores), then the location_scores of their
+#     locations are recomputed (db.recomputeLocationScores, small batches that only lock their own rows)
+#   - the position is checkpointed after every chunk, an interrupted run continues where it stopped
+#
+#   python backfill.py --workers 8 --chunk-size 2000
+#   python backfill.py --llm --llm-rps 5            (new prompt: ask gemini again for every post)
+#   python backfill.py --dry-run --limit 5000       (how much would the scores move, nothing is written)
+
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", "2000"))
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# posts per task handed to a worker, their images are stacked into the model's batches
+BACKFILL_WORKER_POSTS = int(os.getenv("BACKFILL_WORKER_POSTS", "16"))
+BACKFILL_LLM_RPS = float(os.getenv("BACKFILL_LLM_RPS", "2"))
+BACKFILL_LLM_CONCURRENCY = int(os.getenv("BACKFILL_LLM_CONCURRENCY", "8"))
+BACKFILL_LLM_RETRIES = 3
+BACKFILL_CHECKPOINT = os.getenv("BACKFILL_CHECKPOINT", "backfill.checkpoint.json")
+INVALIDATE_CHUNK = 10000
+
+SCORE_KEYS = scoring.SCORE_KEYS
+SCORER_WEIGHTS = {"llm": scoring.LLM_SCORE_WEIGHT, "vision": scoring.VISION_SCORE_WEIGHT}
+
+
+# ---- vision, in the worker processes ----
+
+def _init_worker():
+    backend_vision.load_model()
+
+
+def _image_refs(post: dict) -> List[str]:
+    # blob keys, or the files of a post from before the blob store
+    return blobs.split_keys(post['images_dir']) or post_service.legacy_image_paths(post['images_dir'], post['images'] or 0)
+
+
+def _source(ref: str):
+    return blobs.read(ref) if ref.startswith(blobs.KEY_PREFIX) else ref
+
+
+def score_vision_batch(posts: List[tuple]) -> List[tuple]:
+    # [(post_id, image refs)] -> [(post_id, vision scores or None when none of its images could be loaded)]
+    arrays, post_index = [], []
+    for i, (post_id, refs) in enumerate(posts):
+        for ref in refs:
+            try:
+                arrays.append(image_pipeline.model_input(_source(ref)))
+            except Exception as e:
+                print(f"[ERROR] Could not load image {ref} of post {post_id}: {e}")
+                continue
+            post_index.append(i)
+    if not arrays:
+        return [(post_id, None) for post_id, _ in posts]
+
+    results = backend_vision.run_many(arrays)
+    # one pass over the detections of every image of every post of the task
+    sums, counts = vision_scoring.class_sums(np.stack([r[1] for r in results]), np.stack([r[2] for r in results]),
+                                             np.stack([r[3] for r in results]), post_index, len(posts))
+    scores = vision_scoring.category_scores(sums, counts)
+    loaded = set(post_index)
+    return [(post_id, vision_scoring.to_dict(scores[i]) if i in loaded else None) for i, (post_id, _) in enumerate(posts)]
+
+
+# ---- llm ----
+
+class RateLimiter:
+    # spaces the calls 1 / rate seconds apart across all tasks
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def _image_hashes(post: dict) -> List[str]:
+    keys = blobs.split_keys(post['images_dir'])
+    if keys:
+        return [blobs.key_sha256(key) for key in keys]
+    return [score_cache.file_hash(path) for path in _image_refs(post)]
+
+
+class Backfill:
+    def __init__(self, args):
+        self.args = args
+        self.checkpoint_path = args.checkpoint
+        self.limiter = RateLimiter(args.llm_rps)
+        self.llm_slots = asyncio.Semaphore(args.llm_concurrency)
+        self.pool = None
+        self.state = {}
+
+    # ---- checkpoint ----
+
+    def load_checkpoint(self) -> bool:
+        if self.args.restart or not os.path.exists(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path) as f:
+            self.state = json.load(f)
+        return True
+
+    def save_checkpoint(self):
+        # written to a temp file and renamed, a crash mid-write leaves the previous checkpoint
+        self.state["elapsed"] = self.state.get("elapsed_before", 0) + time.perf_counter() - self.started
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.checkpoint_path)
+
+    def record_kept(self, ids: List[int]):
+        if ids and not self.args.dry_run:
+            with open(self.checkpoint_path + ".kept", "a") as f:
+                f.writelines(f"{i}\n" for i in ids)
+
+    # ---- scoring ----
+
+    async def llm_scores(self, post: dict):
+        # fresh gemini scores with --llm, else the cached ones (None when there are none)
+        try:
+            hashes = await asyncio.to_thread(_image_hashes, post) if post['images'] else []
+        except OSError as e:
+            print(f"[ERROR] Could not read the images of post {post['id']}: {e}")
+            return None
+        key = score_cache.llm_key([{"sha256": h} for h in hashes], post['text_descr'], backend_llm.CACHE_VERSION)
+        if not self.args.llm:
+            return await asyncio.to_thread(score_cache.get, "llm", key) if key else None
+
+        images = []
+        if post['images']:
+            try:
+                images = await post_service.load_stored_images(post['images_dir'], ["image/jpeg"] * post['images'])
+            except Exception as e:
+                print(f"[ERROR] Could not load the images of post {post['id']}: {e}")
+                return None
+        for attempt in range(BACKFILL_LLM_RETRIES):
+            await self.limiter.wait()
+            async with self.llm_slots:
+                self.state["llm_calls"] += 1
+                try:
+                    scores = await asyncio.wait_for(asyncio.to_thread(backend_llm.get_scores, images, post['text_descr'], scoring.LLM_SCORE_TIMEOUT),
+                                                    scoring.LLM_SCORE_TIMEOUT)
+                except Exception as e:
+                    print(f"[ERROR] llm scoring of post {post['id']} failed (attempt {attempt + 1}): {e}")
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+            if isinstance(scores, dict):
+                if key:
+                    await asyncio.to_thread(score_cache.put, "llm", key, scores)
+                return scores
+        return None
+
+    async def rescore(self, posts: List[dict]):
+        # -> rows for db.updatePostScores (changed posts only), ids of the posts that keep their old scores
+        loop = asyncio.get_running_loop()
+        with_images = [(p['id'], _image_refs(p)) for p in posts if p['images']]
+        vision_tasks = [loop.run_in_executor(self.pool, score_vision_batch, with_images[i:i + self.args.worker_posts])
+                        for i in range(0, len(with_images), self.args.worker_posts)]
+        wants_llm = {p['id'] for p in posts if self.args.llm or "llm" in (p['scored_by'] or "").split(",")}
+        llm_posts = [p for p in posts if p['id'] in wants_llm]
+        llm_results = await asyncio.gather(*(self.llm_scores(p) for p in llm_posts))
+        vision = dict(pair for batch in await asyncio.gather(*vision_tasks) for pair in batch)
+        llm = dict(zip([p['id'] for p in llm_posts], llm_results))
+
+        rows, kept = [], []
+        for post in posts:
+            wanted = ({"vision"} if post['images'] else set()) | ({"llm"} if post['id'] in wants_llm else set())
+            if not wanted:
+                # imported reports (bulk_ingest.py) and the like, scored outside of the app
+                self.state["skipped"] += 1
+                continue
+            results = {name: (vision if name == "vision" else llm).get(post['id']) for name in wanted}
+            if any(r is None or not isinstance(r, dict) for r in results.values()):
+                kept.append(post['id'])
+                continue
+            scores = scoring.combine_scores(results, SCORER_WEIGHTS)
+            scored_by = ",".join(sorted(results))
+            for key in SCORE_KEYS:
+                self.state["change"][key] += abs(round(scores[key]) - (post[key] or 0))
+            self.state["rescored"] += 1
+            if scored_by != post['scored_by'] or any(round(scores[key]) != post[key] for key in SCORE_KEYS):
+                rows.append([post['id'], *[scores[key] for key in SCORE_KEYS], scored_by])
+        self.state["images"] += sum(len(refs) for _, refs in with_images)
+        return rows, kept
+
+    # ---- report ----
+
+    def report(self, final: bool = False):
+        s = self.state
+        elapsed = s.get("elapsed_before", 0) + time.perf_counter() - self.started
+        span = max(s["until_id"] - s["start_id"], 1)
+        done = (s["last_id"] - s["start_id"]) / span
+        rate = s["posts"] / elapsed if elapsed else 0
+        eta = (elapsed / done - elapsed) if 0 < done < 1 else 0
+        line = (f"post id {s['last_id']}/{s['until_id']} ({done * 100:.1f}%)  posts {s['posts']}  updated {s['updated']}  "
+                f"kept {s['kept']}  skipped {s['skipped']}  locations {s.get('locations_updated') or 0}  |  {rate:.0f} posts/s  {s['images'] / elapsed if elapsed else 0:.0f} images/s  "
+                f"llm {s['llm_calls'] / elapsed if elapsed else 0:.1f}/s  |  ")
+        line += f"took {datetime.timedelta(seconds=round(elapsed))}" if final else f"eta {datetime.timedelta(seconds=round(eta))}"
+        print(line, flush=True)
+
+    # ---- run ----
+
+    async def run(self):
+        args = self.args
+        self.started = time.perf_counter()
+        if self.load_checkpoint():
+            if self.state.get("done"):
+                print(f"{self.checkpoint_path}: that backfill already finished, pass --restart to run a new one")
+                return
+            self.state["elapsed_before"] = self.state.get("elapsed", 0)
+            print(f"resuming after post id {self.state['last_id']}")
+        else:
+            until_id = await db.getMaxPostId()
+            self.state = {"start_id": args.after_id, "last_id": args.after_id, "until_id": until_id, "posts": 0,
+                          "rescored": 0, "updated": 0, "kept": 0, "skipped": 0, "images": 0, "llm_calls": 0,
+                          "change": {key: 0 for key in SCORE_KEYS}, "locations_updated": 0, "done": False,
+                          "options": {"llm": args.llm, "dry_run": args.dry_run, "weights": vision_scoring.VISION_WEIGHTS_PATH},
+                          "started_at": datetime.datetime.now().isoformat()}
+            if os.path.exists(self.checkpoint_path + ".kept") and not args.dry_run:
+                os.remove(self.checkpoint_path + ".kept")
+
+        # the workers split the cores instead of each starting a thread per core (read by backend_vision at import)
+        os.environ.setdefault("VISION_INTRA_OP_THREADS", str(max(1, (os.cpu_count() or 1) // args.workers)))
+        os.environ.setdefault("VISION_INTER_OP_THREADS", "1")
+        os.environ.setdefault("VISION_MAX_BATCH_SIZE", "32")
+        # spawn: the workers get a fresh interpreter, no copy of the parent's event loop or db connections
+        self.pool = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+        try:
+            await self._chunks()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+        self.state["done"] = True
+        if not args.dry_run:
+            self.save_checkpoint()
+        self.report(final=True)
+        if self.state["rescored"]:
+            print("mean change per post: " + ", ".join(f"{key} {self.state['change'][key] / self.state['rescored']:.2f}" for key in SCORE_KEYS))
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(self.state, f, indent=2)
+
+    async def _chunks(self):
+        args, s = self.args, self.state
+        limit = args.limit
+        last_report = 0.0
+        # the next chunk is read while the current one is scored
+        next_posts = asyncio.ensure_future(db.getPostsAfter(s["last_id"], s["until_id"], args.chunk_size))
+        while True:
+            posts = await next_posts
+            if limit is not None:
+                posts = posts[:max(limit - s["posts"], 0)]
+            if not posts:
+                break
+            next_posts = asyncio.ensure_future(db.getPostsAfter(posts[-1]['id'], s["until_id"], args.chunk_size))
+
+            rows, kept = await self.rescore(posts)
+            if rows and not args.dry_run:
+                updated, locations = await db.updatePostScores(rows)
+                s["updated"] += updated
+                if not args.no_recompute:
+                    changed = await db.recomputeLocationScores(locations)
+                    for i in range(0, len(changed), INVALIDATE_CHUNK):
+                        await location_cache.invalidate(changed[i:i + INVALIDATE_CHUNK])
+                    s["locations_updated"] = (s.get("locations_updated") or 0) + len(changed)
+            elif args.dry_run:
+                s["updated"] += len(rows)
+            self.record_kept(kept)
+            s["kept"] += len(kept)
+            s["posts"] += len(posts)
+            s["last_id"] = posts[-1]['id']
+            if not args.dry_run:
+                self.save_checkpoint()
+            if time.perf_counter() - last_report >= args.report_seconds:
+                self.report()
+                last_report = time.perf_counter()
+        next_posts.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="re-score the stored posts and recompute location_scores")
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="model processes")
+    parser.add_argument("--worker-posts", type=int, default=BACKFILL_WORKER_POSTS, help="posts per worker task")
+    parser.add_argument("--llm", action="store_true", help="ask gemini again instead of using its cached answers")
+    parser.add_argument("--llm-rps", type=float, default=BACKFILL_LLM_RPS, help="gemini calls per second")
+    parser.add_argument("--llm-concurrency", type=int, default=BACKFILL_LLM_CONCURRENCY)
+    parser.add_argument("--checkpoint", default=BACKFILL_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start over")
+    parser.add_argument("--after-id", type=int, default=0, help="start after this post id")
+    parser.add_argument("--limit", type=int, default=None, help="stop after this many posts")
+    parser.add_argument("--dry-run", action="store_true", help="score and report, write nothing")
+    parser.add_argument("--no-recompute", action="store_true", help="leave location_scores alone")
+    parser.add_argument("--report", help="write the final counters as json here")
+    parser.add_argument("--report-seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    async def main():
+        try:
+            await Backfill(args).run()
+        finally:
+            await db.close_pool()
+
+    asyncio.run(main())
@@ -0,0 +1,462 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+import httpx
+import numpy as np
+import psycopg
+from PIL import Image
+
+# end to end load test of the api, fully offline. starts
+#   - a throwaway postgres database with setup.sql applied and --locations scored locations seeded
+#     (--initdb: a whole temporary cluster from initdb / pg_ctl on PATH, otherwise a new database on the server in
+#     DB_HOST / DB_PORT / DB_USER / DB_PASSWORD, dropped again at the end)
+#   - the stand-ins: standins/google_api.py (geocode, routes, roads, places), standins/fake_gemini.py and
+#     standins/fake_vision.py (the inference server protocol), each with its own latency / jitter / error rate
+#   - the api (uvicorn main:app) pointed at all of them
+# then runs every scenario at every concurrency for --duration seconds (closed loop: each of the N clients sends
+# its next request when the last one is answered) and reports throughput and p50 / p95 / p99 latency.
+#
+# run from backend/:
+#   python benchmarks/loadtest.py run --concurrency 1 8 32 64 --duration 20 --output before.json
+#   python benchmarks/loadtest.py run --scenarios route autocomplete --google-latency-ms 80 --google-error-rate 0.02
+#   python benchmarks/loadtest.py run --api-url http://127.0.0.1:8000    # against an api that is already running
+#   python benchmarks/loadtest.py compare before.json after.json --threshold 10
+#
+# the results json has the commit it ran on and the settings, compare prints the change per scenario and
+# concurrency and exits with 1 when p95 latency or throughput got worse by more than --threshold %, or the error
+# rate went up by more than --threshold percentage points.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ["addPost", "getLocations", "route", "autocomplete"]
+# the google stand-in puts every fake coordinate within ~10 km of its STANDIN_CENTER (the same default)
+CENTER = (25.4310, 81.7703)
+LOCATION_PREFIX = "loadtest:"
+STREETS = ["civil lines", "katra", "george town", "tagore town", "allahpur", "mumfordganj", "lukerganj", "chowk",
+           "kydganj", "daraganj", "naini", "jhunsi", "phaphamau", "bamrauli", "kareli", "rajapur", "ashok nagar",
+           "colonelganj", "bairahana", "kalyani devi", "meerapur", "atala", "khuldabad", "mutthiganj"]
+TEXTS = ["big pothole in the middle of the road", "cracks all over the left lane", "water collects here after rain",
+         "road surface completely broken", "faded zebra crossing near the school", "bumpy stretch, hard to ride"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_info() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=30).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": git("rev-parse", "HEAD") or None, "branch": git("rev-parse", "--abbrev-ref", "HEAD") or None,
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+class ThrowawayPostgres:
+    def __init__(self, workdir: str, initdb: bool, keep: bool):
+        self.workdir = workdir
+        self.initdb = initdb
+        self.keep = keep
+        self.name = f"pathfinder_loadtest_{os.getpid()}"
+        self.data_dir = None
+        self.conn = None
+
+    def start(self) -> dict:
+        if self.initdb:
+            initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+            if not initdb or not pg_ctl:
+                raise SystemExit("--initdb needs the postgres binaries (initdb, pg_ctl) on PATH")
+            self.data_dir = os.path.join(self.workdir, "pgdata")
+            port = free_port()
+            subprocess.run([initdb, "-D", self.data_dir, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+                           check=True, stdout=subprocess.DEVNULL)
+            # durability doesn't matter for a database that is thrown away
+            subprocess.run([pg_ctl, "-D", self.data_dir, "-l", os.path.join(self.workdir, "postgres.log"), "-w", "start", "-o",
+                            f"-p {port} -k {self.workdir} -c listen_addresses=127.0.0.1 -c fsync=off -c synchronous_commit=off "
+                            f"-c full_page_writes=off -c max_connections=200"], check=True, stdout=subprocess.DEVNULL)
+            self.conn = {"host": "127.0.0.1", "port": port, "user": "postgres", "password": "loadtest"}
+        else:
+            self.conn = {"host": os.getenv("DB_HOST", "localhost"), "port": int(os.getenv("DB_PORT", "5432")),
+                         "user": os.getenv("DB_USER", "postgres"), "password": os.getenv("DB_PASSWORD", "")}
+
+        with psycopg.connect(dbname="postgres", autocommit=True, **self.conn) as conn:
+            conn.execute(f'CREATE DATABASE "{self.name}";')
+        with psycopg.connect(dbname=self.name, autocommit=True, **self.conn) as conn:
+            with open(os.path.join(BACKEND_DIR, "setup.sql")) as f:
+                conn.execute(f.read())
+        print(f"database {self.name} on {self.conn['host']}:{self.conn['port']}")
+        return {"DB_HOST": self.conn["host"], "DB_PORT": str(self.conn["port"]), "DB_NAME": self.name,
+                "DB_USER": self.conn["user"], "DB_PASSWORD": self.conn["password"]}
+
+    def seed_locations(self, n: int, seed: int):
+        # scored locations around the stand-in's center, so routes pass by them and /getLocations finds them
+        rng = np.random.default_rng(seed)
+        lat = CENTER[0] + rng.uniform(-0.1, 0.1, n)
+        lng = CENTER[1] + rng.uniform(-0.1, 0.1, n)
+        scores = rng.uniform(0, 100, (n, 5)).round(2)
+        with psycopg.connect(dbname=self.name, **self.conn) as conn:
+            with conn.cursor() as cur:
+                with cur.copy("COPY location (id, posts, lat, lng) FROM STDIN") as copy:
+                    for i in range(n):
+                        copy.write_row((f"{LOCATION_PREFIX}{i}", 1, float(lat[i]), float(lng[i])))
+                with cur.copy("""COPY location_scores (location_id, surface_damage, traffic_safety_risk, ride_discomfort,
+                              waterlogging, urgency_for_repair) FROM STDIN""") as copy:
+                    for i in range(n):
+                        copy.write_row((f"{LOCATION_PREFIX}{i}", *map(float, scores[i])))
+        return [f"{LOCATION_PREFIX}{i}" for i in range(n)]
+
+    def stop(self):
+        if self.conn is None:
+            return
+        if self.keep:
+            print(f"kept database {self.name} on {self.conn['host']}:{self.conn['port']}"
+                  + (f" (cluster in {self.data_dir})" if self.data_dir else ""))
+            return
+        if self.data_dir:
+            subprocess.run([shutil.which("pg_ctl"), "-D", self.data_dir, "-m", "immediate", "stop"], stdout=subprocess.DEVNULL)
+            return
+        try:
+            with psycopg.connect(dbname="postgres", autocommit=True, **self.conn) as conn:
+                conn.execute(f'DROP DATABASE IF EXISTS "{self.name}" WITH (FORCE);')
+        except Exception as e:
+            print(f"[ERROR] could not drop database {self.name}: {e}")
+
+
+class Stack:
+    # the processes of a run (stand-ins, api), stopped in reverse order
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.processes = []
+
+    def start(self, name: str, args, env: dict = None):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        process = subprocess.Popen([sys.executable, *args], cwd=BACKEND_DIR, env={**os.environ, **(env or {})},
+                                   stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((name, process, log))
+        return process
+
+    def check(self):
+        for name, process, log in self.processes:
+            if process.poll() is not None:
+                log.flush()
+                with open(log.name) as f:
+                    tail = f.read()[-3000:]
+                raise SystemExit(f"{name} exited with {process.returncode}:\n{tail}")
+
+    def stop(self):
+        for name, process, log in reversed(self.processes):
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            log.close()
+        self.processes = []
+
+
+def wait_for(stack: Stack, ready, what: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stack.check()
+        try:
+            if ready():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{what} not ready after {timeout:.0f}s")
+
+
+def port_open(port: int) -> bool:
+    with socket.socket() as s:
+        return s.connect_ex(("127.0.0.1", port)) == 0
+
+
+def standin_env(latency_ms: float, jitter_ms: float, error_rate: float, **extra) -> dict:
+    return {"STANDIN_LATENCY_MS": str(latency_ms), "STANDIN_JITTER_MS": str(jitter_ms), "STANDIN_ERROR_RATE": str(error_rate),
+            **{k: str(v) for k, v in extra.items()}}
+
+
+def start_stack(args, stack: Stack, database_env: dict) -> str:
+    google_port, gemini_port, api_port = free_port(), free_port(), free_port()
+    vision_socket = os.path.join(args.workdir, "vision.sock")
+    stack.start("google_api", ["-m", "standins.google_api", "--port", str(google_port)],
+                standin_env(args.google_latency_ms, args.google_jitter_ms, args.google_error_rate, STANDIN_CENTER=f"{CENTER[0]},{CENTER[1]}"))
+    stack.start("fake_gemini", ["-m", "standins.fake_gemini", "--port", str(gemini_port)],
+                standin_env(args.gemini_latency_ms, args.gemini_jitter_ms, args.gemini_error_rate))
+    stack.start("fake_vision", ["-m", "standins.fake_vision", "--socket", vision_socket],
+                standin_env(args.vision_latency_ms, 0, args.vision_error_rate, STANDIN_IMAGE_MS=args.vision_image_ms))
+    wait_for(stack, lambda: port_open(google_port) and port_open(gemini_port) and os.path.exists(vision_socket), "stand-ins", 30)
+
+    uploads = os.path.join(args.workdir, "uploads")
+    env = {
+        **database_env,
+        "GOOGLE_STANDIN_URL": f"http://127.0.0.1:{google_port}",
+        "GOOGLE_API_KEY": "standin",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{gemini_port}",
+        "GEMINI_API_KEY": "standin",
+        "VISION_INFERENCE_SOCKET": vision_socket,
+        "STORAGE_BACKEND": "local",
+        "STORAGE_LOCAL_DIR": uploads,
+        "STORAGE_TMP_DIR": os.path.join(args.workdir, "uploads-tmp"),
+        # every run starts cold and on its own: no persisted scores, no shared cache from somewhere else
+        "SCORE_CACHE_PERSIST": "0",
+        "LOCATION_CACHE_REDIS_URL": "",
+        "WARMUP_ON_STARTUP": "1",
+    }
+    stack.start("api", ["-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(api_port), "--workers", str(args.workers),
+                        "--log-level", "warning", "--no-access-log"], env)
+    api_url = f"http://127.0.0.1:{api_port}"
+    wait_for(stack, lambda: httpx.get(f"{api_url}/health/ready", timeout=2).status_code == 200, "api", args.startup_timeout)
+    print(f"api on {api_url} ({args.workers} workers), logs in {args.workdir}")
+    return api_url
+
+
+def jpeg(rng: random.Random, width: int, height: int) -> bytes:
+    # a blocky random image: different pixels every time (no score cache hits), but small and cheap to encode
+    blocks = np.frombuffer(rng.randbytes(12 * 9 * 3), dtype=np.uint8).reshape(9, 12, 3)
+    buf = io.BytesIO()
+    Image.fromarray(blocks).resize((width, height), Image.NEAREST).save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def near_center(rng: random.Random):
+    return CENTER[0] + rng.uniform(-0.1, 0.1), CENTER[1] + rng.uniform(-0.1, 0.1)
+
+
+def scenario_requests(args, location_ids):
+    width, height = (int(v) for v in args.image_size.split("x"))
+    places = [f"{street}, prayagraj" for street in STREETS] + [f"ward {i}, prayagraj" for i in range(args.places)]
+    ids = location_ids or [f"{LOCATION_PREFIX}{i}" for i in range(args.locations)]
+
+    # every scenario makes the arguments of its next client.request(); that happens before the clock starts
+
+    def post_files(rng: random.Random):
+        return [("images_bytes", (f"road{i}.jpg", jpeg(rng, width, height), "image/jpeg")) for i in range(args.images_per_post)]
+
+    async def add_post(rng: random.Random) -> dict:
+        lat, lng = near_center(rng)
+        data = {"text_descr": rng.choice(TEXTS), "latitude": f"{lat:.6f}", "longitude": f"{lng:.6f}"}
+        # encoding the images would hold up the event loop (and the timing of the other clients' requests)
+        files = await asyncio.to_thread(post_files, random.Random(rng.random()))
+        return {"method": "POST", "url": "/addPost", "data": data, "files": files}
+
+    async def get_locations(rng: random.Random) -> dict:
+        return {"method": "GET", "url": "/getLocations", "json": {"location_ids": rng.sample(ids, min(len(ids), args.ids_per_request))}}
+
+    async def route(rng: random.Random) -> dict:
+        origin, destination = rng.sample(places, 2)
+        return {"method": "GET", "url": "/route", "params": {"origin": origin, "destination": destination}}
+
+    async def autocomplete(rng: random.Random) -> dict:
+        # what a user types: growing prefixes of a street name, so some are cache hits and some aren't
+        street = rng.choice(STREETS)
+        return {"method": "GET", "url": "/api/autocomplete", "params": {"input_text": street[:rng.randint(3, len(street))]}}
+
+    return {"addPost": add_post, "getLocations": get_locations, "route": route, "autocomplete": autocomplete}
+
+
+def summarize(latencies, statuses: Counter, seconds: float, concurrency: int) -> dict:
+    errors = sum(n for status, n in statuses.items() if not (isinstance(status, int) and 200 <= status < 300))
+    requests = sum(statuses.values())
+    result = {"concurrency": concurrency, "requests": requests, "errors": errors,
+              "error_rate": round(errors / requests, 4) if requests else 0.0,
+              "rps": round(requests / seconds, 2), "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)}}
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        result.update({"p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+                       "mean_ms": round(float(np.mean(latencies)), 2), "max_ms": round(float(np.max(latencies)), 2)})
+    return result
+
+
+async def run_level(api_url: str, prepare, concurrency: int, args, seed: int) -> dict:
+    latencies, statuses = [], Counter()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=api_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        measure_from = started + args.warmup
+        stop_at = measure_from + args.duration
+
+        async def worker(i: int):
+            rng = random.Random(seed * 100003 + i)
+            while time.perf_counter() < stop_at:
+                kwargs = await prepare(rng)
+                sent = time.perf_counter()
+                try:
+                    status = (await client.request(**kwargs)).status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                done = time.perf_counter()
+                # requests sent during the warm-up or still running at the end aren't counted
+                if sent >= measure_from and done <= stop_at:
+                    latencies.append((done - sent) * 1000)
+                    statuses[status] += 1
+
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return summarize(latencies, statuses, args.duration, concurrency)
+
+
+def print_level(r: dict):
+    if "p50_ms" not in r:
+        print(f"  {r['concurrency']:>5} {r['requests']:>7} {'-':>6}")
+        return
+    print(f"  {r['concurrency']:>5} {r['requests']:>7} {r['error_rate'] * 100:>5.1f}% {r['rps']:>8.1f} "
+          f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+async def run_scenarios(api_url: str, args, location_ids) -> dict:
+    requests = scenario_requests(args, location_ids)
+    results = {}
+    for s, name in enumerate(args.scenarios):
+        print(f"{name}\n  {'conc':>5} {'reqs':>7} {'err':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        results[name] = []
+        for level, concurrency in enumerate(args.concurrency):
+            r = await run_level(api_url, requests[name], concurrency, args, args.seed + s * 1000 + level)
+            results[name].append(r)
+            print_level(r)
+    return results
+
+
+def run(args):
+    settings = {k: v for k, v in vars(args).items() if k not in ("command", "output", "workdir", "keep")}
+    own_workdir = args.workdir is None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="pathfinder-loadtest-")
+    os.makedirs(args.workdir, exist_ok=True)
+    stack = Stack(args.workdir)
+    postgres = None
+    location_ids = None
+    try:
+        api_url = args.api_url
+        if api_url is None:
+            postgres = ThrowawayPostgres(args.workdir, args.initdb, args.keep)
+            database_env = postgres.start()
+            location_ids = postgres.seed_locations(args.locations, args.seed)
+            api_url = start_stack(args, stack, database_env)
+        results = asyncio.run(run_scenarios(api_url, args, location_ids))
+        try:
+            api_metrics = httpx.get(f"{api_url}/metrics", timeout=10).json()
+        except Exception as e:
+            print(f"[ERROR] could not read /metrics: {e}")
+            api_metrics = None
+    finally:
+        stack.stop()
+        if postgres is not None:
+            postgres.stop()
+        if own_workdir and not args.keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    report = {
+        "meta": {**git_info(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "host": platform.node(),
+                 "python": platform.python_version(), "cpus": os.cpu_count(), "settings": settings},
+        "scenarios": results,
+        "api_metrics": api_metrics,
+    }
+    output = args.output or f"loadtest-{(report['meta']['commit'] or 'unknown')[:10]}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}")
+
+
+def change(old, new) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base['meta'].get('commit')} ({base['meta'].get('timestamp')})\n"
+          f"new  {new['meta'].get('commit')} ({new['meta'].get('timestamp')}){' dirty' if new['meta'].get('dirty') else ''}")
+    differing = sorted(k for k in set(base["meta"]["settings"]) | set(new["meta"]["settings"])
+                       if base["meta"]["settings"].get(k) != new["meta"]["settings"].get(k))
+    if differing:
+        print(f"note: the runs used different settings ({', '.join(differing)}), the numbers may not be comparable")
+
+    regressions = 0
+    for name, levels in new["scenarios"].items():
+        old_levels = {r["concurrency"]: r for r in base["scenarios"].get(name, [])}
+        print(f"{name}\n  {'conc':>5} {'rps':>18} {'p50 ms':>20} {'p95 ms':>20} {'p99 ms':>20} {'err':>13}")
+        for r in levels:
+            old = old_levels.get(r["concurrency"])
+            if old is None or "p50_ms" not in old or "p50_ms" not in r:
+                print(f"  {r['concurrency']:>5} (not in both runs)")
+                continue
+            worse = []
+            if change(old["p95_ms"], r["p95_ms"]) > args.threshold:
+                worse.append("p95")
+            if change(old["rps"], r["rps"]) < -args.threshold:
+                worse.append("rps")
+            if (r["error_rate"] - old["error_rate"]) * 100 > args.threshold:
+                worse.append("errors")
+            regressions += bool(worse)
+            cells = " ".join(f"{old[k]:>7.1f}>{r[k]:<7.1f}{change(old[k], r[k]):>+4.0f}%" for k in ("rps", "p50_ms", "p95_ms", "p99_ms"))
+            errors = f"{old['error_rate'] * 100:.1f}%>{r['error_rate'] * 100:.1f}%"
+            print(f"  {r['concurrency']:>5} {cells} {errors:>13}"
+                  + (f"  REGRESSION ({', '.join(worse)})" if worse else ""))
+
+    print(f"{regressions} regression(s) beyond {args.threshold:g}%")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline load test of the api against local stand-ins")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("run", help="start everything, run the scenarios, write the results json")
+    p.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    p.add_argument("--duration", type=float, default=20, help="measured seconds per scenario and concurrency")
+    p.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    p.add_argument("--timeout", type=float, default=60, help="per request")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", default=None, help="results json, default loadtest-<commit>.json")
+    p.add_argument("--api-url", default=None, help="test an api that is already running instead of starting one")
+    p.add_argument("--workers", type=int, default=1, help="uvicorn workers of the api")
+    p.add_argument("--startup-timeout", type=float, default=120)
+    p.add_argument("--initdb", action="store_true", help="throwaway postgres cluster instead of a database on DB_HOST")
+    p.add_argument("--keep", action="store_true", help="keep the database and the work directory (logs, uploads)")
+    p.add_argument("--workdir", default=None)
+    p.add_argument("--locations", type=int, default=5000, help="scored locations to seed")
+    p.add_argument("--ids-per-request", type=int, default=200, help="/getLocations")
+    p.add_argument("--places", type=int, default=100, help="distinct addresses for /route")
+    p.add_argument("--images-per-post", type=int, default=1)
+    p.add_argument("--image-size", default="1280x960")
+    p.add_argument("--google-latency-ms", type=float, default=40)
+    p.add_argument("--google-jitter-ms", type=float, default=40)
+    p.add_argument("--google-error-rate", type=float, default=0)
+    p.add_argument("--gemini-latency-ms", type=float, default=1200)
+    p.add_argument("--gemini-jitter-ms", type=float, default=800)
+    p.add_argument("--gemini-error-rate", type=float, default=0)
+    p.add_argument("--vision-latency-ms", type=float, default=5)
+    p.add_argument("--vision-image-ms", type=float, default=40, help="inference time per image of the fake model")
+    p.add_argument("--vision-error-rate", type=float, default=0)
+
+    p = commands.add_parser("compare", help="compare two results files")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=10, help="percent")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
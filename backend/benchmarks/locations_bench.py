@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# run from backend/:  python benchmarks/locations_bench.py --sizes 10 100 1000 5000
+# seeds `bench:` locations into the configured database (DB_PASSWORD etc. as for the api), times the old per-id
+# lookup against the bulk one for growing id lists, and deletes the seeded rows again.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db
+
+PREFIX = "bench:"
+
+
+async def seed(n: int):
+    ids = [f"{PREFIX}{i}" for i in range(n)]
+    async with (await db.open_pool()).connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany("INSERT INTO location (id, posts) VALUES (%s, 2) ON CONFLICT (id) DO NOTHING;", [(i,) for i in ids])
+            await cur.executemany("""INSERT INTO location_scores (location_id, surface_damage, traffic_safety_risk, ride_discomfort,
+                                  waterlogging, urgency_for_repair) VALUES (%s, 100, 80, 60, 40, 20)
+                                  ON CONFLICT (location_id) DO NOTHING;""", [(i,) for i in ids])
+
+
+async def cleanup():
+    async with (await db.open_pool()).connection() as conn:
+        await conn.execute("DELETE FROM location_scores WHERE location_id LIKE %s;", (PREFIX + "%",))
+        await conn.execute("DELETE FROM location WHERE id LIKE %s;", (PREFIX + "%",))
+
+
+async def per_id(ids):
+    # what getLocations used to do: a pooled connection and two queries per id
+    found = []
+    for loc_id in ids:
+        async with (await db.open_pool()).connection() as conn:
+            cur = await conn.execute("SELECT * FROM location_scores WHERE location_id = %s;", (loc_id,))
+            row = await cur.fetchone()
+            if row is not None:
+                cur = await conn.execute("SELECT posts FROM location WHERE id = %s;", (loc_id,))
+                if (await cur.fetchone())['posts']:
+                    found.append(row)
+    return found
+
+
+async def timed(fn, ids, repeat: int):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await fn(ids)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), len(result)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="per-id vs bulk location lookup latency")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--per-id-max", type=int, default=5000, help="skip the per-id lookup above this many ids")
+    args = parser.parse_args()
+
+    await (await db.open_pool()).wait()
+    await seed(max(args.sizes))
+    try:
+        print(f"{'ids':>7} {'per-id ms':>10} {'bulk ms':>9} {'speedup':>8}")
+        for n in args.sizes:
+            ids = [f"{PREFIX}{i}" for i in range(n)]
+            bulk_ms, found = await timed(db.getLocations, ids, args.repeat)
+            assert found == n, f"bulk lookup found {found} of {n}"
+            if n <= args.per_id_max:
+                old_ms, _ = await timed(per_id, ids, args.repeat)
+                print(f"{n:>7} {old_ms:>10.1f} {bulk_ms:>9.1f} {old_ms / bulk_ms:>7.1f}x")
+            else:
+                print(f"{n:>7} {'-':>10} {bulk_ms:>9.1f} {'-':>8}")
+    finally:
+        await cleanup()
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
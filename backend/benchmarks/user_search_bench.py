@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+# run from backend/:  python benchmarks/user_search_bench.py --sizes 100000 1000000 3000000
+# grows the users table with synthetic `bench-u:` users (COPY) step by step and after every step times the old
+# ILIKE '%x%' search against db.searchForUser (first and third page, long and short queries). the synthetic users
+# are deleted at the end unless --keep is given.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db
+
+PREFIX = "bench-u:"
+FIRST = ["sahil", "aarav", "priya", "rohan", "ananya", "vikram", "neha", "arjun", "kavya", "ishaan", "meera", "kabir",
+         "diya", "aditya", "sara", "rahul", "pooja", "karan", "riya", "dev", "tanvi", "nikhil", "isha", "yash"]
+LAST = ["gupta", "sharma", "verma", "singh", "kumar", "patel", "reddy", "iyer", "nair", "das", "mehta", "joshi",
+        "chopra", "malhotra", "bose", "rao", "saxena", "kapoor", "mishra", "pandey"]
+QUERIES = ["sahil gupta", "priya", "malhotra", "kavya iyer", "sa", "r"]
+
+
+async def grow(start: int, stop: int):
+    rng = random.Random(start)
+    async with (await db.open_pool()).connection() as conn:
+        await conn.execute("SET statement_timeout = 0;")
+        async with conn.cursor().copy("COPY users (id, name, reputation) FROM STDIN") as copy:
+            for i in range(start, stop):
+                name = f"{rng.choice(FIRST)} {rng.choice(LAST)}{rng.randrange(1000) if rng.random() < 0.5 else ''}"
+                await copy.write_row((f"{PREFIX}{i}", name, rng.randrange(5000)))
+        await conn.execute("ANALYZE users;")
+
+
+async def cleanup():
+    async with (await db.open_pool()).connection() as conn:
+        await conn.execute("SET statement_timeout = 0;")
+        await conn.execute("DELETE FROM users WHERE id LIKE %s;", (PREFIX + "%",))
+
+
+async def ilike(query: str):
+    # what searchForUser used to do
+    async with (await db.open_pool()).connection() as conn:
+        await conn.execute("SET statement_timeout = 0;")
+        cur = await conn.execute("SELECT * FROM users WHERE name ILIKE %s", ('%' + query + '%',))
+        return await cur.fetchall()
+
+
+async def third_page(query: str):
+    cursor = None
+    for _ in range(3):
+        result = await db.searchForUser(query, 20, cursor)
+        cursor = result['next_cursor']
+        if cursor is None:
+            break
+    return result
+
+
+async def timed(fn, repeat: int):
+    times = []
+    for query in QUERIES:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            await fn(query)
+            times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.95) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="user search latency as the users table grows")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000, 3000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-ilike", action="store_true", help="don't time the old full scan search")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic users")
+    args = parser.parse_args()
+
+    await (await db.open_pool()).wait()
+    size = 0
+    try:
+        print(f"{'users':>9} {'ilike p50/p95 ms':>18} {'page 1 p50/p95 ms':>19} {'page 3 p50/p95 ms':>19}")
+        for target in sorted(args.sizes):
+            await grow(size, target)
+            size = target
+            old = "-" if args.skip_ilike else "%.1f / %.1f" % await timed(ilike, args.repeat)
+            first = "%.1f / %.1f" % await timed(lambda q: db.searchForUser(q), args.repeat)
+            third = "%.1f / %.1f" % await timed(third_page, args.repeat)
+            print(f"{size:>9} {old:>18} {first:>19} {third:>19}")
+    finally:
+        if not args.keep:
+            await cleanup()
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import numpy as np
+
+# run from backend/:  python benchmarks/vision_backends_bench.py --backends tf tflite onnx --threads 4
+# loads every vision backend (vision_backends/, model files from convert_model.py) and on the sample images times
+#   - latency: one image per run, p50 / p95
+#   - throughput: --batch-size images per run (the sample images repeated), images/s
+#   - parity with the first backend (tf by default): detections above the confidence threshold matched by class
+#     and box overlap, the largest confidence difference of a match, and the largest change of a category score
+# a backend whose runtime or model file is missing is skipped. --json writes the numbers for comparing runs.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backend_vision
+import image_pipeline
+import vision_scoring
+
+MATCH_IOU = 0.5
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def kept(result):
+    # -> [(class id, confidence, box)] of the detections the scoring counts
+    boxes, scores, classes, num = result
+    return [(int(classes[i]), float(scores[i]), boxes[i]) for i in range(int(num)) if scores[i] >= vision_scoring.CONFIDENCE_THRESHOLD]
+
+
+def iou(a, b) -> float:
+    # boxes are [ymin, xmin, ymax, xmax], normalized
+    h = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    w = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = h * w
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def parity(reference, result) -> dict:
+    expected, got = kept(reference), kept(result)
+    matched, score_diff, used = 0, 0.0, set()
+    for class_id, score, box in expected:
+        candidates = [(iou(box, b), j) for j, (c, _, b) in enumerate(got) if c == class_id and j not in used]
+        overlap, j = max(candidates, default=(0.0, None))
+        if j is not None and overlap >= MATCH_IOU:
+            used.add(j)
+            matched += 1
+            score_diff = max(score_diff, abs(score - got[j][1]))
+
+    def categories(r):
+        sums, counts = vision_scoring.class_sums(r[1], r[2], [r[3]])
+        return vision_scoring.category_scores(sums, counts)[0]
+
+    return {
+        "reference_detections": len(expected),
+        "detections": len(got),
+        "matched": matched,
+        "max_confidence_diff": round(score_diff, 4),
+        "max_category_diff": round(float(np.max(np.abs(categories(reference) - categories(result)))), 2),
+    }
+
+
+def bench(name: str, model_path: str, images, args) -> dict:
+    started = time.perf_counter()
+    model = backend_vision.create_backend(name, model_path, args.threads, args.inter_op_threads)
+    load_ms = (time.perf_counter() - started) * 1000
+    model.run(images[0][None])  # warm up
+
+    latencies = []
+    for _ in range(args.repeat):
+        for image in images:
+            started = time.perf_counter()
+            model.run(image[None])
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    batch = np.stack([images[i % len(images)] for i in range(args.batch_size)])
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        model.run(batch)
+    throughput = args.batch_size * args.repeat / (time.perf_counter() - started)
+
+    outputs = []
+    for image in images:
+        boxes, scores, classes, num = model.run(image[None])
+        outputs.append((boxes[0], scores[0], classes[0], num[0]))
+    model.close()
+    return {
+        "model": model.model_path,
+        "load_ms": round(load_ms, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "images_per_s": round(throughput, 1),
+        "outputs": outputs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="latency, throughput and detection parity of the vision backends")
+    parser.add_argument("--backends", nargs="+", default=["tf", "tflite", "onnx"], choices=sorted(backend_vision.MODEL_PATHS),
+                        help="the first one that loads is the parity reference")
+    parser.add_argument("--model", action="append", default=[], metavar="BACKEND=PATH", help="model file of a backend")
+    parser.add_argument("--images", nargs="+", default=["road.jpg", "badroad.jpg"])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=0, help="intra op threads, 0 = the runtime's default")
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    paths = dict(m.split("=", 1) for m in args.model)
+    images = [image_pipeline.model_input(path) for path in args.images]
+
+    results = {}
+    for name in args.backends:
+        try:
+            results[name] = bench(name, paths.get(name), images, args)
+        except Exception as e:
+            print(f"[ERROR] skipping {name}: {e}")
+    if not results:
+        raise SystemExit("no backend could be loaded")
+
+    reference = next(iter(results))
+    print(f"{'backend':<8} {'load ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>8}  parity with {reference} per image: "
+          f"matched/expected+extra, max confidence diff, max category diff")
+    for name, r in results.items():
+        r["parity"] = {os.path.basename(path): parity(ref, out)
+                       for path, ref, out in zip(args.images, results[reference]["outputs"], r["outputs"])}
+        cells = "  ".join(f"{image} {p['matched']}/{p['reference_detections']}+{p['detections'] - p['matched']} "
+                          f"{p['max_confidence_diff']:.3f} {p['max_category_diff']:.2f}" for image, p in r["parity"].items())
+        print(f"{name:<8} {r['load_ms']:>8.0f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['images_per_s']:>8.1f}  {cells}")
+
+    if args.json:
+        report = {"reference": reference, "repeat": args.repeat, "batch_size": args.batch_size, "threads": args.threads,
+                  "backends": {name: {k: v for k, v in r.items() if k != "outputs"} for name, r in results.items()}}
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
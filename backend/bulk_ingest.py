@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import math
+import os
+import numpy as np
+from dotenv import load_dotenv
+import road_index
+import location_cache
+from database import db
+
+load_dotenv()
+
+# bulk import of historical / partner road reports (e.g. municipal road surveys) from csv.
+# rows are validated here and loaded in batches with COPY + set-wise aggregate updates (db.bulkAddPosts),
+# each batch in one transaction. a report needs scores and either a location_id or lat/lng; reports with only
+# coordinates are snapped to a road segment with the local road index (road_index.py), all of a batch at once.
+#
+#   python bulk_ingest.py survey.csv --batch-size 50000 --scored-by municipal_survey
+#
+# header (any order, extra columns ignored):
+#   location_id, lat, lng, posted_by, text_descr, surface_damage, traffic_safety_risk, ride_discomfort,
+#   waterlogging, urgency_for_repair, created_at
+
+BULK_INGEST_BATCH_SIZE = int(os.getenv("BULK_INGEST_BATCH_SIZE", "50000"))
+MAX_ERRORS_REPORTED = 20
+
+SCORE_COLUMNS = ["surface_damage", "traffic_safety_risk", "ride_discomfort", "waterlogging", "urgency_for_repair"]
+
+
+def _float_or_none(value):
+    try:
+        return float(value) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def parse_row(row: dict, scored_by: str):
+    # -> (values in db.BULK_POST_COLUMNS order, None) or (None, reason)
+    scores = [_float_or_none(row.get(c)) for c in SCORE_COLUMNS]
+    if any(s is None or not 0 <= s <= 100 for s in scores):
+        return None, "scores must be numbers from 0 to 100"
+    lat, lng = _float_or_none(row.get("lat")), _float_or_none(row.get("lng"))
+    # float() takes "nan" and "inf" too, one of them in location.lat/lng would turn the sums of whole score tiles nan
+    if (lat is not None and not (math.isfinite(lat) and -90 <= lat <= 90)) or (lng is not None and not (math.isfinite(lng) and -180 <= lng <= 180)):
+        return None, "lat must be from -90 to 90 and lng from -180 to 180"
+    location_id = (row.get("location_id") or "").strip() or None
+    if location_id is None and (lat is None or lng is None):
+        return None, "needs a location_id or lat/lng"
+    created_at = row.get("created_at") or None
+    if created_at:
+        try:
+            created_at = datetime.datetime.fromisoformat(created_at)
+        except ValueError:
+            return None, f"bad created_at {created_at!r}"
+    return [location_id, lat, lng, (row.get("posted_by") or "").strip() or None, row.get("text_descr") or "",
+            *[round(s) for s in scores], scored_by, created_at or datetime.datetime.now()], None
+
+
+def _snap_missing(rows):
+    # fills in the location_id of rows that only have coordinates, returns the rows that couldn't be placed
+    missing = [r for r in rows if r[0] is None]
+    if not missing:
+        return []
+    index = road_index.get_index()
+    if index is None:
+        return missing
+    ids = index.snap_ids(np.asarray([r[1] for r in missing]), np.asarray([r[2] for r in missing]))
+    unplaced = []
+    for row, location_id in zip(missing, ids):
+        if location_id is None:
+            unplaced.append(row)
+        row[0] = location_id
+    return unplaced
+
+
+def _read_batch(reader, scored_by: str, batch_size: int):
+    # next batch of parsed rows as [(line, values)] plus the rejected [(line, reason)], runs in a thread
+    batch, rejects = [], []
+    for row in reader:
+        # line 1 is the header
+        line = reader.line_num
+        values, reason = parse_row(row, scored_by)
+        if values is None:
+            rejects.append((line, reason))
+            continue
+        batch.append((line, values))
+        if len(batch) >= batch_size:
+            break
+    return batch, rejects
+
+
+async def ingest_csv(text_file, scored_by: str = "import", batch_size: int = BULK_INGEST_BATCH_SIZE) -> dict:
+    # text_file: an open csv (text mode) with a header row
+    added = rejected = failed_batches = 0
+    errors = []
+
+    def reject(line: int, reason: str):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < MAX_ERRORS_REPORTED:
+            errors.append({"line": line, "error": reason})
+
+    async def flush(batch):
+        nonlocal added, failed_batches
+        unplaced = {id(r) for r in await asyncio.to_thread(_snap_missing, [r for _, r in batch])}
+        rows = []
+        for line, row in batch:
+            if id(row) in unplaced:
+                reject(line, "not near any known road")
+            else:
+                rows.append(row)
+        if rows:
+            count = await db.bulkAddPosts(rows)
+            if count:
+                await location_cache.invalidate(list({r[0] for r in rows}))
+            if count == 0:
+                failed_batches += 1
+            added += count
+
+    # parsing is cpu work on a (possibly spooled to disk) file, it stays off the event loop
+    reader = csv.DictReader(text_file)
+    while True:
+        batch, rejects = await asyncio.to_thread(_read_batch, reader, scored_by, batch_size)
+        for line, reason in rejects:
+            reject(line, reason)
+        if not batch:
+            break
+        await flush(batch)
+
+    return {"added": added, "rejected": rejected, "failed_batches": failed_batches, "errors": errors}
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="bulk import of road reports from csv")
+    parser.add_argument("csv")
+    parser.add_argument("--batch-size", type=int, default=BULK_INGEST_BATCH_SIZE)
+    parser.add_argument("--scored-by", default="import", help="recorded in posts.scored_by for the imported rows")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    async def run():
+        try:
+            with open(args.csv, newline="", encoding="utf-8") as f:
+                return await ingest_csv(f, args.scored_by, args.batch_size)
+        finally:
+            await db.close_pool()
+
+    result = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    print(f"added {result['added']}, rejected {result['rejected']}, failed batches {result['failed_batches']} "
+          f"in {elapsed:.1f} s ({result['added'] / max(elapsed, 1e-9):.0f} rows/s)")
+    for error in result["errors"]:
+        print(f"  line {error['line']}: {error['error']}")
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+# small in-process caches shared by the backend modules.
+
+MISSING = object()
+
+
+# thread-safe LRU cache with an optional time-to-live (in seconds) per entry.
+# keeps hit/miss counters so the hit ratio can be reported on /metrics.
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = None, name: str = "cache"):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is not MISSING and entry[0] is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                entry = MISSING
+            if entry is MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        # like get, but doesn't count as a lookup or refresh the entry's LRU position
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is MISSING or (entry[0] is not None and entry[0] < time.monotonic()):
+                return default
+            return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+# coalesces concurrent identical async calls: while a call for `key` is in flight, other callers asking
+# for the same key wait for that call's result instead of starting their own upstream request.
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: a caller that gets cancelled (client went away) must not cancel the call the others wait for
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._inflight), "calls": self.calls, "coalesced": self.coalesced}
@@ -0,0 +1,123 @@
+import argparse
+import glob
+import os
+import backend_vision
+import image_pipeline
+
+# makes the model files of the other vision backends (vision_backends/) from the frozen ssd graph:
+#
+#   python convert_model.py tflite                       # int8, calibrated on the sample images
+#   python convert_model.py tflite --calibration-dir uploads/blobs --calibration-images 300
+#   python convert_model.py tflite --float               # no quantization
+#   python convert_model.py onnx                         # float, plus an int8 (dynamic) copy with --quantize
+#
+# then start the api / inference_server.py / backfill.py with VISION_BACKEND=tflite or onnx and compare the
+# backends with benchmarks/vision_backends_bench.py first, int8 moves the scores a little.
+# needs tensorflow (both), tf2onnx and onnx (onnx), onnxruntime (--quantize). only run this offline, not on the api.
+
+INPUT = "image_tensor"
+OUTPUTS = ["detection_boxes", "detection_scores", "detection_classes", "num_detections"]
+SAMPLE_IMAGES = ["road.jpg", "badroad.jpg"]
+
+
+def calibration_images(directory: str = None, limit: int = 100):
+    # the representative inputs int8 calibration measures the activation ranges on: real road photos, as the model
+    # sees them (resized to the model input, uint8). blob files have no extension, so everything in the directory
+    # that decodes is used.
+    if directory:
+        paths = sorted(p for p in glob.glob(os.path.join(directory, "**", "*"), recursive=True) if os.path.isfile(p))
+    else:
+        paths = SAMPLE_IMAGES
+    images = []
+    for path in paths:
+        if len(images) >= limit:
+            break
+        try:
+            images.append(image_pipeline.model_input(path))
+        except Exception as e:
+            print(f"[ERROR] skipping {path}: {e}")
+    if not images:
+        raise SystemExit(f"no calibration images found in {directory or SAMPLE_IMAGES}")
+    return images
+
+
+def load_graph_def(path: str):
+    import tensorflow as tf
+
+    graph_def = tf.compat.v1.GraphDef()
+    with tf.compat.v1.gfile.GFile(path, "rb") as fid:
+        graph_def.ParseFromString(fid.read())
+    return graph_def
+
+
+def to_tflite(args):
+    import tensorflow as tf
+
+    width, height = backend_vision.MODEL_INPUT_SIZE
+
+    def converter():
+        c = tf.compat.v1.lite.TFLiteConverter.from_frozen_graph(
+            args.model, input_arrays=[INPUT], output_arrays=OUTPUTS, input_shapes={INPUT: [1, height, width, 3]})
+        if not args.float:
+            images = calibration_images(args.calibration_dir, args.calibration_images)
+            print(f"calibrating on {len(images)} images")
+            c.optimizations = [tf.lite.Optimize.DEFAULT]
+            c.representative_dataset = lambda: ([image[None]] for image in images)
+        return c
+
+    # the ssd postprocessing (non max suppression, the while loops of the batch ops) isn't all tflite builtins.
+    # try builtins only first, a model that needs the tensorflow ops (flex) only runs with full tensorflow.
+    try:
+        c = converter()
+        c.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8 if not args.float else tf.lite.OpsSet.TFLITE_BUILTINS]
+        model = c.convert()
+        flex = False
+    except Exception as e:
+        print(f"builtin ops only failed ({str(e).splitlines()[0] if str(e) else e}), converting with SELECT_TF_OPS")
+        c = converter()
+        c.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        model = c.convert()
+        flex = True
+
+    output = args.output or backend_vision.MODEL_PATHS["tflite"]
+    with open(output, "wb") as f:
+        f.write(model)
+    print(f"wrote {output} ({len(model) / 1e6:.1f} MB, {'float' if args.float else 'int8'})")
+    if flex:
+        print("the model uses tensorflow ops: run it with the tensorflow package installed, tflite-runtime alone can't")
+
+
+def to_onnx(args):
+    import tf2onnx
+
+    output = args.output or backend_vision.MODEL_PATHS["onnx"]
+    tf2onnx.convert.from_graph_def(load_graph_def(args.model), input_names=[INPUT + ":0"],
+                                   output_names=[name + ":0" for name in OUTPUTS], opset=args.opset, output_path=output)
+    print(f"wrote {output} ({os.path.getsize(output) / 1e6:.1f} MB, float)")
+    if args.quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # dynamic quantization: int8 weights, the activations are quantized on the fly, no calibration needed
+        root, ext = os.path.splitext(output)
+        quantized = root + "_int8" + ext
+        quantize_dynamic(output, quantized, weight_type=QuantType.QInt8)
+        print(f"wrote {quantized} ({os.path.getsize(quantized) / 1e6:.1f} MB, int8 weights), "
+              f"use it with VISION_MODEL_PATH={quantized}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert the frozen ssd graph for the tflite / onnx vision backends")
+    parser.add_argument("target", choices=["tflite", "onnx"])
+    parser.add_argument("--model", default=backend_vision.MODEL_PATH, help="frozen graph (.pb)")
+    parser.add_argument("--output", default=None, help="default: the model path of the backend in backend_vision.py")
+    parser.add_argument("--float", action="store_true", help="tflite: no int8 quantization")
+    parser.add_argument("--calibration-dir", default=None, help="tflite: images to calibrate int8 on, default the sample images")
+    parser.add_argument("--calibration-images", type=int, default=100)
+    parser.add_argument("--opset", type=int, default=13, help="onnx opset")
+    parser.add_argument("--quantize", action="store_true", help="onnx: also write an int8 (dynamic) copy")
+    args = parser.parse_args()
+
+    if args.target == "tflite":
+        to_tflite(args)
+    else:
+        to_onnx(args)
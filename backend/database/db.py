@@ -1,11 +1,16 @@
-# postgres database libraries in python
-from psycopg2 import pool 
-from psycopg2.extras import RealDictCursor
+# postgres database library (psycopg 3, async)
+import psycopg
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
 
 # for environment variable 'DB_PASSWORD'
 import os
+import asyncio
+import base64
+import json
 
-# data models 
+# data models
 from database.models import User, Location
 # to convert dataclass objects to python dictionary
 from dataclasses import asdict
@@ -16,9 +21,10 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-DB_HOST = "localhost"
-DB_NAME = "pathfinder_db"
-DB_USER = "postgres"
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = int(os.getenv("DB_PORT", "5432"))
+DB_NAME = os.getenv("DB_NAME", "pathfinder_db")
+DB_USER = os.getenv("DB_USER", "postgres")
 
 try:
     DB_PASSWORD = os.getenv("DB_PASSWORD") #Using project env rather than system env.
@@ -26,73 +32,166 @@ try:
 except KeyError:
     raise RuntimeError("Required environment variable DB_PASSWORD not found on your system. Set it.")
 
-# defining the connection pool (its just like the thread pool ;)
-conn_pool = pool.SimpleConnectionPool(
-    1, 20,
-    host=DB_HOST,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD
-)
-
-def createUser(user: User) -> bool:
-    cur = conn = None # initialize these values first, in case try block fails immediately, finally should be valid so cur and conn need to be 
-    # present in finally block
+# the pool is shared by every request of this worker. handlers await a connection instead of holding one of
+# starlette's threads while postgres answers, so db latency no longer caps the number of requests in flight.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+# how long a request waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# every statement of the api is cut off after this, a slow query fails instead of piling up requests behind it
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+# bulk imports (COPY of a whole batch) get longer
+DB_BULK_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_BULK_STATEMENT_TIMEOUT_MS", "600000"))
 
+# defining the connection pool (its just like the thread pool ;)
+# it is opened on first use (or by open_pool() at startup) and connects in the background, so starting the api
+# doesn't wait for postgres.
+conn_pool: AsyncConnectionPool = None
+_pool_lock = asyncio.Lock()
+# event loop the pool lives on, for run_sync()
+_loop = None
+# set once the pool managed to open a connection
+_connected = False
+
+async def _on_connect(conn):
+    global _connected
+    _connected = True
+
+async def open_pool() -> AsyncConnectionPool:
+    global conn_pool, _loop
+    if conn_pool is None:
+        async with _pool_lock:
+            if conn_pool is None:
+                pool = AsyncConnectionPool(
+                    conninfo=psycopg.conninfo.make_conninfo(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER,
+                                                            password=DB_PASSWORD),
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    kwargs={"row_factory": dict_row, "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"},
+                    configure=_on_connect,
+                    open=False,
+                    name="pathfinder",
+                )
+                await pool.open(wait=False)
+                _loop = asyncio.get_running_loop()
+                conn_pool = pool
+    return conn_pool
+
+async def close_pool():
+    global conn_pool, _loop
+    if conn_pool is not None:
+        await conn_pool.close()
+        conn_pool = _loop = None
+
+def is_ready() -> bool:
+    return conn_pool is not None and _connected
+
+def stats() -> dict:
+    return conn_pool.get_stats() if conn_pool is not None else {}
+
+def run_sync(coro, timeout: float = None):
+    # runs one of the functions below from a worker thread (e.g. the scorers' cache lookups) on the pool's loop.
+    # never call it from the event loop itself, it would wait on itself.
+    if _loop is None or _loop.is_closed():
+        coro.close()
+        raise RuntimeError("database pool is not open")
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result(timeout)
+
+async def createUser(user: User) -> bool:
     success = False
     try:
-        conn = conn_pool.getconn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("INSERT INTO users (id, name, reputation, created_at) VALUES (%s, %s, %s, %s);",
-                    (user.id, user.name, user.reputation, user.created_at))
-        conn.commit()
+        # the connection commits when the block exits without an error and rolls back otherwise
+        async with (await open_pool()).connection() as conn:
+            await conn.execute("INSERT INTO users (id, name, reputation, created_at) VALUES (%s, %s, %s, %s);",
+                               (user.id, user.name, user.reputation, user.created_at))
         success = True
-        # conn_pool.putconn(conn)
     except Exception as e:
-        print("Error: ", e)   
-        success = False 
-    finally:
-        if cur: 
-            cur.close()
-        if conn:
-            conn_pool.putconn(conn)
-        return success
+        print("Error: ", e)
+        success = False
+    return success
 
 # function to get a user from the database from its id
-def getUser(id: str) -> User:
+async def getUser(id: str) -> User:
     # user dataclass where we store all the attributes (columns from the table 'users') of the user
     user: User = User(id=None) # check if id=None to know if the user was found or the req was successful
 
-    cur = conn = None
     try:
-        conn = conn_pool.getconn()
-        cur = conn.cursor(cursor_factory=RealDictCursor) # RealDictCursor is just to get the results from the db in python dictionary
-        cur.execute("SELECT * FROM users WHERE id = %s;",
-                    (id,))
-        rows = cur.fetchall() # only single row will be fetched 
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute("SELECT * FROM users WHERE id = %s;", (id,), prepare=True)
+            row = await cur.fetchone() # only single row will be fetched
 
-        for row in rows:
+        if row is not None:
             user.id = row['id']
             user.name = row['name']
             user.reputation = row['reputation']
             user.created_at = row['created_at']
     except Exception as e: # in case any error occurs
-        print("Error: ", e)    
-    finally:
-        # return the 'user', if any error happened, id=None will be the flag.
-        return asdict(user)
-    
-def searchForUser(username: str) -> List[User]:
-    cur = conn = None
-    users = []
-    try:
-        conn = conn_pool.getconn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        print("Error: ", e)
+    # return the 'user', if any error happened, id=None will be the flag.
+    return asdict(user)
+
+# user search: word similarity over a trigram (gist) index, best matches first and the higher reputation first among
+# equally good ones. the index returns rows already in that order (knn), so a page costs the same whatever the size
+# of the table. queries shorter than 3 characters have no useful trigrams and are a prefix match on the lower cased
+# name instead, in name order so that it is read straight off the (C collation) btree index as well.
+# pages are keyset paginated: `cursor` is the opaque next_cursor of the previous page.
+USER_SEARCH_MAX_LIMIT = 100
+USER_COLUMNS = "id, name, reputation, created_at"
 
-        # return all the users having their username ilike (case-insensitive) given username 
-        cur.execute("""SELECT * FROM users WHERE name ILIKE %s""", ('%'+username+'%',))
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
 
-        rows = cur.fetchall()
+class InvalidCursor(Exception):
+    pass
+
+def _decode_cursor(cursor: str, types: tuple) -> list:
+    # the cursor comes from the client, anything that isn't the keys of a row of this kind of search is rejected
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidCursor("malformed cursor")
+    if (not isinstance(values, list) or len(values) != len(types)
+            or not all(isinstance(v, t) and not isinstance(v, bool) for v, t in zip(values, types))):
+        raise InvalidCursor("malformed cursor")
+    return values
+
+async def searchForUser(username: str, limit: int = 20, cursor: str = None) -> dict:
+    users = []
+    next_cursor = None
+    query = username.strip()
+    # raises InvalidCursor (a 400 for the client) instead of being swallowed below
+    after = _decode_cursor(cursor, ((float, int), int, str) if len(query) >= 3 else (str, str)) if cursor else None
+    if after and len(query) >= 3:
+        after[0] = float(after[0])
+    try:
+        limit = max(1, min(limit, USER_SEARCH_MAX_LIMIT))
+        async with (await open_pool()).connection() as conn:
+            if len(query) >= 3:
+                # <<-> is 1 - word_similarity, the distance the gist index orders by. it is a real, the cursor's copy
+                # comes back as a float8 and has to be cast back: compared as float8 the stored 0.4 (0.4000000059...)
+                # would sort after the cursor's 0.4 and the page would start with the rows it ended on
+                page = """(%(q)s <<-> name, -reputation, id) > (%(d)s::real, %(r)s, %(id)s)""" if after else "TRUE"
+                cur = await conn.execute(f"""SELECT {USER_COLUMNS}, %(q)s <<-> name AS distance FROM users
+                                         WHERE %(q)s <%% name AND {page}
+                                         ORDER BY %(q)s <<-> name, reputation DESC, id LIMIT %(limit)s;""",
+                                         {"q": query, "limit": limit + 1,
+                                          **(dict(zip(("d", "r", "id"), after)) if after else {})}, prepare=True)
+                rows = await cur.fetchall()
+                keys = [[row['distance'], -row['reputation'], row['id']] for row in rows]
+            else:
+                prefix = query.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                page = """(lower(name) COLLATE "C", id) > (%(n)s, %(id)s)""" if after else "TRUE"
+                cur = await conn.execute(f"""SELECT {USER_COLUMNS}, lower(name) AS name_key FROM users WHERE lower(name) COLLATE "C" LIKE %(prefix)s AND {page}
+                                         ORDER BY lower(name) COLLATE "C", id LIMIT %(limit)s;""",
+                                         {"prefix": prefix, "limit": limit + 1,
+                                          **(dict(zip(("n", "id"), after)) if after else {})}, prepare=True)
+                rows = await cur.fetchall()
+                keys = [[row['name_key'], row['id']] for row in rows]
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor(keys[limit - 1])
 
         for row in rows:
             user = User(id=row['id'],
@@ -100,165 +199,509 @@ def searchForUser(username: str) -> List[User]:
                         reputation=row['reputation'],
                         created_at=row['created_at'])
             users.append(asdict(user))
-        
+
     except Exception as e:
         print("Error: ", e)
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn_pool.putconn(conn)
-        return users
-    
-# maybe we dont need this database method
-
-# def getUsers() -> List[User]:
-#     users: List[User] = []
-#     cur = conn = None
-#     try:
-#         conn = conn_pool.getconn()
-#         cur = conn.cursor(cursor_factory=RealDictCursor)
-
-#         cur.execute("SELECT * FROM users;")
-#         rows = cur.fetchall()
-
-#         for row in rows:
-#             user = User(id=row['id'],
-#                         name=row['name'],
-#                         reputation=row['reputation'],
-#                         created_at=row['created_at'])
-            
-#             users.append(user)
-#     except Exception as e:
-#         print("Error: ", e)
-#     finally:
-#         if cur:
-#             cur.close()
-#         if conn:
-#             conn_pool.putconn(conn)
-#         return users
-    
-def addPost(location: Location) -> bool:
-    cur = conn = None 
+    return {"users": users, "next_cursor": next_cursor}
+
+# the whole write is one statement (one round trip, one transaction): the location row is created or its post count
+# bumped, the post inserted and the score sums upserted together, so a failure can't leave the counters half updated.
+ADD_POST_SQL = """
+WITH loc AS (
+    INSERT INTO location (id, posts, lat, lng, updated_at) VALUES (%(location_id)s, 1, %(latitude)s, %(longitude)s, now())
+    ON CONFLICT (id) DO UPDATE SET posts = location.posts + 1, updated_at = now(),
+    lat = COALESCE(location.lat, EXCLUDED.lat), lng = COALESCE(location.lng, EXCLUDED.lng)
+    RETURNING id
+), post AS (
+    INSERT INTO posts (posted_by, location_id, images_dir, images, text_descr, surface_damage, traffic_safety_risk,
+    ride_discomfort, waterlogging, urgency_for_repair, scored_by, created_at)
+    SELECT %(posted_by)s, loc.id, %(images_dir)s, %(images)s, %(text_descr)s, %(surface_damage)s, %(traffic_safety_risk)s,
+    %(ride_discomfort)s, %(waterlogging)s, %(urgency_for_repair)s, %(scored_by)s, %(created_at)s FROM loc
+    RETURNING id
+), scores AS (
+    INSERT INTO location_scores (location_id, surface_damage, traffic_safety_risk, ride_discomfort, waterlogging, urgency_for_repair)
+    SELECT loc.id, %(surface_damage)s, %(traffic_safety_risk)s, %(ride_discomfort)s, %(waterlogging)s, %(urgency_for_repair)s FROM loc
+    ON CONFLICT (location_id) DO UPDATE
+    SET surface_damage = location_scores.surface_damage + EXCLUDED.surface_damage,
+    traffic_safety_risk = location_scores.traffic_safety_risk + EXCLUDED.traffic_safety_risk,
+    ride_discomfort = location_scores.ride_discomfort + EXCLUDED.ride_discomfort,
+    waterlogging = location_scores.waterlogging + EXCLUDED.waterlogging,
+    urgency_for_repair = location_scores.urgency_for_repair + EXCLUDED.urgency_for_repair
+    RETURNING location_id
+), dirty AS (
+    -- the score tile pyramid picks the change up on its next refresh (tiles.py)
+    INSERT INTO location_dirty (location_id) SELECT id FROM loc ON CONFLICT DO NOTHING
+)
+SELECT (SELECT id FROM post) AS post_id;
+"""
+
+async def addPost(location: Location) -> bool:
     success = False
     try:
-        id = location.location_id
-
-        conn = conn_pool.getconn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        cur.execute("SELECT 1 FROM location WHERE id = %s;", (id,))
-        exists = cur.fetchone() is not None
-        if not exists:
-                cur.execute("INSERT INTO location (id, posts) VALUES (%s, 0);", (location.location_id,))
-                conn.commit()
-
-        # insert the new post into the post table.
-        cur.execute("""INSERT INTO posts (posted_by, location_id, images_dir, images, text_descr, surface_damage,
-        traffic_safety_risk, ride_discomfort, waterlogging, urgency_for_repair, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);""", 
-        (location.posted_by, location.location_id, location.images_dir, location.images, location.text_descr, location.surface_damage,
-        location.traffic_safety_risk, location.ride_discomfort, location.waterlogging, location.urgency_for_repair, location.created_at))
-
-        conn.commit()
-
-
-        # Upsert (Insert/Update(if already present))
-        cur.execute("""INSERT INTO location_scores (location_id, surface_damage, traffic_safety_risk, ride_discomfort, waterlogging,
-                    urgency_for_repair) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (location_id) DO UPDATE
-                    SET surface_damage = location_scores.surface_damage + EXCLUDED.surface_damage,
-                    traffic_safety_risk = location_scores.traffic_safety_risk + EXCLUDED.traffic_safety_risk,
-                    ride_discomfort = location_scores.ride_discomfort + EXCLUDED.ride_discomfort,
-                    waterlogging = location_scores.waterlogging + EXCLUDED.waterlogging,
-                    urgency_for_repair = location_scores.urgency_for_repair + EXCLUDED.urgency_for_repair;""", (location.location_id, location.surface_damage, location.traffic_safety_risk,
-                                                                        location.ride_discomfort, location.waterlogging, 
-                                                                        location.urgency_for_repair))
-        
-        conn.commit()
-
-        cur.execute("UPDATE location SET posts = posts + 1 WHERE id = %s;", (location.location_id,))
-        conn.commit()
+        async with (await open_pool()).connection() as conn:
+            await conn.execute(ADD_POST_SQL, asdict(location), prepare=True)
+        success = True
+    except Exception as e:
+        print("Error: ", e)
+        success = False
+    return success
+
+LOCATION_SQL = """SELECT s.location_id, s.surface_damage, s.traffic_safety_risk, s.ride_discomfort, s.waterlogging,
+s.urgency_for_repair, l.posts
+FROM location_scores s JOIN location l ON l.id = s.location_id
+WHERE s.location_id = ANY(%s) AND l.posts > 0;"""
+
+async def getLocation(id: str) -> Location:
+    # if req fails or any untoward situation, location_id set to 'None' will be returned which
+    # can be checked for to know if the request went successful.
+    location = asdict(Location(location_id=None))
+
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute(LOCATION_SQL, ([id],), prepare=True)
+            row = await cur.fetchone()
+
+        if row is not None:
+            location = _location_from_row(row)
+    except Exception as e:
+        print("Error: ", e)
+    return location
+
+# ids per query of the bulk lookups, keeps the id array (and the result set held in memory) bounded for huge routes
+LOCATIONS_CHUNK_SIZE = int(os.getenv("LOCATIONS_CHUNK_SIZE", "1000"))
+
+def _location_from_row(row) -> dict:
+    n = row['posts']
+    return asdict(Location(location_id=row['location_id'], surface_damage=row['surface_damage']/n, traffic_safety_risk=
+                           row['traffic_safety_risk']/n, ride_discomfort=row['ride_discomfort']/n, waterlogging=row['waterlogging']/n,
+                           urgency_for_repair=row['urgency_for_repair']/n))
+
+async def iterLocations(ids: List[str], chunk_size: int = LOCATIONS_CHUNK_SIZE):
+    # yields the found locations chunk by chunk, one joined query per chunk on a single connection.
+    # locations come out in the order of `ids`, unknown ids (and locations without posts) are skipped.
+    async with (await open_pool()).connection() as conn:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            cur = await conn.execute(LOCATION_SQL, (list(set(chunk)),), prepare=True)
+            found = {row['location_id']: row for row in await cur.fetchall()}
+            yield [_location_from_row(found[loc_id]) for loc_id in chunk if loc_id in found]
+
+async def getLocations(id: List[str]) -> List[dict]:
+    locations_list = []
+    try:
+        async for chunk in iterLocations(id):
+            locations_list.extend(chunk)
+    except Exception as e:
+        print("Error: ", e)
+    return locations_list
+
+# generation counters of cached data (cache_generation table): a process that changes a lot of the data at once bumps
+# it, every api worker polls it and drops its in-process copies when it moved (see location_cache.py). these and the
+# invalidation log below raise on error.
+async def bumpCacheGeneration(name: str) -> int:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("""INSERT INTO cache_generation (name, generation) VALUES (%s, 1)
+                                 ON CONFLICT (name) DO UPDATE SET generation = cache_generation.generation + 1
+                                 RETURNING generation;""", (name,), prepare=True)
+        return (await cur.fetchone())['generation']
+
+async def getCacheGeneration(name: str) -> int:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("SELECT generation FROM cache_generation WHERE name = %s;", (name,), prepare=True)
+        row = await cur.fetchone()
+        return row['generation'] if row is not None else 0
+
+# small invalidations are logged per key instead (cache_invalidation), so the workers drop only those entries.
+# returns [{"id", "created_at"}] of the new log rows
+async def logCacheInvalidations(name: str, keys: List[str]) -> List[dict]:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("""INSERT INTO cache_invalidation (name, key) SELECT %s, unnest(%s::text[])
+                                 RETURNING id, created_at;""", (name, keys), prepare=True)
+        return await cur.fetchall()
+
+# -> {"generation", "now" (database time), "keys": [{"id", "key", "created_at"}]}: the generation counter and the
+# keys logged since `since` minus `overlap_seconds` (none when `since` is None). a log row is written with the time its
+# transaction started, it can commit a little after a reader passed that time, so readers ask again for a window
+# before it and skip the ids they already applied.
+async def getCacheInvalidations(name: str, since, overlap_seconds: float) -> dict:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("""SELECT now()::timestamp AS now,
+                                 (SELECT generation FROM cache_generation WHERE name = %s) AS generation;""", (name,), prepare=True)
+        head = await cur.fetchone()
+        keys = []
+        if since is not None:
+            cur = await conn.execute("""SELECT id, key, created_at FROM cache_invalidation
+                                     WHERE name = %s AND created_at > %s::timestamp - make_interval(secs => %s) ORDER BY id;""",
+                                     (name, since, overlap_seconds), prepare=True)
+            keys = await cur.fetchall()
+        return {"generation": head['generation'] or 0, "now": head['now'], "keys": keys}
+
+async def pruneCacheInvalidations(retention_seconds: float) -> int:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("DELETE FROM cache_invalidation WHERE created_at < now() - make_interval(secs => %s);",
+                                 (retention_seconds,), prepare=True)
+        return cur.rowcount
+
+# ---- bulk ingestion of historical / partner reports (see bulk_ingest.py) ----
+
+BULK_POST_COLUMNS = ["location_id", "lat", "lng", "posted_by", "text_descr", "surface_damage", "traffic_safety_risk",
+                     "ride_discomfort", "waterlogging", "urgency_for_repair", "scored_by", "created_at"]
+
+# rows are COPYed into a temporary staging table and everything else is a handful of set-wise statements,
+# so the cost per row is the COPY parsing, not a round trip. all in one transaction: a batch goes in whole or not at all.
+BULK_POST_SQL = [
+    """CREATE TEMP TABLE post_staging (location_id TEXT, lat DOUBLE PRECISION, lng DOUBLE PRECISION, posted_by TEXT,
+    text_descr TEXT, surface_damage SMALLINT, traffic_safety_risk SMALLINT, ride_discomfort SMALLINT, waterlogging SMALLINT,
+    urgency_for_repair SMALLINT, scored_by TEXT, created_at TIMESTAMP) ON COMMIT DROP;""",
+    # COPY goes here
+    """INSERT INTO location (id, posts, lat, lng, updated_at)
+    SELECT location_id, count(*), (array_agg(lat ORDER BY created_at))[1], (array_agg(lng ORDER BY created_at))[1], now()
+    FROM post_staging GROUP BY location_id
+    ON CONFLICT (id) DO UPDATE SET posts = location.posts + EXCLUDED.posts, updated_at = now(),
+    lat = COALESCE(location.lat, EXCLUDED.lat), lng = COALESCE(location.lng, EXCLUDED.lng);""",
+    """INSERT INTO posts (posted_by, location_id, images, text_descr, surface_damage, traffic_safety_risk, ride_discomfort,
+    waterlogging, urgency_for_repair, scored_by, created_at)
+    SELECT posted_by, location_id, 0, text_descr, surface_damage, traffic_safety_risk, ride_discomfort, waterlogging,
+    urgency_for_repair, scored_by, created_at FROM post_staging;""",
+    """INSERT INTO location_scores (location_id, surface_damage, traffic_safety_risk, ride_discomfort, waterlogging, urgency_for_repair)
+    SELECT location_id, sum(surface_damage), sum(traffic_safety_risk), sum(ride_discomfort), sum(waterlogging), sum(urgency_for_repair)
+    FROM post_staging GROUP BY location_id
+    ON CONFLICT (location_id) DO UPDATE
+    SET surface_damage = location_scores.surface_damage + EXCLUDED.surface_damage,
+    traffic_safety_risk = location_scores.traffic_safety_risk + EXCLUDED.traffic_safety_risk,
+    ride_discomfort = location_scores.ride_discomfort + EXCLUDED.ride_discomfort,
+    waterlogging = location_scores.waterlogging + EXCLUDED.waterlogging,
+    urgency_for_repair = location_scores.urgency_for_repair + EXCLUDED.urgency_for_repair;""",
+    """INSERT INTO location_dirty (location_id) SELECT DISTINCT location_id FROM post_staging ON CONFLICT DO NOTHING;""",
+]
+
+# `rows` are lists of values in BULK_POST_COLUMNS order, returns how many posts were added
+async def bulkAddPosts(rows: List[list]) -> int:
+    count = 0
+    try:
+        async with (await open_pool()).connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(f"SET LOCAL statement_timeout = {DB_BULK_STATEMENT_TIMEOUT_MS};")
+                await cur.execute(BULK_POST_SQL[0])
+                async with cur.copy(f"COPY post_staging ({', '.join(BULK_POST_COLUMNS)}) FROM STDIN") as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+                count = len(rows)
+                for statement in BULK_POST_SQL[1:]:
+                    await cur.execute(statement)
+    except Exception as e:
+        print("Error: ", e)
+        count = 0
+    return count
+
+# ---- viewport queries and the score tile pyramid (see tiles.py) ----
+
+LOCATION_SCORE_COLUMNS = """s.surface_damage / l.posts AS surface_damage, s.traffic_safety_risk / l.posts AS traffic_safety_risk,
+s.ride_discomfort / l.posts AS ride_discomfort, s.waterlogging / l.posts AS waterlogging,
+s.urgency_for_repair / l.posts AS urgency_for_repair"""
+
+# scored locations inside the box, through the gist index on point(lng, lat)
+async def getLocationsInBox(min_lat: float, min_lng: float, max_lat: float, max_lng: float, limit: int) -> List[dict]:
+    rows = []
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute(f"""SELECT l.id AS location_id, l.lat, l.lng, l.posts, {LOCATION_SCORE_COLUMNS}
+                                     FROM location l JOIN location_scores s ON s.location_id = l.id
+                                     WHERE point(l.lng, l.lat) <@ box(point(%s, %s), point(%s, %s)) AND l.lat IS NOT NULL
+                                     AND l.posts > 0 LIMIT %s;""", (min_lng, min_lat, max_lng, max_lat, limit), prepare=True)
+            rows = await cur.fetchall()
+    except Exception as e:
+        print("Error: ", e)
+    return rows
+
+TILE_COLUMNS = """x, y, locations, posts, sum_lat, sum_lng, surface_damage, traffic_safety_risk, ride_discomfort,
+waterlogging, urgency_for_repair, version"""
+
+# tiles of zoom z in the x / y ranges (inclusive), a primary key range scan
+async def getScoreTiles(z: int, min_x: int, max_x: int, min_y: int, max_y: int) -> List[dict]:
+    rows = []
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute(f"""SELECT {TILE_COLUMNS} FROM score_tiles
+                                     WHERE z = %s AND x BETWEEN %s AND %s AND y BETWEEN %s AND %s AND locations > 0;""",
+                                     (z, min_x, max_x, min_y, max_y), prepare=True)
+            rows = await cur.fetchall()
+    except Exception as e:
+        print("Error: ", e)
+    return rows
+
+TILE_SUMS = """locations, posts, sum_lat, sum_lng, surface_damage, traffic_safety_risk, ride_discomfort, waterlogging,
+urgency_for_repair"""
+TILE_UPSERT = """ON CONFLICT (z, x, y) DO UPDATE SET locations = EXCLUDED.locations, posts = EXCLUDED.posts,
+sum_lat = EXCLUDED.sum_lat, sum_lng = EXCLUDED.sum_lng, surface_damage = EXCLUDED.surface_damage,
+traffic_safety_risk = EXCLUDED.traffic_safety_risk, ride_discomfort = EXCLUDED.ride_discomfort,
+waterlogging = EXCLUDED.waterlogging, urgency_for_repair = EXCLUDED.urgency_for_repair,
+version = EXCLUDED.version, updated_at = now();"""
+
+# recomputes the tiles of (up to `batch`) dirty locations: the max_zoom tiles from the locations in them, then every
+# level above from its 4 children, so each level is one indexed statement whatever the number of locations.
+# returns how many dirty locations were handled (0 when another worker is refreshing right now).
+async def refreshScoreTiles(min_zoom: int, max_zoom: int, batch: int) -> int:
+    count = 0
+    try:
+        async with (await open_pool()).connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(f"SET LOCAL statement_timeout = {DB_BULK_STATEMENT_TIMEOUT_MS};")
+                await cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('score_tiles')) AS locked;")
+                if not (await cur.fetchone())['locked']:
+                    return 0
+                await cur.execute("CREATE TEMP TABLE dirty_tiles (x INT, y INT) ON COMMIT DROP;")
+                await cur.execute("""WITH d AS (
+                                    DELETE FROM location_dirty WHERE location_id IN (SELECT location_id FROM location_dirty LIMIT %(batch)s)
+                                    RETURNING location_id
+                                  ), t AS (
+                                    INSERT INTO dirty_tiles SELECT DISTINCT tile_x(l.lng, %(z)s), tile_y(l.lat, %(z)s)
+                                    FROM d JOIN location l ON l.id = d.location_id WHERE l.lat IS NOT NULL AND l.lng IS NOT NULL
+                                  )
+                                  SELECT count(*) AS n FROM d;""", {"batch": batch, "z": max_zoom})
+                count = (await cur.fetchone())['n']
+                if count == 0:
+                    return 0
+                await cur.execute(f"""INSERT INTO score_tiles (z, x, y, {TILE_SUMS}, version)
+                                  SELECT %(z)s, t.x, t.y, count(*), sum(l.posts), sum(l.lat), sum(l.lng),
+                                  sum(s.surface_damage / l.posts), sum(s.traffic_safety_risk / l.posts), sum(s.ride_discomfort / l.posts),
+                                  sum(s.waterlogging / l.posts), sum(s.urgency_for_repair / l.posts), nextval('score_tiles_version_seq')
+                                  FROM (SELECT DISTINCT x, y FROM dirty_tiles) t
+                                  JOIN location l ON point(l.lng, l.lat) <@ box(point(tile_lng(t.x, %(z)s), tile_lat(t.y + 1, %(z)s)),
+                                                                               point(tile_lng(t.x + 1, %(z)s), tile_lat(t.y, %(z)s)))
+                                  AND l.lat IS NOT NULL AND tile_x(l.lng, %(z)s) = t.x AND tile_y(l.lat, %(z)s) = t.y AND l.posts > 0
+                                  JOIN location_scores s ON s.location_id = l.id
+                                  GROUP BY t.x, t.y {TILE_UPSERT}""", {"z": max_zoom})
+                for z in range(max_zoom - 1, min_zoom - 1, -1):
+                    await cur.execute("UPDATE dirty_tiles SET x = x / 2, y = y / 2;")
+                    await cur.execute(f"""INSERT INTO score_tiles (z, x, y, {TILE_SUMS}, version)
+                                      SELECT %(z)s, p.x, p.y, sum(c.locations), sum(c.posts), sum(c.sum_lat), sum(c.sum_lng),
+                                      sum(c.surface_damage), sum(c.traffic_safety_risk), sum(c.ride_discomfort), sum(c.waterlogging),
+                                      sum(c.urgency_for_repair), nextval('score_tiles_version_seq')
+                                      FROM (SELECT DISTINCT x, y FROM dirty_tiles) p
+                                      JOIN score_tiles c ON c.z = %(z)s + 1 AND c.x IN (2 * p.x, 2 * p.x + 1) AND c.y IN (2 * p.y, 2 * p.y + 1)
+                                      GROUP BY p.x, p.y {TILE_UPSERT}""", {"z": z})
+    except Exception as e:
+        print("Error: ", e)
+        count = 0
+    return count
 
+async def markAllLocationsDirty() -> bool:
+    success = False
+    try:
+        async with (await open_pool()).connection() as conn:
+            await conn.execute("""INSERT INTO location_dirty (location_id) SELECT id FROM location WHERE posts > 0
+                               ON CONFLICT DO NOTHING;""")
+        success = True
+    except Exception as e:
+        print("Error: ", e)
+        success = False
+    return success
+
+# ---- re-scoring stored posts (see backfill.py) ----
+# unlike the request path these raise: the backfill stops and is resumed from its checkpoint.
+
+async def getMaxPostId() -> int:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("SELECT coalesce(max(id), 0) AS id FROM posts;")
+        return (await cur.fetchone())['id']
+
+# keyset pagination over the primary key, every chunk is an index range scan however far in we are
+async def getPostsAfter(after_id: int, until_id: int, limit: int) -> List[dict]:
+    async with (await open_pool()).connection() as conn:
+        cur = await conn.execute("""SELECT id, images_dir, images, text_descr, scored_by, surface_damage,
+                                 traffic_safety_risk, ride_discomfort, waterlogging, urgency_for_repair FROM posts
+                                 WHERE id > %s AND id <= %s ORDER BY id LIMIT %s;""", (after_id, until_id, limit), prepare=True)
+        return await cur.fetchall()
+
+POST_SCORE_COLUMNS = ["id", "surface_damage", "traffic_safety_risk", "ride_discomfort", "waterlogging", "urgency_for_repair", "scored_by"]
+
+# `rows` are lists of values in POST_SCORE_COLUMNS order. COPY into a staging table + one UPDATE ... FROM.
+# returns (posts updated, the ids of their locations) -> recomputeLocationScores
+async def updatePostScores(rows: List[list]):
+    async with (await open_pool()).connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"SET LOCAL statement_timeout = {DB_BULK_STATEMENT_TIMEOUT_MS};")
+            await cur.execute("""CREATE TEMP TABLE post_score_staging (id BIGINT, surface_damage FLOAT, traffic_safety_risk FLOAT,
+                              ride_discomfort FLOAT, waterlogging FLOAT, urgency_for_repair FLOAT, scored_by TEXT) ON COMMIT DROP;""")
+            async with cur.copy(f"COPY post_score_staging ({', '.join(POST_SCORE_COLUMNS)}) FROM STDIN") as copy:
+                for row in rows:
+                    await copy.write_row(row)
+            await cur.execute("""UPDATE posts p SET surface_damage = round(s.surface_damage),
+                              traffic_safety_risk = round(s.traffic_safety_risk), ride_discomfort = round(s.ride_discomfort),
+                              waterlogging = round(s.waterlogging), urgency_for_repair = round(s.urgency_for_repair), scored_by = s.scored_by
+                              FROM post_score_staging s WHERE p.id = s.id RETURNING p.location_id;""")
+            updated = await cur.fetchall()
+            return len(updated), sorted({row['location_id'] for row in updated if row['location_id'] is not None})
+
+# location_scores holds the sums of the posts' scores. after posts were re-scored the sums of their locations are
+# recomputed from posts, in batches of RECOMPUTE_BATCH_SIZE locations; only locations whose sums moved are written,
+# bumped (updated_at, for location_index.py) and marked dirty (for the tile pyramid).
+RECOMPUTE_BATCH_SIZE = int(os.getenv("RECOMPUTE_BATCH_SIZE", "500"))
+RECOMPUTE_LOCATION_SCORES_SQL = """
+WITH sums AS (
+    SELECT location_id, sum(surface_damage)::float AS surface_damage, sum(traffic_safety_risk)::float AS traffic_safety_risk,
+    sum(ride_discomfort)::float AS ride_discomfort, sum(waterlogging)::float AS waterlogging,
+    sum(urgency_for_repair)::float AS urgency_for_repair
+    FROM posts WHERE location_id = ANY(%(ids)s) GROUP BY location_id
+), changed AS (
+    UPDATE location_scores s SET surface_damage = n.surface_damage, traffic_safety_risk = n.traffic_safety_risk,
+    ride_discomfort = n.ride_discomfort, waterlogging = n.waterlogging, urgency_for_repair = n.urgency_for_repair
+    FROM sums n
+    WHERE s.location_id = n.location_id AND (s.surface_damage, s.traffic_safety_risk, s.ride_discomfort, s.waterlogging,
+    s.urgency_for_repair) IS DISTINCT FROM (n.surface_damage, n.traffic_safety_risk, n.ride_discomfort, n.waterlogging,
+    n.urgency_for_repair)
+    RETURNING s.location_id
+), touched AS (
+    UPDATE location SET updated_at = now() WHERE id IN (SELECT location_id FROM changed) RETURNING id
+), dirty AS (
+    INSERT INTO location_dirty (location_id) SELECT id FROM touched ON CONFLICT DO NOTHING
+)
+SELECT id FROM touched;
+"""
+
+# -> ids of the locations whose sums changed
+async def recomputeLocationScores(location_ids: List[str]) -> List[str]:
+    changed = []
+    location_ids = sorted(set(location_ids))
+    for i in range(0, len(location_ids), RECOMPUTE_BATCH_SIZE):
+        batch = location_ids[i:i + RECOMPUTE_BATCH_SIZE]
+        async with (await open_pool()).connection() as conn:
+            # a post committed after the sums were read would be overwritten with the old sum, so the batch's rows
+            # are locked first, in statements of their own: the recompute's snapshot then has every post that got
+            # in before, and new posts for these locations wait for this (short) transaction only. location before
+            # location_scores, the order addPost / bulkAddPosts take them in, so they can't deadlock with it.
+            await conn.execute("SELECT id FROM location WHERE id = ANY(%s) ORDER BY id FOR UPDATE;", (batch,))
+            await conn.execute("SELECT location_id FROM location_scores WHERE location_id = ANY(%s) ORDER BY location_id FOR UPDATE;",
+                               (batch,))
+            cur = await conn.execute(RECOMPUTE_LOCATION_SCORES_SQL, {"ids": batch})
+            changed += [row['id'] for row in await cur.fetchall()]
+    return changed
+
+# ---- scoring jobs (see jobs.py) ----
+
+JOB_COLUMNS = """id, status, stage, text_descr, latitude, longitude, images_dir, mime_types, result, error, attempts,
+created_at, updated_at"""
+
+async def createJob(job_id: str, text_descr: str, latitude: str, longitude: str, images_dir: str, mime_types: List[str]) -> bool:
+    success = False
+    try:
+        async with (await open_pool()).connection() as conn:
+            await conn.execute("""INSERT INTO scoring_jobs (id, status, text_descr, latitude, longitude, images_dir, mime_types)
+                               VALUES (%s, 'queued', %s, %s, %s, %s, %s);""",
+                               (job_id, text_descr, latitude, longitude, images_dir, mime_types))
         success = True
     except Exception as e:
         print("Error: ", e)
         success = False
+    return success
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn_pool.putconn(conn)
+async def _claim(query: str, params: tuple) -> dict:
+    job = None
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute(query, params, prepare=True)
+            job = await cur.fetchone()
+    except Exception as e:
+        print("Error: ", e)
+    return dict(job) if job is not None else None
 
-        return success
+# marks a queued job as running and returns it, None if some other worker already took it
+async def claimJob(job_id: str) -> dict:
+    return await _claim(f"""UPDATE scoring_jobs SET status = 'running', attempts = attempts + 1, updated_at = now()
+                        WHERE id = %s AND status = 'queued' RETURNING {JOB_COLUMNS};""", (job_id,))
 
-def getLocation(id: str) -> Location:
-    # if req fails or any untoward situation, location_id set to 'None' will be returned 'finally' which 
-    # can be checked for to know if the request went successful.
-    location: Location = Location(location_id=None)
-    cur = conn = None
+# same, but takes the oldest queued job (SKIP LOCKED so several workers can poll the table at once)
+async def claimNextJob(max_attempts: int) -> dict:
+    return await _claim(f"""UPDATE scoring_jobs SET status = 'running', attempts = attempts + 1, updated_at = now()
+                        WHERE id = (SELECT id FROM scoring_jobs WHERE status = 'queued' AND attempts < %s
+                                    ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED)
+                        RETURNING {JOB_COLUMNS};""", (max_attempts,))
 
+async def updateJob(job_id: str, status: str = None, stage: str = None, result: dict = None, error: str = None) -> bool:
+    success = False
     try:
-        conn = conn_pool.getconn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        async with (await open_pool()).connection() as conn:
+            await conn.execute("""UPDATE scoring_jobs SET status = COALESCE(%s, status), stage = COALESCE(%s, stage),
+                               result = COALESCE(%s, result), error = COALESCE(%s, error), updated_at = now() WHERE id = %s;""",
+                               (status, stage, Jsonb(result) if result is not None else None, error, job_id), prepare=True)
+        success = True
+    except Exception as e:
+        print("Error: ", e)
+        success = False
+    return success
 
-        cur.execute("SELECT * FROM location_scores WHERE location_id = %s;", (id,))
-        row = cur.fetchone()
+async def getJob(job_id: str) -> dict:
+    job = None
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute("""SELECT id, status, stage, result, error, attempts, created_at, updated_at
+                                     FROM scoring_jobs WHERE id = %s;""", (job_id,), prepare=True)
+            job = await cur.fetchone()
+    except Exception as e:
+        print("Error: ", e)
+    return dict(job) if job is not None else None
 
-        exists = row is not None
+# jobs stuck in 'running' (their worker died) go back to 'queued', or to 'failed' when they have used up their
+# attempts (claimNextJob would never take them again). returns how many
+async def requeueStaleJobs(stale_seconds: int, max_attempts: int) -> int:
+    count = 0
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute("""UPDATE scoring_jobs SET status = CASE WHEN attempts >= %(max)s THEN 'failed' ELSE 'queued' END,
+                                     error = CASE WHEN attempts >= %(max)s THEN 'the worker stopped while scoring it, out of attempts'
+                                     ELSE error END, updated_at = now()
+                                     WHERE status = 'running' AND updated_at < now() - make_interval(secs => %(stale)s);""",
+                                     {"max": max_attempts, "stale": stale_seconds})
+            count = cur.rowcount
+    except Exception as e:
+        print("Error: ", e)
+    return count
 
-        if exists:
-            cur.execute("SELECT posts FROM location WHERE id = %s;", (id,))
 
-            n = cur.fetchone()['posts']
+# ---- shared scoring cache (see score_cache.py) ----
 
-            if (n != 0):
-                location = Location(location_id=row['location_id'], surface_damage=row['surface_damage']/n, traffic_safety_risk=
-                                    row['traffic_safety_risk']/n, ride_discomfort=row['ride_discomfort']/n, waterlogging=row['waterlogging']/n,
-                                    urgency_for_repair=row['urgency_for_repair']/n)
+async def getCachedScore(key: str):
+    value = None
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute("SELECT value FROM score_cache WHERE key = %s;", (key,), prepare=True)
+            row = await cur.fetchone()
+        if row is not None:
+            value = row['value']
     except Exception as e:
         print("Error: ", e)
+    return value
 
-    finally:
-        if cur:
-            cur.close()
+async def setCachedScore(key: str, value) -> bool:
+    success = False
+    try:
+        async with (await open_pool()).connection() as conn:
+            await conn.execute("""INSERT INTO score_cache (key, value) VALUES (%s, %s)
+                               ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, created_at = now();""",
+                               (key, Jsonb(value)), prepare=True)
+        success = True
+    except Exception as e:
+        print("Error: ", e)
+        success = False
+    return success
 
-        if conn:
-            conn_pool.putconn(conn)
-        return asdict(location)
 
-def getLocations(id: List[str]) -> List[dict]:
-    locations_list = []
-    cur = conn = None
-    for loc_id in id:
-        location: Location = Location(location_id=None)
-        try:
-            conn = conn_pool.getconn()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-
-            cur.execute("SELECT * FROM location_scores WHERE location_id = %s;", (loc_id,))
-            row = cur.fetchone() 
-
-            if row is not None:
-                cur.execute("SELECT posts FROM location WHERE id = %s;", (loc_id,))
-                n = cur.fetchone()['posts']
-
-                if n != 0:
-                    location = Location(location_id=row['location_id'], surface_damage=row['surface_damage']/n, traffic_safety_risk=
-                                        row['traffic_safety_risk']/n, ride_discomfort=row['ride_discomfort']/n, waterlogging=row['waterlogging']/n,
-                                        urgency_for_repair=row['urgency_for_repair']/n)
-                                    
-        except Exception as e:
-            print("Error: ", e)
-
-        finally:
-            if cur:
-                cur.close()
-
-            if conn:
-                conn_pool.putconn(conn)
-
-            if location.location_id is not None:
-                locations_list.append(asdict(location))
-            
-    return locations_list
\ No newline at end of file
+# scored locations that have coordinates and changed after `since` (all of them when since is None),
+# with the averaged scores. used to keep the in-memory location index (location_index.py) up to date.
+async def getScoredLocationsSince(since) -> List[dict]:
+    rows = []
+    try:
+        async with (await open_pool()).connection() as conn:
+            cur = await conn.execute("""SELECT l.id AS location_id, l.lat, l.lng, l.updated_at,
+                                     s.surface_damage / l.posts AS surface_damage, s.traffic_safety_risk / l.posts AS traffic_safety_risk,
+                                     s.ride_discomfort / l.posts AS ride_discomfort, s.waterlogging / l.posts AS waterlogging,
+                                     s.urgency_for_repair / l.posts AS urgency_for_repair
+                                     FROM location l JOIN location_scores s ON s.location_id = l.id
+                                     WHERE l.posts > 0 AND l.lat IS NOT NULL AND l.lng IS NOT NULL
+                                     AND (%s::timestamp IS NULL OR l.updated_at > %s::timestamp)
+                                     ORDER BY l.updated_at;""", (since, since))
+            rows = await cur.fetchall()
+    except Exception as e:
+        print("Error: ", e)
+    return rows
@@ -0,0 +1,6 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+
+CREATE TABLE IF NOT EXISTS cache_generation (
+name TEXT PRIMARY KEY,
+generation BIGINT NOT NULL DEFAULT 0
+);
@@ -0,0 +1,5 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- location.posts was a SMALLINT, a bulk import of more than 32767 posts at one location overflowed it.
+-- rewrites the table, so run it when nothing is writing posts.
+
+ALTER TABLE location ALTER COLUMN posts TYPE INT;
@@ -0,0 +1,10 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+
+CREATE TABLE IF NOT EXISTS cache_invalidation (
+id BIGSERIAL PRIMARY KEY,
+name TEXT NOT NULL,
+key TEXT NOT NULL,
+created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS cache_invalidation_created_at_idx ON cache_invalidation (name, created_at);
@@ -0,0 +1,9 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- coordinates and change time of a location (location_index.py, the tile pyramid). existing locations get their
+-- coordinates from their next post.
+
+ALTER TABLE location ADD COLUMN IF NOT EXISTS lat DOUBLE PRECISION;
+ALTER TABLE location ADD COLUMN IF NOT EXISTS lng DOUBLE PRECISION;
+ALTER TABLE location ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS location_updated_at_idx ON location (updated_at);
@@ -0,0 +1,4 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- which scorers contributed to a post's scores (e.g. 'llm,vision'), unknown (NULL) for older posts
+
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS scored_by TEXT;
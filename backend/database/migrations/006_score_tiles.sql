@@ -0,0 +1,39 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- the score tile pyramid (tiles.py) and the viewport index of /locations/bbox. needs 004_location_coordinates.sql.
+-- the tiles start empty, fill them with: python tiles.py rebuild
+
+CREATE OR REPLACE FUNCTION tile_x(lng DOUBLE PRECISION, z INT) RETURNS INT AS
+$$ SELECT least(floor((lng + 180) / 360 * (1 << z)), (1 << z) - 1)::int $$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE OR REPLACE FUNCTION tile_y(lat DOUBLE PRECISION, z INT) RETURNS INT AS
+$$ SELECT least(greatest(floor((1 - ln(tan(radians(r)) + 1 / cos(radians(r))) / pi()) / 2 * (1 << z)), 0), (1 << z) - 1)::int
+   FROM (SELECT greatest(least(lat, 85.0511), -85.0511) AS r) c $$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE OR REPLACE FUNCTION tile_lng(x INT, z INT) RETURNS DOUBLE PRECISION AS
+$$ SELECT x::float8 / (1 << z) * 360 - 180 $$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE OR REPLACE FUNCTION tile_lat(y INT, z INT) RETURNS DOUBLE PRECISION AS
+$$ SELECT degrees(atan(sinh(pi() * (1 - 2 * y::float8 / (1 << z))))) $$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE INDEX IF NOT EXISTS location_point_idx ON location USING gist (point(lng, lat)) WHERE lat IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS location_dirty (
+location_id TEXT PRIMARY KEY
+);
+
+CREATE SEQUENCE IF NOT EXISTS score_tiles_version_seq;
+
+CREATE TABLE IF NOT EXISTS score_tiles (
+z SMALLINT,
+x INT,
+y INT,
+locations INT,
+posts INT,
+sum_lat DOUBLE PRECISION,
+sum_lng DOUBLE PRECISION,
+surface_damage FLOAT,
+traffic_safety_risk FLOAT,
+ride_discomfort FLOAT,
+waterlogging FLOAT,
+urgency_for_repair FLOAT,
+version BIGINT,
+updated_at TIMESTAMP DEFAULT now(),
+PRIMARY KEY (z, x, y)
+);
@@ -0,0 +1,20 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- background scoring jobs for /addPost?mode=job (jobs.py)
+
+CREATE TABLE IF NOT EXISTS scoring_jobs (
+id TEXT PRIMARY KEY,
+status TEXT NOT NULL DEFAULT 'queued',
+stage TEXT,
+text_descr TEXT,
+latitude TEXT,
+longitude TEXT,
+images_dir TEXT,
+mime_types TEXT[],
+result JSONB,
+error TEXT,
+attempts SMALLINT DEFAULT 0,
+created_at TIMESTAMP DEFAULT now(),
+updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS scoring_jobs_queued_idx ON scoring_jobs (created_at) WHERE status = 'queued';
@@ -0,0 +1,8 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- the persistent tier of score_cache.py (SCORE_CACHE_PERSIST=1)
+
+CREATE TABLE IF NOT EXISTS score_cache (
+key TEXT PRIMARY KEY,
+value JSONB NOT NULL,
+created_at TIMESTAMP DEFAULT now()
+);
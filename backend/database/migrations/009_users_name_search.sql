@@ -0,0 +1,7 @@
+-- for databases created from an older setup.sql. run it inside psql shell using: \i /path/to/this/file.sql
+-- user search (db.searchForUser). creating pg_trgm needs a role that may create extensions. on a big users table
+-- build the indexes with CREATE INDEX CONCURRENTLY instead (outside a transaction).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS users_name_trgm_idx ON users USING gist (name gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS users_name_prefix_idx ON users ((lower(name) COLLATE "C"), id);
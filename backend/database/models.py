@@ -22,5 +22,8 @@ class Location:
     waterlogging: float = 0
     urgency_for_repair: float = 0
     overall_score: float = 0
+    scored_by: str = "" # comma separated names of the scorers that contributed (llm, vision)
+    latitude: float = None
+    longitude: float = None
     posted_by: str = ""
     created_at: datetime.datetime = field(default_factory=datetime.datetime.now)
@@ -1,7 +1,11 @@
-import httpx
 import os
+import re
+import asyncio
 from dotenv import load_dotenv
 import polyline
+import http_client
+import road_graph
+from caching import LRUCache, SingleFlight
 
 load_dotenv() 
 
@@ -10,27 +14,74 @@ OSRM_URL = "https://router.project-osrm.org/route/v1/driving"
 GOOGLE_URL = "https://routes.googleapis.com/directions/v2:computeRoutes"
 GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 
+# "local" routes on our own road graph (road_graph.py, safety weighted) and only asks google when the graph isn't
+# loaded or the trip is outside it, "google" always asks google
+ROUTING_ENGINE = os.getenv("ROUTING_ENGINE", "google")
+# our profiles -> google travel modes
+TRAVEL_MODES = {"drive": "DRIVE", "cycle": "BICYCLE", "walk": "WALK"}
+
+
+# people look up the same few addresses (home, work, campus) over and over, so geocoding results are cached
+# by normalized address. addresses that don't resolve are cached for a shorter time.
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "10000"))
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", str(7 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv("GEOCODE_NEGATIVE_TTL", "300"))
+
+geocode_cache = LRUCache(GEOCODE_CACHE_SIZE, ttl=GEOCODE_CACHE_TTL, name="geocode")
+geocode_inflight = SingleFlight()
+
+def normalize_address(address: str) -> str:
+    # "  IIIT Allahabad,  Jhalwa " and "iiit allahabad, jhalwa" are the same lookup
+    address = re.sub(r"\s+", " ", address.strip().lower())
+    address = re.sub(r"\s*,\s*", ", ", address)
+    return address.strip(" ,.")
+
+async def _geocode_upstream(key: str, address: str):
+    response = await http_client.get(GEOCODE_URL,params={"address":address,"key":API_KEY})
+    data = response.json()
+    if data["status"] == "OK":
+        location = data["results"][0]["geometry"]["location"]
+        result = (location["lat"],location["lng"])
+        geocode_cache.set(key, result)
+        return result
+    if data["status"] == "ZERO_RESULTS":
+        geocode_cache.set(key, (None,None), ttl=GEOCODE_NEGATIVE_TTL)
+    # other statuses (quota, denied, ...) are not cached, the next request tries again
+    return None,None
 
 async def geocode_address(address: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(GEOCODE_URL,params={"address":address,"key":API_KEY})
-        data = response.json()
-        if data["status"] == "OK":
-            location = data["results"][0]["geometry"]["location"]
-            return location["lat"],location["lng"]
-        else:
-            return None,None
-
-async def get_route(origin: str, destination: str):
-    o_lat, o_lng = await geocode_address(origin)
-    d_lat, d_lng = await geocode_address(destination)
+    key = normalize_address(address)
+    cached = geocode_cache.get(key)
+    if cached is not None:
+        return cached
+    # identical lookups that are already in flight share one upstream call
+    return await geocode_inflight.do(key, lambda: _geocode_upstream(key, address))
+
+def geocode_stats() -> dict:
+    return {"cache": geocode_cache.stats(), "in_flight": geocode_inflight.stats()}
+
+def _local_route(o_lat, o_lng, d_lat, d_lng, profile: str, safety):
+    # read only: the penalties are updated by location_index.refresh_if_stale
+    if road_graph.get_graph() is None:
+        return None
+    return road_graph.route(o_lat, o_lng, d_lat, d_lng, profile, safety)
+
+async def get_route(origin: str, destination: str, profile: str = "drive", safety: float = None):
+    (o_lat, o_lng), (d_lat, d_lng) = await asyncio.gather(geocode_address(origin), geocode_address(destination))
     #will use the trafic data and live time returned later.
     if not o_lat or not d_lat:
         return []
+
+    if ROUTING_ENGINE == "local":
+        # the search is cpu bound, keep it off the event loop
+        points = await asyncio.to_thread(_local_route, float(o_lat), float(o_lng), float(d_lat), float(d_lng), profile, safety)
+        if points:
+            return points
+
     body = {
         "origin": {"location": {"latLng": {"latitude": float(o_lat), "longitude": float(o_lng)}}},
         "destination": {"location": {"latLng": {"latitude": float(d_lat), "longitude": float(d_lng)}}},
-        "travelMode": "DRIVE"
+        "travelMode": TRAVEL_MODES.get(profile, "DRIVE")
     }
 
     headers = {
@@ -39,9 +90,8 @@ async def get_route(origin: str, destination: str):
         "X-Goog-FieldMask": "routes.polyline.encodedPolyline"
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(GOOGLE_URL,headers=headers,json=body)
-        data = response.json()
+    response = await http_client.post(GOOGLE_URL,headers=headers,json=body)
+    data = response.json()
     if "routes" not in data:
         return []
     encoded_polyline = data["routes"][0]["polyline"]["encodedPolyline"]
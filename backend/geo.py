@@ -0,0 +1,98 @@
+import numpy as np
+
+# numpy helpers for the in-memory spatial indexes (road_index.py, location_index.py).
+# items are bucketed in a uniform lat/lng grid stored as three flat arrays:
+#   cell_keys   (c,)     sorted keys of the non-empty cells
+#   cell_starts (c + 1,) offsets of each cell's items in cell_items
+#   cell_items  (k,)     item indices, grouped by cell
+# distances use a local equirectangular projection, plenty accurate at the (tens of meters) distances we match at.
+
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LNG = 111320.0  # at the equator, times cos(lat)
+
+_KEY_OFFSET = 1 << 20
+_KEY_STRIDE = 1 << 21
+
+
+def cell_keys(lat, lng, cell: float):
+    cy = np.floor(np.asarray(lat) / cell).astype(np.int64)
+    cx = np.floor(np.asarray(lng) / cell).astype(np.int64)
+    return (cy + _KEY_OFFSET) * _KEY_STRIDE + (cx + _KEY_OFFSET)
+
+
+def cell_key(cy: int, cx: int) -> int:
+    return (cy + _KEY_OFFSET) * _KEY_STRIDE + (cx + _KEY_OFFSET)
+
+
+def build_grid(keys, items):
+    # keys[i] is the cell of items[i] (an item can appear once per cell it touches)
+    keys = np.asarray(keys, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys, items = keys[order], items[order]
+    unique_keys, first = np.unique(keys, return_index=True)
+    return unique_keys, np.append(first, len(keys)).astype(np.int64), items
+
+
+def grid_candidates(grid_keys, grid_starts, grid_items, lats, lngs, cell: float):
+    # (point index, item index) pairs for every item in the 3x3 cells around each point
+    n = len(lats)
+    pair_points, pair_items = [], []
+    if n == 0 or len(grid_keys) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    for oy in (-1, 0, 1):
+        for ox in (-1, 0, 1):
+            keys = cell_keys(lats + oy * cell, lngs + ox * cell, cell)
+            pos = np.minimum(np.searchsorted(grid_keys, keys), len(grid_keys) - 1)
+            found = grid_keys[pos] == keys
+            starts = np.where(found, grid_starts[pos], 0)
+            counts = np.where(found, grid_starts[pos + 1] - starts, 0)
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            pair_points.append(np.repeat(np.arange(n), counts))
+            pair_items.append(grid_items[np.repeat(starts, counts) + within])
+
+    if not pair_points:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(pair_points), np.concatenate(pair_items)
+
+
+def nearest_per_point(n: int, pair_points, pair_items, dist, max_distance: float):
+    # closest item per point out of the candidate pairs: (item index or -1, distance or inf)
+    # (distance stays inf for points with nothing within max_distance)
+    best = np.full(n, -1, dtype=np.int64)
+    best_dist = np.full(n, np.inf)
+    # most candidate pairs are out of range, drop them before sorting
+    close = dist <= max_distance
+    pair_points, pair_items, dist = pair_points[close], pair_items[close], dist[close]
+    if len(pair_points) == 0:
+        return best, best_dist
+    # sort by (point, distance) and keep the first row of every point
+    order = np.lexsort((dist, pair_points))
+    points_sorted = pair_points[order]
+    rows = order[np.flatnonzero(np.r_[True, points_sorted[1:] != points_sorted[:-1]])]
+    best[pair_points[rows]] = pair_items[rows]
+    best_dist[pair_points[rows]] = dist[rows]
+    return best, best_dist
+
+
+def point_distance(p_lat, p_lng, q_lat, q_lng):
+    kx = METERS_PER_DEG_LNG * np.cos(np.radians(p_lat))
+    return np.hypot((q_lng - p_lng) * kx, (q_lat - p_lat) * METERS_PER_DEG_LAT)
+
+
+def point_segment_distance(p_lat, p_lng, a_lat, a_lng, b_lat, b_lng):
+    # distance in meters from points p to segments a-b (all arrays of the same length)
+    kx = METERS_PER_DEG_LNG * np.cos(np.radians(p_lat))
+    ax = (a_lng - p_lng) * kx
+    ay = (a_lat - p_lat) * METERS_PER_DEG_LAT
+    dx = (b_lng - a_lng) * kx
+    dy = (b_lat - a_lat) * METERS_PER_DEG_LAT
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(length2 > 0, -(ax * dx + ay * dy) / length2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(ax + t * dx, ay + t * dy)
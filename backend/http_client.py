@@ -0,0 +1,99 @@
+import asyncio
+import os
+import random
+import httpx
+from urllib.parse import urlsplit, urlunsplit
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# one application-wide outbound http client for every google api call (geocode, routes, roads, places).
+# keeping the connections alive means we pay the tls handshake once per host instead of once per call,
+# and all calls get the same timeouts, connection limits and retry policy.
+
+HTTP_TIMEOUT = float(os.getenv("OUTBOUND_HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("OUTBOUND_HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("OUTBOUND_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("OUTBOUND_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_RETRIES = int(os.getenv("OUTBOUND_HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("OUTBOUND_HTTP_BACKOFF", "0.2"))  # seconds, doubled on every retry (with full jitter)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# when set (e.g. http://127.0.0.1:9100), every *.googleapis.com call is sent to this local stand-in server
+# instead (see standins/google_api.py), so the api can be load tested offline without paying for google calls.
+GOOGLE_STANDIN_URL = os.getenv("GOOGLE_STANDIN_URL")
+
+_client: httpx.AsyncClient = None
+
+
+def _http2_available() -> bool:
+    # http2 needs the optional 'h2' package (httpx[http2])
+    try:
+        import h2
+        return True
+    except ImportError:
+        return False
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=_http2_available(),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+    )
+
+
+async def start():
+    global _client
+    if _client is None:
+        _client = _new_client()
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    # normally created by start() in the app lifespan, created here too for scripts that don't run the app
+    global _client
+    if _client is None:
+        _client = _new_client()
+    return _client
+
+
+def resolve_url(url: str) -> str:
+    if not GOOGLE_STANDIN_URL:
+        return url
+    parts = urlsplit(url)
+    if not parts.hostname or not parts.hostname.endswith("googleapis.com"):
+        return url
+    standin = urlsplit(GOOGLE_STANDIN_URL)
+    return urlunsplit((standin.scheme, standin.netloc, parts.path, parts.query, parts.fragment))
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    # retries connection errors and 429/5xx answers with exponential backoff + full jitter,
+    # so many workers retrying at once don't hit the api in lockstep.
+    url = resolve_url(url)
+    client = get_client()
+    for attempt in range(HTTP_RETRIES + 1):
+        last_attempt = attempt == HTTP_RETRIES
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                return response
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+        await asyncio.sleep(random.uniform(0, HTTP_BACKOFF * (2 ** attempt)))
+
+
+async def get(url: str, **kwargs) -> httpx.Response:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> httpx.Response:
+    return await request("POST", url, **kwargs)
@@ -0,0 +1,66 @@
+import io
+import os
+import numpy as np
+from PIL import Image, ImageOps
+import pillow_avif  # registers the avif decoder with PIL
+from backend_vision import MODEL_INPUT_SIZE
+from score_cache import content_hash, file_hash
+
+# every upload is decoded exactly once here. from that one decode we make:
+#   - the small uint8 array the ssd graph wants (MODEL_INPUT_SIZE)
+#   - a size-capped jpeg for gemini (phone photos are 3-12 MB, gemini doesn't need that)
+# both scorers then work on these in-memory buffers instead of re-reading the file from uploads/.
+LLM_IMAGE_MAX_SIDE = int(os.getenv("LLM_IMAGE_MAX_SIDE", "1024"))
+LLM_IMAGE_QUALITY = int(os.getenv("LLM_IMAGE_QUALITY", "85"))
+
+
+def decode_image(data) -> dict:
+    # `data` is the image bytes or the path of a file with them (a blob / spooled upload, read straight from disk).
+    # BytesIO shares the buffer of a bytes object instead of copying it
+    image = Image.open(data if isinstance(data, str) else io.BytesIO(data))
+
+    # for jpegs, let libjpeg scale down by 1/2, 1/4 or 1/8 while decoding, so the full
+    # resolution frame is never materialized. the result is still >= the size we ask for.
+    image.draft("RGB", (LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+
+    llm_image = image.copy()
+    llm_image.thumbnail((LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE))
+    buf = io.BytesIO()
+    llm_image.save(buf, format="JPEG", quality=LLM_IMAGE_QUALITY)
+
+    model_input = np.asarray(image.resize(MODEL_INPUT_SIZE, Image.BILINEAR), dtype=np.uint8)
+
+    return {
+        "model_input": model_input,
+        "llm_bytes": buf.getvalue(),
+        "llm_mime_type": "image/jpeg",
+    }
+
+
+def model_input(data):
+    # only the ssd input, for re-scoring stored images (backfill.py). same draft size as decode_image, so the
+    # model sees the same pixels it saw when the post came in
+    image = Image.open(data if isinstance(data, str) else io.BytesIO(data))
+    image.draft("RGB", (LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    return np.asarray(image.resize(MODEL_INPUT_SIZE, Image.BILINEAR), dtype=np.uint8)
+
+
+def decode_or_none(data):
+    try:
+        return decode_image(data)
+    except Exception as e:
+        print(f"[ERROR] Could not decode image: {e}")
+        return None
+
+
+def prepare_image(data, sha256: str = None) -> dict:
+    # content hash (the key of the scoring cache) + the decoded copies, if the upload could be decoded
+    if sha256 is None:
+        sha256 = file_hash(data) if isinstance(data, str) else content_hash(data)
+    entry = {"sha256": sha256}
+    decoded = decode_or_none(data)
+    if decoded is not None:
+        entry.update(decoded)
+    return entry
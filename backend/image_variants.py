@@ -0,0 +1,162 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from typing import List
+from PIL import Image, ImageOps
+import pillow_avif  # registers the avif encoder with PIL
+from caching import LRUCache, SingleFlight
+from storage import blobs
+
+# downsized copies of the uploaded photos for the app (profile grid, map markers), so it doesn't download
+# the multi megabyte originals to show a thumbnail. every size in IMAGE_VARIANT_SIZES is encoded in every
+# format in IMAGE_VARIANT_FORMATS and stored next to the blobs as variants/<ab>/<sha256>/<size>.<format>.
+# they are rendered in a process pool (encoding avif is seconds of cpu per photo) right after a post's blobs
+# are stored, and on demand by /images when a variant isn't there yet (older posts, a full queue).
+
+IMAGE_VARIANT_SIZES = {"thumb": int(os.getenv("IMAGE_THUMB_SIDE", "320")), "medium": int(os.getenv("IMAGE_MEDIUM_SIDE", "1280"))}
+IMAGE_VARIANT_FORMATS = [f for f in os.getenv("IMAGE_VARIANT_FORMATS", "webp,avif").split(",") if f]
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
+# photos waiting for the pool, past this the new ones are left for on demand rendering
+IMAGE_VARIANT_MAX_PENDING = int(os.getenv("IMAGE_VARIANT_MAX_PENDING", "200"))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+AVIF_QUALITY = int(os.getenv("AVIF_QUALITY", "60"))
+AVIF_SPEED = int(os.getenv("AVIF_SPEED", "8"))
+# photos pillow couldn't render, remembered for a while so /images serves their original right away instead of
+# sending every request for them to the pool again
+IMAGE_VARIANT_FAILURE_CACHE_SIZE = int(os.getenv("IMAGE_VARIANT_FAILURE_CACHE_SIZE", "10000"))
+IMAGE_VARIANT_FAILURE_TTL = float(os.getenv("IMAGE_VARIANT_FAILURE_TTL", "3600"))
+
+MIME_TYPES = {"webp": "image/webp", "avif": "image/avif"}
+VARIANT_KEY_PREFIX = "variants/"
+
+_pool: ProcessPoolExecutor = None
+_flights = SingleFlight()
+_failures = LRUCache(IMAGE_VARIANT_FAILURE_CACHE_SIZE, ttl=IMAGE_VARIANT_FAILURE_TTL, name="variant-failures")
+_background = set()
+
+rendered = 0
+failed = 0
+dropped = 0
+
+
+def variant_key(sha256: str, size: str, fmt: str) -> str:
+    return f"{VARIANT_KEY_PREFIX}{sha256[:2]}/{sha256}/{size}.{fmt}"
+
+
+def _last_key(sha256: str) -> str:
+    # written after all the others, so when it exists the whole set does
+    return variant_key(sha256, list(IMAGE_VARIANT_SIZES)[-1], IMAGE_VARIANT_FORMATS[-1])
+
+
+def render(source, sizes: dict, formats: List[str]) -> dict:
+    # runs in the pool. source: the image bytes or the path of a file with them -> {(size, format): encoded bytes}
+    image = Image.open(source if isinstance(source, str) else io.BytesIO(source))
+    image.draft("RGB", (max(sizes.values()),) * 2)
+    image = ImageOps.exif_transpose(image).convert("RGB")
+
+    result = {}
+    # largest first, every smaller size is scaled down from the previous one
+    for name, side in sorted(sizes.items(), key=lambda kv: -kv[1]):
+        image.thumbnail((side, side), Image.LANCZOS)
+        for fmt in formats:
+            buf = io.BytesIO()
+            if fmt == "avif":
+                image.save(buf, format="AVIF", quality=AVIF_QUALITY, speed=AVIF_SPEED)
+            else:
+                image.save(buf, format="WEBP", quality=WEBP_QUALITY, method=4)
+            result[(name, fmt)] = buf.getvalue()
+    return result
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the api process has tensorflow and the db pool threads running
+        _pool = ProcessPoolExecutor(IMAGE_VARIANT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def _generate(sha256: str) -> bool:
+    global rendered, failed
+    if not IMAGE_VARIANT_FORMATS or await blobs.exists(_last_key(sha256)):
+        return True
+    try:
+        source = await blobs.load(blobs.blob_key(sha256))
+    except Exception as e:
+        # the blob is gone or the storage is down, not remembered: it may be back on the next request
+        failed += 1
+        print(f"[ERROR] Could not load {sha256} to render its variants: {e}")
+        return False
+    try:
+        variants = await asyncio.get_running_loop().run_in_executor(_get_pool(), render, source, IMAGE_VARIANT_SIZES, IMAGE_VARIANT_FORMATS)
+    except Exception as e:
+        # not decodable by pillow, /images serves the original then. a worker dying says nothing about the photo
+        failed += 1
+        if not isinstance(e, BrokenExecutor):
+            _failures.set(sha256, True)
+        print(f"[ERROR] Could not render the variants of {sha256}: {e}")
+        return False
+    last = (list(IMAGE_VARIANT_SIZES)[-1], IMAGE_VARIANT_FORMATS[-1])
+    await asyncio.gather(*(blobs.put_bytes(variant_key(sha256, size, fmt), data, MIME_TYPES[fmt])
+                           for (size, fmt), data in variants.items() if (size, fmt) != last))
+    await blobs.put_bytes(variant_key(sha256, *last), variants[last], MIME_TYPES[last[1]])
+    rendered += 1
+    return True
+
+
+async def ensure(sha256: str) -> bool:
+    # renders the variants of a blob unless they exist, False when they can't be rendered
+    if _failures.get(sha256):
+        return False
+    return await _flights.do(sha256, lambda: _generate(sha256))
+
+
+def submit(hashes: List[str]):
+    # called once a post's blobs are stored, doesn't wait for the rendering
+    global dropped
+    for sha256 in dict.fromkeys(hashes):
+        if len(_background) >= IMAGE_VARIANT_MAX_PENDING:
+            dropped += 1
+            continue
+        task = asyncio.ensure_future(ensure(sha256))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+async def variant(sha256: str, size: str, fmt: str):
+    # the key of a variant, rendered now if needed. None when there is none (the caller serves the original)
+    if size not in IMAGE_VARIANT_SIZES or fmt not in IMAGE_VARIANT_FORMATS:
+        return None
+    if _failures.get(sha256):
+        return None
+    key = variant_key(sha256, size, fmt)
+    if await blobs.exists(key):
+        return key
+    if not await blobs.exists(blobs.blob_key(sha256)) or not await ensure(sha256):
+        return None
+    return key
+
+
+async def stop():
+    global _pool
+    for task in list(_background):
+        task.cancel()
+    await asyncio.gather(*_background, return_exceptions=True)
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def stats() -> dict:
+    return {
+        "sizes": IMAGE_VARIANT_SIZES,
+        "formats": IMAGE_VARIANT_FORMATS,
+        "pending": len(_background),
+        "rendered": rendered,
+        "failed": failed,
+        "dropped": dropped,
+        "failures": _failures.stats(),
+        "single_flight": _flights.stats(),
+    }
@@ -0,0 +1,152 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import backend_vision
+import vision_remote
+
+# shared model server for all api workers on a host. instead of every uvicorn worker loading its own copy of the ssd
+# graph and tensorflow runtime (memory x workers, and one thread pool per core in each of them), the api workers
+# run with VISION_INFERENCE_SOCKET=<path> and send the decoded 300x300 model inputs here (vision_remote.py).
+#
+# the supervisor binds the unix socket and forks --processes model processes, each loads the graph once with a fixed
+# number of intra / inter op threads and accepts connections on the shared socket. a connection gets a thread,
+# and the requests of all connections of a process meet in its micro batcher (vision_batcher.py), so images from
+# different api workers share a sess.run. a model process that dies is forked again.
+#
+#   python inference_server.py --socket /tmp/pathfinder-vision.sock --processes 2 --intra-op-threads 4
+#   VISION_INFERENCE_SOCKET=/tmp/pathfinder-vision.sock uvicorn main:app --workers 8
+
+VISION_INFERENCE_SOCKET = os.getenv("VISION_INFERENCE_SOCKET", "/tmp/pathfinder-vision.sock")
+VISION_INFERENCE_PROCESSES = int(os.getenv("VISION_INFERENCE_PROCESSES", "2"))
+LISTEN_BACKLOG = 256
+
+# the server always runs the model itself
+backend_vision.remote = None
+
+
+def _handle(conn: socket.socket):
+    with conn:
+        while True:
+            try:
+                header, payload = vision_remote.recv_frame(conn)
+            except (ConnectionError, OSError, ValueError):
+                return
+            try:
+                if header.get("op") == "ping":
+                    response = {"ok": True, "pid": os.getpid(), "ready": backend_vision.is_ready(),
+                                "model": backend_vision.model_identity()}, b""
+                elif header.get("op") == "detect":
+                    results = backend_vision.run_many(vision_remote.decode_images(header, payload))
+                    response = vision_remote.encode_results(results) if results else ({"ok": True, "boxes": [0, 0, 4], "scores": [0, 0], "classes": [0, 0]}, b"")
+                else:
+                    response = {"ok": False, "error": f"unknown op {header.get('op')!r}"}, b""
+            except Exception as e:
+                print(f"[ERROR] inference failed: {e}", flush=True)
+                response = {"ok": False, "error": str(e)}, b""
+            try:
+                vision_remote.send_frame(conn, *response)
+            except OSError:
+                return
+
+
+def _model_process(listener: socket.socket):
+    # runs in a forked child: tensorflow is only ever imported here, never in the supervisor
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    backend_vision.warm_up()
+    print(f"model process {os.getpid()} ready", flush=True)
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=_handle, args=(conn,), daemon=True).start()
+
+
+def _fork(listener: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _model_process(listener)
+        except BaseException as e:
+            print(f"[ERROR] model process {os.getpid()} stopped: {e}", flush=True)
+            code = 1
+        os._exit(code)
+    return pid
+
+
+def serve(path: str, processes: int):
+    if os.path.exists(path):
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(LISTEN_BACKLOG)
+    print(f"inference server on {path}: {processes} {backend_vision.VISION_BACKEND} model processes, "
+          f"{backend_vision.VISION_INTRA_OP_THREADS} intra / {backend_vision.VISION_INTER_OP_THREADS} inter op threads each", flush=True)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    children = {_fork(listener) for _ in range(processes)}
+    try:
+        while not stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid in children:
+                children.discard(pid)
+                print(f"[ERROR] model process {pid} exited ({status}), starting a new one", flush=True)
+                # a process that can't even load the model would otherwise be restarted in a tight loop
+                time.sleep(1)
+                children.add(_fork(listener))
+            else:
+                time.sleep(0.2)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="shared ssd inference server for the api workers")
+    parser.add_argument("--socket", default=VISION_INFERENCE_SOCKET)
+    parser.add_argument("--processes", type=int, default=VISION_INFERENCE_PROCESSES)
+    parser.add_argument("--backend", choices=sorted(backend_vision.MODEL_PATHS), default=None,
+                        help="model runtime (VISION_BACKEND), see vision_backends/")
+    parser.add_argument("--model-path", default=None, help="model file, default: the one of the backend")
+    parser.add_argument("--intra-op-threads", type=int, default=None,
+                        help="runtime threads per op, default: the cores split between the processes")
+    parser.add_argument("--inter-op-threads", type=int, default=None, help="ops run in parallel, default 1")
+    parser.add_argument("--max-batch-size", type=int, default=None, help="images per model run (VISION_MAX_BATCH_SIZE)")
+    args = parser.parse_args()
+
+    # read by the model processes when they create their session / batcher after the fork
+    cores = os.cpu_count() or 1
+    backend_vision.VISION_INTRA_OP_THREADS = args.intra_op_threads or backend_vision.VISION_INTRA_OP_THREADS or max(1, cores // args.processes)
+    backend_vision.VISION_INTER_OP_THREADS = args.inter_op_threads or backend_vision.VISION_INTER_OP_THREADS or 1
+    backend_vision.VISION_BACKEND = args.backend or backend_vision.VISION_BACKEND
+    backend_vision.VISION_MODEL_PATH = args.model_path or backend_vision.VISION_MODEL_PATH
+    if args.max_batch_size:
+        backend_vision.batcher.max_batch_size = args.max_batch_size
+    if sys.platform == "win32":
+        raise SystemExit("the inference server needs fork and unix sockets")
+    serve(args.socket, args.processes)
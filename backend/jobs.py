@@ -0,0 +1,136 @@
+import asyncio
+import os
+import uuid
+from typing import List
+import post_service
+from database import db
+
+# background scoring jobs for /addPost?mode=job.
+# the scoring_jobs table is the source of truth (so jobs survive a restart), the in-process queue only
+# holds ids of jobs accepted by this worker. when the queue is full /addPost answers 429 instead of piling up work.
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+# jobs left 'running' for longer than this (the worker died mid-job) are put back in the queue, checked every
+# JOB_REQUEUE_SECONDS in the background (a worker of another api process can die at any time, not just at startup)
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "600"))
+JOB_REQUEUE_SECONDS = float(os.getenv("JOB_REQUEUE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+_queue: asyncio.Queue = None
+_workers: List[asyncio.Task] = []
+_requeue_task: asyncio.Task = None
+
+
+async def _requeuer():
+    while True:
+        try:
+            requeued = await db.requeueStaleJobs(JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS)
+            if requeued:
+                print(f"Requeued (or failed, out of attempts) {requeued} unfinished scoring jobs")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Could not recover scoring jobs: {e}")
+        await asyncio.sleep(JOB_REQUEUE_SECONDS)
+
+
+async def start():
+    global _queue, _requeue_task
+    _queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    # in the background, startup doesn't wait for the database
+    _requeue_task = asyncio.create_task(_requeuer(), name="scoring-job-requeuer")
+    for i in range(JOB_WORKERS):
+        _workers.append(asyncio.create_task(_worker(), name=f"scoring-job-worker-{i}"))
+
+
+async def stop():
+    global _requeue_task
+    tasks = _workers + ([_requeue_task] if _requeue_task is not None else [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _workers.clear()
+    _requeue_task = None
+
+
+async def submit(text_descr: str, latitude: str, longitude: str, images_dir: str, mime_types: List[str]) -> str:
+    if is_full():
+        raise QueueFull()
+
+    job_id = uuid.uuid4().hex
+    created = await db.createJob(job_id, text_descr, latitude, longitude, images_dir, mime_types)
+    if not created:
+        raise RuntimeError("could not persist the scoring job")
+
+    try:
+        _queue.put_nowait(job_id)
+    except asyncio.QueueFull:
+        # the job is already persisted, an idle worker will pick it up from the table
+        pass
+    return job_id
+
+
+def is_full() -> bool:
+    return _queue is None or _queue.full()
+
+
+def queue_stats() -> dict:
+    return {
+        "workers": len(_workers),
+        "queued": _queue.qsize() if _queue is not None else 0,
+        "capacity": JOB_QUEUE_SIZE,
+    }
+
+
+async def _next_job():
+    # prefer jobs handed to this worker, otherwise sweep the table for queued jobs (recovered or overflowed ones)
+    try:
+        job_id = await asyncio.wait_for(_queue.get(), timeout=JOB_POLL_SECONDS)
+        return await db.claimJob(job_id)
+    except asyncio.TimeoutError:
+        return await db.claimNextJob(JOB_MAX_ATTEMPTS)
+
+
+async def _worker():
+    while True:
+        try:
+            job = await _next_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Could not fetch scoring job: {e}")
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            continue
+
+        if job is not None:
+            await _run(job)
+
+
+async def _run(job: dict):
+    job_id = job['id']
+
+    async def progress(stage):
+        await db.updateJob(job_id, stage=stage)
+
+    try:
+        images = await post_service.load_stored_images(job['images_dir'], job['mime_types'] or [])
+        result = await post_service.score_and_store(images, job['text_descr'], job['latitude'], job['longitude'],
+                                                    job['images_dir'], progress=progress)
+        if result['saved']:
+            await db.updateJob(job_id, status="done", stage="done", result=result)
+        else:
+            await db.updateJob(job_id, status="failed", error="Error adding the post")
+    except asyncio.CancelledError:
+        # shutting down, the job stays 'running' and is requeued once it is stale (_requeuer)
+        raise
+    except Exception as e:
+        print(f"[ERROR] Scoring job {job_id} failed: {e}")
+        status = "queued" if job.get('attempts', 0) < JOB_MAX_ATTEMPTS else "failed"
+        await db.updateJob(job_id, status=status, error=str(e))
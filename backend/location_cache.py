@@ -0,0 +1,244 @@
+import json
+import os
+import time
+from dataclasses import asdict
+from datetime import timedelta
+from typing import List
+from caching import LRUCache, MISSING
+from database import db
+from database.models import Location
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # the shared tier is optional
+    aioredis = None
+
+# read-through cache of the averaged location scores served to the map (/getLocation, /getLocations, /locations).
+# a location's scores only change when a post is added for it, so entries live until post_service (addPost)
+# or bulk_ingest invalidates them.
+#   local:  bounded in-process LRU, the popular corridors are answered from memory
+#   shared: optional redis (LOCATION_CACHE_REDIS_URL, standins/fake_redis.py for tests), shared by every api worker
+# with several workers, a post invalidates the shared tier and its own worker's LRU only. the other workers learn about
+# it from the database, checked every LOCATION_CACHE_SYNC_SECONDS: the ids of small invalidations (a post) are logged
+# in cache_invalidation and every worker drops just those entries, big ones (backfill.py, the bulk_ingest cli, more
+# than LOCATION_CACHE_LOG_MAX ids) bump a generation counter instead and every worker drops its whole LRU.
+# ids that don't exist are cached too (as NOT_FOUND), an unscored road on a route is looked up as often as a scored one.
+
+LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", "50000"))
+LOCATION_CACHE_REDIS_URL = os.getenv("LOCATION_CACHE_REDIS_URL")
+# other processes always can write (the other workers, the clis), the local ttl bounds the staleness when the
+# generation check below can't reach the database
+LOCATION_CACHE_LOCAL_TTL = float(os.getenv("LOCATION_CACHE_LOCAL_TTL", "5" if LOCATION_CACHE_REDIS_URL else "60"))
+LOCATION_CACHE_SHARED_TTL = int(os.getenv("LOCATION_CACHE_SHARED_TTL", "3600"))
+# an invalidation leaves a tombstone in redis instead of deleting the key, and fills only write keys that don't
+# exist (SET NX). so a worker whose db read started before another worker's post committed can't put its old scores
+# back. it has to outlive any db read (the statement timeout), until it expires the location is read from the db.
+LOCATION_CACHE_TOMBSTONE_TTL = int(os.getenv("LOCATION_CACHE_TOMBSTONE_TTL", "30"))
+LOCATION_CACHE_SYNC_SECONDS = float(os.getenv("LOCATION_CACHE_SYNC_SECONDS", "2"))
+LOCATION_CACHE_LOG_MAX = int(os.getenv("LOCATION_CACHE_LOG_MAX", "1000"))
+# how long logged ids are kept. a worker that couldn't check for longer than that may have missed some, it drops
+# its whole LRU
+LOCATION_CACHE_LOG_RETENTION = float(os.getenv("LOCATION_CACHE_LOG_RETENTION", "600"))
+LOG_OVERLAP_SECONDS = 10  # see db.getCacheInvalidations
+GENERATION_NAME = "locations"
+
+KEY_PREFIX = "loc:"
+TOMBSTONE = b"-"
+NOT_FOUND = {}
+
+_local = LRUCache(LOCATION_CACHE_SIZE, ttl=LOCATION_CACHE_LOCAL_TTL, name="locations")
+_redis = None
+# bumped by every invalidation: a db read that overlapped one doesn't fill the local cache, it may have read
+# the scores from before the new post
+_generation = 0
+
+# the database generation this worker's LRU is from, the database time of the last check, the log rows already
+# applied (id -> created_at, only the ones still in the overlap window) and when the checks ran
+_db_generation = None
+_log_since = None
+_applied = {}
+_synced_at = 0.0
+_pruned_at = 0.0
+_syncing = False
+
+shared_hits = 0
+shared_misses = 0
+db_reads = 0
+shared_errors = 0
+sync_errors = 0
+logged_invalidations = 0
+
+
+def _get_redis():
+    global _redis
+    if _redis is None and LOCATION_CACHE_REDIS_URL and aioredis is not None:
+        _redis = aioredis.from_url(LOCATION_CACHE_REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis
+
+
+async def close():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+
+async def _shared_get(ids: List[str]) -> dict:
+    global shared_hits, shared_misses, shared_errors
+    client = _get_redis()
+    if client is None or not ids:
+        return {}
+    try:
+        values = await client.mget([KEY_PREFIX + i for i in ids])
+    except Exception as e:
+        # a broken cache must not break the map, fall through to postgres
+        shared_errors += 1
+        print("Error: ", e)
+        return {}
+    found = {i: json.loads(v) for i, v in zip(ids, values) if v is not None and v != TOMBSTONE}
+    shared_hits += len(found)
+    shared_misses += len(ids) - len(found)
+    return found
+
+
+async def _shared_set(values: dict):
+    global shared_errors
+    client = _get_redis()
+    if client is None or not values:
+        return
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            for location_id, value in values.items():
+                pipe.set(KEY_PREFIX + location_id, json.dumps(value, default=str), ex=LOCATION_CACHE_SHARED_TTL, nx=True)
+            await pipe.execute()
+    except Exception as e:
+        shared_errors += 1
+        print("Error: ", e)
+
+
+async def _sync():
+    # drop the local entries some other process changed since the last check. a failed check leaves them alone,
+    # LOCATION_CACHE_LOCAL_TTL still bounds how stale they get
+    global _db_generation, _log_since, _applied, _synced_at, _pruned_at, _syncing, _generation, sync_errors, logged_invalidations
+    if _syncing or time.monotonic() - _synced_at < LOCATION_CACHE_SYNC_SECONDS:
+        return
+    _syncing = True
+    try:
+        state = await db.getCacheInvalidations(GENERATION_NAME, _log_since, LOG_OVERLAP_SECONDS)
+        behind = _log_since is not None and state["now"] - _log_since > timedelta(seconds=LOCATION_CACHE_LOG_RETENTION - LOG_OVERLAP_SECONDS)
+        if (_db_generation is not None and state["generation"] != _db_generation) or behind:
+            _local.clear()
+            _generation += 1
+        else:
+            fresh = [row['key'] for row in state["keys"] if row['id'] not in _applied]
+            if fresh:
+                _generation += 1
+                logged_invalidations += len(fresh)
+                for location_id in fresh:
+                    _local.delete(location_id)
+        cutoff = state["now"] - timedelta(seconds=LOG_OVERLAP_SECONDS)
+        _applied.update((row['id'], row['created_at']) for row in state["keys"])
+        _applied = {i: created for i, created in _applied.items() if created > cutoff}
+        _db_generation = state["generation"]
+        _log_since = state["now"]
+        if time.monotonic() - _pruned_at > LOCATION_CACHE_LOG_RETENTION / 10:
+            _pruned_at = time.monotonic()
+            await db.pruneCacheInvalidations(LOCATION_CACHE_LOG_RETENTION)
+    except Exception as e:
+        sync_errors += 1
+        print("Error: ", e)
+    finally:
+        _synced_at = time.monotonic()
+        _syncing = False
+
+
+async def get_locations(ids: List[str]) -> List[dict]:
+    # same as db.getLocations: the found locations in the order of `ids`
+    global db_reads
+    await _sync()
+    found = {}
+    missing = []
+    for location_id in dict.fromkeys(ids):
+        value = _local.get(location_id, MISSING)
+        if value is MISSING:
+            missing.append(location_id)
+        else:
+            found[location_id] = value
+
+    if missing:
+        shared = await _shared_get(missing)
+        for location_id, value in shared.items():
+            _local.set(location_id, value)
+        found.update(shared)
+        missing = [i for i in missing if i not in shared]
+
+    if missing:
+        generation = _generation
+        db_reads += 1
+        rows = {}
+        try:
+            async for chunk in db.iterLocations(missing):
+                rows.update((loc['location_id'], loc) for loc in chunk)
+        except Exception as e:
+            # answer with what we have, and don't cache the failed ids as not found
+            print("Error: ", e)
+            return [found[i] for i in ids if found.get(i)]
+        fetched = {i: rows.get(i, NOT_FOUND) for i in missing}
+        if generation == _generation:
+            for location_id, value in fetched.items():
+                _local.set(location_id, value)
+            await _shared_set(fetched)
+        found.update(fetched)
+
+    return [found[i] for i in ids if found.get(i)]
+
+
+async def get_location(location_id: str) -> dict:
+    # same as db.getLocation: location_id is None when it wasn't found
+    locations = await get_locations([location_id])
+    return locations[0] if locations else asdict(Location(location_id=None))
+
+
+async def invalidate(location_ids: List[str]):
+    # called after a post for these locations committed
+    global _generation, shared_errors, sync_errors
+    _generation += 1
+    for location_id in location_ids:
+        _local.delete(location_id)
+    client = _get_redis()
+    if client is not None and location_ids:
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                for location_id in location_ids:
+                    pipe.set(KEY_PREFIX + location_id, TOMBSTONE, ex=LOCATION_CACHE_TOMBSTONE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            shared_errors += 1
+            print("Error: ", e)
+    if location_ids:
+        try:
+            if len(location_ids) > LOCATION_CACHE_LOG_MAX:
+                # this worker's own lru is already clean of them, it drops it again on its next check like everyone else
+                await db.bumpCacheGeneration(GENERATION_NAME)
+            else:
+                # our own lru is already clean, the next check doesn't have to apply these again
+                _applied.update((row['id'], row['created_at']) for row in await db.logCacheInvalidations(GENERATION_NAME, location_ids))
+        except Exception as e:
+            sync_errors += 1
+            print("Error: ", e)
+
+
+def stats() -> dict:
+    lookups = shared_hits + shared_misses
+    return {
+        "local": _local.stats(),
+        "shared": {
+            "enabled": _get_redis() is not None,
+            "hits": shared_hits,
+            "misses": shared_misses,
+            "errors": shared_errors,
+            "hit_ratio": round(shared_hits / lookups, 4) if lookups else 0,
+        },
+        "db_reads": db_reads,
+        "sync": {"generation": _db_generation, "logged_invalidations": logged_invalidations, "errors": sync_errors},
+    }
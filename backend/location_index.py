@@ -0,0 +1,217 @@
+import asyncio
+import os
+import time
+from datetime import timedelta
+import numpy as np
+import geo
+import road_graph
+from database import db
+
+# in-memory spatial index over the scored locations (location_scores joined with the location coordinates),
+# used to annotate a /route polyline with road quality. the index is refreshed incrementally: only locations
+# whose `updated_at` moved since the last refresh are fetched, at most every LOCATION_INDEX_REFRESH_SECONDS.
+# updated_at is the start of the writing transaction, one that commits late can show up with a time older than
+# rows already seen, so every refresh asks again for the last LOCATION_INDEX_OVERLAP_SECONDS before the newest one.
+# matching a route is a handful of numpy operations over the whole polyline, no per-point python loop.
+
+LOCATION_INDEX_REFRESH_SECONDS = float(os.getenv("LOCATION_INDEX_REFRESH_SECONDS", "30"))
+# longer than the longest transaction that bumps location.updated_at, the bulk ones (DB_BULK_STATEMENT_TIMEOUT_MS)
+LOCATION_INDEX_OVERLAP_SECONDS = float(os.getenv("LOCATION_INDEX_OVERLAP_SECONDS", "600"))
+# a route segment picks up the scores of the closest scored location within this distance of it
+ROUTE_MATCH_METERS = float(os.getenv("ROUTE_MATCH_METERS", "30"))
+# segments with an RQI below this are counted as hazards in the route summary
+HAZARD_RQI_THRESHOLD = float(os.getenv("HAZARD_RQI_THRESHOLD", "40"))
+
+CELL_DEGREES = 0.001  # ~110 m, larger than ROUTE_MATCH_METERS so the 3x3 neighbourhood covers it
+# longer segments are sampled this often: every point of the segment is within half of it from a sample, and that
+# plus ROUTE_MATCH_METERS stays inside the neighbourhood of the sample
+SAMPLE_METERS = 40.0
+
+SCORE_COLUMNS = ["surface_damage", "traffic_safety_risk", "ride_discomfort", "waterlogging", "urgency_for_repair"]
+
+
+def compute_indices(scores):
+    # scores: (n, 5) in SCORE_COLUMNS order, 0-100 with 100 the worst. returns (rqi, psi), 0-100 with 100 the best.
+    # RQI (road quality): surface damage, ride discomfort and waterlogging. PSI (pedestrian safety): traffic safety risk.
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1, len(SCORE_COLUMNS))
+    rqi = 100 - scores[:, [0, 2, 3]].mean(axis=1)
+    psi = 100 - scores[:, 1]
+    return rqi, psi
+
+
+class LocationIndex:
+    def __init__(self):
+        self.ids = []        # row -> location id
+        self._rows = {}      # location id -> row
+        self.lat = np.empty(0)
+        self.lng = np.empty(0)
+        self.scores = np.empty((0, len(SCORE_COLUMNS)))
+        self.last_updated = None  # max updated_at seen, the next refresh asks for rows after it (minus the overlap)
+        self.version = 0  # bumped by every upsert that changed something
+        self._grid = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def upsert(self, rows) -> int:
+        # -> how many rows were new or changed, the overlap of the refreshes brings back rows we already have
+        if not rows:
+            return 0
+        changed = 0
+        new_lat, new_lng, new_scores = [], [], []
+        for row in rows:
+            values = [float(row[c] or 0) for c in SCORE_COLUMNS]
+            i = self._rows.get(row['location_id'])
+            if i is None:
+                self._rows[row['location_id']] = len(self.ids)
+                self.ids.append(row['location_id'])
+                new_lat.append(row['lat'])
+                new_lng.append(row['lng'])
+                new_scores.append(values)
+                changed += 1
+            elif self.scores[i].tolist() != values or self.lat[i] != row['lat'] or self.lng[i] != row['lng']:
+                if self.lat[i] != row['lat'] or self.lng[i] != row['lng']:
+                    self._grid = None
+                self.lat[i], self.lng[i] = row['lat'], row['lng']
+                self.scores[i] = values
+                changed += 1
+            if self.last_updated is None or row['updated_at'] > self.last_updated:
+                self.last_updated = row['updated_at']
+
+        if new_lat:
+            self.lat = np.concatenate([self.lat, np.asarray(new_lat, dtype=np.float64)])
+            self.lng = np.concatenate([self.lng, np.asarray(new_lng, dtype=np.float64)])
+            self.scores = np.concatenate([self.scores, np.asarray(new_scores, dtype=np.float64)])
+            self._grid = None  # rebuilt lazily
+        if changed:
+            self.version += 1
+        return changed
+
+    def snapshot(self) -> "LocationIndex":
+        # a copy that later upserts don't touch, for work done off the event loop
+        copy = LocationIndex()
+        copy.ids = list(self.ids)
+        copy.lat, copy.lng, copy.scores = self.lat.copy(), self.lng.copy(), self.scores.copy()
+        copy.last_updated, copy.version = self.last_updated, self.version
+        return copy
+
+    def _get_grid(self):
+        if self._grid is None:
+            self._grid = geo.build_grid(geo.cell_keys(self.lat, self.lng, CELL_DEGREES), np.arange(len(self.ids)))
+        return self._grid
+
+    def match_segments(self, lats, lngs, max_distance: float = ROUTE_MATCH_METERS):
+        # row of the closest location per polyline segment (consecutive points), -1 if none within max_distance.
+        # candidates come from the grid cells around both ends of every segment and around points spaced
+        # SAMPLE_METERS apart along the longer ones (a straight road can be one segment of kilometres), distances are
+        # point-to-segment.
+        grid_keys, grid_starts, grid_items = self._get_grid()
+        n = len(lats) - 1
+        a_lat, a_lng, b_lat, b_lng = lats[:-1], lngs[:-1], lats[1:], lngs[1:]
+
+        # a polyline point's candidates are shared by the segment ending and the segment starting at it
+        points, rows = geo.grid_candidates(grid_keys, grid_starts, grid_items, lats, lngs, CELL_DEGREES)
+        starts = points < n
+        ends = points > 0
+        pair_segs = [points[starts], points[ends] - 1]
+        pair_rows = [rows[starts], rows[ends]]
+
+        samples = np.ceil(geo.point_distance(a_lat, a_lng, b_lat, b_lng) / SAMPLE_METERS).astype(np.int64) - 1
+        long_segs = np.flatnonzero(samples > 0)
+        if len(long_segs):
+            counts = samples[long_segs]
+            segs = np.repeat(long_segs, counts)
+            # the k-th of m points along a segment sits at (k + 1) / (m + 1) of it
+            k = np.arange(len(segs)) - np.repeat(np.cumsum(counts) - counts, counts)
+            t = (k + 1) / (samples[segs] + 1)
+            points, sample_rows = geo.grid_candidates(grid_keys, grid_starts, grid_items, a_lat[segs] + t * (b_lat[segs] - a_lat[segs]),
+                                                      a_lng[segs] + t * (b_lng[segs] - a_lng[segs]), CELL_DEGREES)
+            pair_segs.append(segs[points])
+            pair_rows.append(sample_rows)
+
+        pair_segs = np.concatenate(pair_segs)
+        pair_rows = np.concatenate(pair_rows)
+        dist = geo.point_segment_distance(self.lat[pair_rows], self.lng[pair_rows], a_lat[pair_segs], a_lng[pair_segs],
+                                          b_lat[pair_segs], b_lng[pair_segs])
+        rows, _ = geo.nearest_per_point(n, pair_segs, pair_rows, dist, max_distance)
+        return rows
+
+
+index = LocationIndex()
+_last_refresh = 0.0
+_refresh_lock = asyncio.Lock()
+
+
+async def refresh_if_stale(force: bool = False):
+    global _last_refresh
+    if not force and time.monotonic() - _last_refresh < LOCATION_INDEX_REFRESH_SECONDS:
+        return
+    async with _refresh_lock:
+        if not force and time.monotonic() - _last_refresh < LOCATION_INDEX_REFRESH_SECONDS:
+            return
+        since = index.last_updated - timedelta(seconds=LOCATION_INDEX_OVERLAP_SECONDS) if index.last_updated else None
+        changed = index.upsert(await db.getScoredLocationsSince(since))
+        _last_refresh = time.monotonic()
+        if changed and road_graph.ROAD_GRAPH_PATH:
+            # the routing penalties follow the scores. computed from a snapshot in a thread (snapping the locations
+            # is cpu bound), the refresh lock keeps two of them from running at once
+            try:
+                await asyncio.to_thread(road_graph.update_penalties, index.snapshot())
+            except Exception as e:
+                print("Error: ", e)
+
+
+def _round_or_none(values):
+    # nan (unscored) -> None, done on python floats since looping over numpy scalars is slow
+    return [None if v != v else v for v in np.round(values, 1).tolist()]
+
+
+def annotate_route(points) -> dict:
+    # per-segment (between consecutive polyline points) location id, RQI and PSI, plus a summary of the route
+    pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n_segments = max(len(pts) - 1, 0)
+    if n_segments == 0:
+        return {"segments": {"location_ids": [], "rqi": [], "psi": []}, "summary": {"segments": 0}}
+
+    a_lat, a_lng, b_lat, b_lng = pts[:-1, 0], pts[:-1, 1], pts[1:, 0], pts[1:, 1]
+    lengths = geo.point_distance(a_lat, a_lng, b_lat, b_lng)
+
+    rows = index.match_segments(pts[:, 0], pts[:, 1]) if len(index) else np.full(n_segments, -1)
+    scored = rows >= 0
+    rqi = np.full(n_segments, np.nan)
+    psi = np.full(n_segments, np.nan)
+    if scored.any():
+        rqi[scored], psi[scored] = compute_indices(index.scores[rows[scored]])
+
+    total_length = float(lengths.sum())
+    scored_length = float(lengths[scored].sum())
+    hazards = scored & (np.nan_to_num(rqi, nan=100) < HAZARD_RQI_THRESHOLD)
+    summary = {
+        "segments": n_segments,
+        "scored_segments": int(scored.sum()),
+        "length_m": round(total_length, 1),
+        "scored_length_m": round(scored_length, 1),
+        "coverage": round(scored_length / total_length, 4) if total_length else 0,
+        "hazard_segments": int(hazards.sum()),
+        "hazard_length_m": round(float(lengths[hazards].sum()), 1),
+    }
+    if scored_length > 0:
+        # length weighted, so a long bad stretch counts more than a short one
+        summary["mean_rqi"] = round(float((rqi[scored] * lengths[scored]).sum() / scored_length), 1)
+        summary["mean_psi"] = round(float((psi[scored] * lengths[scored]).sum() / scored_length), 1)
+        worst = int(np.nanargmin(rqi))
+        summary["min_rqi"] = round(float(rqi[worst]), 1)
+        summary["worst_segment"] = worst
+
+    return {
+        "segments": {
+            "location_ids": [index.ids[r] if r >= 0 else None for r in rows],
+            "rqi": _round_or_none(rqi),
+            "psi": _round_or_none(psi),
+        },
+        "summary": summary,
+    }
+
+
+def stats() -> dict:
+    return {"locations": len(index), "last_updated": index.last_updated}
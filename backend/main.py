@@ -1,22 +1,36 @@
-from fastapi import FastAPI, Query, File, UploadFile, Form
+from fastapi import FastAPI, Query, File, UploadFile, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from directions import get_route
+import directions
+import places
+import road_index
+import road_graph
+import location_index
+import location_cache
+import tiles
 from typing import List
-import uuid
 import os
 import backend_llm
 import backend_vision
-import aiofiles
+import post_service
+import scoring
+import score_cache
+import jobs
+import bulk_ingest
+from storage import blobs
+import image_variants
+import csv
+import io
+import json
 import asyncio
-import httpx
+import http_client
+import threading
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 load_dotenv() 
 
-# requests library to make api calls to Google Roads API
-import requests
-
 # to convert the python datatypes/objects, etc. to json strings 
 from fastapi.encoders import jsonable_encoder
 
@@ -30,8 +44,6 @@ from pydantic import BaseModel
 from database.models import User, Location
 
 from database import db
-PLACES_AUTOCOMPLETE_URL = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
-PLACES_DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
 
 # just the User model with inheriting BaseModel so that we can use User model (in form of this below model) directly as function arguments.
 # see line 71.
@@ -44,7 +56,43 @@ class RequestUserModel(BaseModel):
 class RequestLocationsIDModel(BaseModel):
     location_ids: List[str]
 
-app = FastAPI()
+# subsystems that take a while to come up (tensorflow graph + warm-up inference, gemini client, db pool).
+# they are all lazy, so the api starts serving immediately; with WARMUP_ON_STARTUP they are also loaded in a
+# background thread so the first scoring request doesn't pay for it. /health/ready tells when that is done.
+SUBSYSTEMS = {
+    "database": (None, db.is_ready),  # opened on the event loop by the lifespan below
+    "llm": (backend_llm.get_client, backend_llm.is_ready),
+    "vision": (backend_vision.warm_up, backend_vision.is_ready),
+    "road_index": (road_index.get_index, road_index.is_ready),
+    "road_graph": (road_graph.get_graph, road_graph.is_ready),
+}
+
+def warm_up_subsystems():
+    for name, (init, _) in SUBSYSTEMS.items():
+        if init is None:
+            continue
+        try:
+            init()
+        except Exception as e:
+            print(f"[ERROR] Could not initialize {name}: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("WARMUP_ON_STARTUP", "1") == "1":
+        threading.Thread(target=warm_up_subsystems, name="warm-up", daemon=True).start()
+    await db.open_pool()
+    await http_client.start()
+    await jobs.start()
+    tiles.start()
+    yield
+    await tiles.stop()
+    await jobs.stop()
+    await image_variants.stop()
+    await http_client.close()
+    await location_cache.close()
+    await db.close_pool()
+
+app = FastAPI(lifespan=lifespan)
 #Add api calling between front end and backend here
 app.add_middleware(
     CORSMiddleware,
@@ -59,49 +107,84 @@ try:
 except KeyError:
     raise RuntimeError("Check project environment variables. Set it. It is needed to get location_id from latitude/longitude")
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# a thumb / medium request answered with the original because the variant couldn't be rendered (yet): the url
+# will serve the variant later, so it must not be cached for good
+IMAGE_FALLBACK_CACHE_CONTROL = "public, max-age=60"
+
+# older posts (upload_<uuid> directories) and, with the local storage backend, the blobs. /images/{sha256} serves
+# the blobs on every backend, and their downsized variants. nothing under uploads/ is ever rewritten, so it is
+# cached like /images (StaticFiles already answers If-None-Match and Range).
+# STORAGE_TMP_DIR defaults to outside uploads/, but if it is pointed inside, the spool files are not served.
+_TMP_UNDER_UPLOADS = os.path.relpath(os.path.abspath(blobs.STORAGE_TMP_DIR), os.path.abspath(blobs.STORAGE_LOCAL_DIR))
+if _TMP_UNDER_UPLOADS == os.curdir or _TMP_UNDER_UPLOADS.startswith(os.pardir):
+    _TMP_UNDER_UPLOADS = None
+
+class ImmutableStaticFiles(StaticFiles):
+    async def get_response(self, path, scope):
+        if _TMP_UNDER_UPLOADS is not None:
+            rel = os.path.normpath(path)
+            if rel == _TMP_UNDER_UPLOADS or rel.startswith(_TMP_UNDER_UPLOADS + os.sep):
+                return Response(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = IMAGE_CACHE_CONTROL
+        return response
+
+app.mount("/uploads", ImmutableStaticFiles(directory=blobs.STORAGE_LOCAL_DIR, check_dir=False), name="uploads")
 
 GOOGLE_ROADS_API_KEY = os.getenv("GOOGLE_API_KEY", "") #keep naming as google api key for consistnecy
+JOB_EVENTS_POLL_SECONDS = 1
 
 
-def combine_scores(scores_llm, scores_vision):
-    scores = {}
-    for key in set(scores_llm.keys()) | set(scores_vision.keys()):
-        v1 = scores_llm.get(key, 0)
-        v2 = scores_vision.get(key, 0)
-        scores[key] = (v1 + v2) / 2
-
-    return scores
-
 # endpoint for creating a new user 
 # Example curl:
 # curl -X POST "http://127.0.0.1:8000/createUser" \
 #      -H "Content-Type: application/json" \
 #      -d '{"id": "Sa12", "name": "Sahil Gupta", "reputation": "1000"}'
 @app.post("/createUser")
-def create_user(user: RequestUserModel):
+async def create_user(user: RequestUserModel):
     newUser = User(id=user.id,
                    name=user.name,
                    reputation=user.reputation)
     
-    done = db.createUser(newUser)
+    done = await db.createUser(newUser)
     if done:
         return JSONResponse(content=jsonable_encoder({"message": "Successful!"}), status_code=201)
     else:
         return JSONResponse(content=jsonable_encoder({"message": "Error creating new user"}), status_code=500)
 
 # in this endpoint, search the user by paramter
+# (first page of /users/search, the cursor for the next page is in the X-Next-Cursor header)
 @app.get("/searchUser/{name}")
-def search_user(name: str):
-    users = db.searchForUser(name)
+async def search_user(name: str):
+    result = await db.searchForUser(name)
+    users = result['users']
+    headers = {"X-Next-Cursor": result['next_cursor']} if result['next_cursor'] else None
 
     if len(users) == 0:
         return JSONResponse(content=jsonable_encoder(users), status_code=204)
     else:
-        return JSONResponse(content=jsonable_encoder(users), status_code=200)
+        return JSONResponse(content=jsonable_encoder(users), status_code=200, headers=headers)
+
+# paginated user search, best matches first. pass the returned next_cursor to get the next page.
+# Example curl:
+# curl "http://127.0.0.1:8000/users/search?q=sahil&limit=20"
+@app.get("/users/search")
+async def search_users(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(20, ge=1, le=db.USER_SEARCH_MAX_LIMIT),
+                       cursor: str = Query(None, max_length=500)):
+    try:
+        result = await db.searchForUser(q, limit, cursor)
+    except db.InvalidCursor as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
+    return JSONResponse(content=jsonable_encoder(result), status_code=200)
 
 # endpoint to handle a new post (image + text by the user)
 # does llm rating and stores in the database.
+# with ?mode=job the uploads are stored, a scoring job is queued and 202 + job id is returned right away,
+# poll /posts/jobs/{job_id} (or stream /posts/jobs/{job_id}/events) for the result.
 # Example curl:
 # curl -X POST "http://127.0.0.1:8000/addPost" \
 #      -H "Content-Type: multipart/form-data" \
@@ -114,71 +197,150 @@ def search_user(name: str):
 async def add_post(text_descr: str = Form(...), 
                    latitude: str = Form(...),
                    longitude: str = Form(...),
-                   images_bytes: List[UploadFile] = File(...)):
+                   images_bytes: List[UploadFile] = File(...),
+                   mode: str = Query("sync", pattern="^(sync|job)$")):
     images = []
+    write_task = None
 
     images_dir = ""
-    # images = []
     if len(images_bytes) == 0 and text_descr == "":
         return JSONResponse(content=jsonable_encoder({"message": "no attached images and text description found!"}), status_code=400)
+
+    if mode == "job":
+        if jobs.is_full():
+            return JSONResponse(content=jsonable_encoder({"message": "Too many posts are being scored, try again later"}), status_code=429)
+        mime_types = []
+        if len(images_bytes) != 0:
+            try:
+                images_dir, mime_types = await post_service.store_uploads(images_bytes)
+            except blobs.UploadTooLarge as e:
+                return JSONResponse(content=jsonable_encoder({"message": str(e)}), status_code=413)
+        try:
+            job_id = await jobs.submit(text_descr, latitude, longitude, images_dir, mime_types)
+        except jobs.QueueFull:
+            return JSONResponse(content=jsonable_encoder({"message": "Too many posts are being scored, try again later"}), status_code=429)
+        except Exception as e:
+            print("Error: ", e)
+            return JSONResponse(content=jsonable_encoder({"message": "Error adding the post"}), status_code=500)
+        return JSONResponse(content=jsonable_encoder({"job_id": job_id, "status": "queued"}), status_code=202)
+
     if len(images_bytes) != 0:
-        uuid_number = uuid.uuid4().hex
-        os.makedirs(f"uploads/upload_{uuid_number}", exist_ok=True)
-        ct = 0
-        for image in images_bytes:
-            f = image.file
-            images_dir = f"upload_{uuid_number}"
-            file_path = f"upload_{uuid_number}/{str(ct)}"
-
-            contents = await image.read()
-            
-            async with aiofiles.open(f"uploads/{file_path}", "wb") as out_f:
-                await out_f.write(contents)
-
-            images.append({
-                "file_location": f"uploads/{file_path}",
-                "mime_type": image.content_type
-            })
-
-            ct += 1
-
-    scores_llm = await asyncio.to_thread(backend_llm.get_scores, images, text_descr)
-    scores_vision = await asyncio.to_thread(backend_vision.get_scores_cv,images,text_descr)
-    scores = combine_scores(scores_llm,scores_vision)
-    # ATTENTION!
-    # Google Maps Road API to convert given latitude-longitude to location_id needed here!
-    # This part is pending (TODO!!)
-
-    url = f"https://roads.googleapis.com/v1/snapToRoads?path={latitude},{longitude}&key={GOOGLE_ROADS_API_KEY}"
-    response = requests.get(url=url)
-
-    data = response.json()
-    location_id = data["snappedPoints"][0]["placeId"]
-    
-    newLocation = Location(location_id=location_id,
-                           images_dir=images_dir,
-                           images = ct,
-                           text_descr=text_descr,
-                           surface_damage=scores['surface_damage'],
-                           traffic_safety_risk=scores['traffic_safety_risk'],
-                           ride_discomfort=scores['ride_discomfort'],
-                           waterlogging=scores['waterlogging'],
-                           urgency_for_repair=scores['urgency_for_repair'],
-                           posted_by='Sa12')
-    
-    done = db.addPost(newLocation)
+        try:
+            images_dir, images, write_task = await post_service.ingest_uploads(images_bytes)
+        except blobs.UploadTooLarge as e:
+            return JSONResponse(content=jsonable_encoder({"message": str(e)}), status_code=413)
 
-    if done:
+    try:
+        result = await post_service.score_and_store(images, text_descr, latitude, longitude, images_dir, write_task=write_task)
+    except scoring.ScoringFailed:
+        return JSONResponse(content=jsonable_encoder({"message": "Could not score the post, try again later"}), status_code=503)
+
+    if result['saved']:
         return JSONResponse(content=jsonable_encoder({"message": "Successful!"}), status_code=201)
     else:
         return JSONResponse(content=jsonable_encoder({"message": "Error adding the post"}), status_code=500)
 
+# the photo of a post, by the sha256 in its blob key (posts.images_dir holds blobs/<ab>/<sha256>). with size=thumb
+# or size=medium a downsized webp / avif copy (see image_variants.py), format=auto picks avif when the client
+# accepts it. the bytes behind a url never change, so it is cached for good (strong etag, immutable), and Range
+# requests are answered for resuming / progressive loading.
+# Example curl:
+# curl "http://127.0.0.1:8000/images/3f5a...e9?size=thumb" -H "Accept: image/avif,image/webp" -o thumb.avif
+@app.get("/images/{sha256}")
+async def get_image(sha256: str, request: Request, size: str = Query("original", pattern="^(original|thumb|medium)$"),
+                    format: str = Query("auto", pattern="^(auto|webp|avif)$")):
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        return JSONResponse(content={"message": "not a sha256"}, status_code=400)
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+    key = None
+    if size != "original":
+        fmt = format
+        if fmt == "auto":
+            headers["Vary"] = "Accept"
+            fmt = "avif" if "image/avif" in request.headers.get("accept", "") and "avif" in image_variants.IMAGE_VARIANT_FORMATS else "webp"
+        key = await image_variants.variant(sha256, size, fmt)
+        media_type, etag = image_variants.MIME_TYPES[fmt], f'"{sha256}-{size}.{fmt}"'
+    if key is None:
+        # the original (also when its variants can't be rendered)
+        key, media_type, etag = blobs.blob_key(sha256), None, f'"{sha256}"'
+        if size != "original":
+            headers["Cache-Control"] = IMAGE_FALLBACK_CACHE_CONTROL
+
+    length = await blobs.size(key)
+    if length is None:
+        return JSONResponse(content={"message": "image not found"}, status_code=404)
+    headers["ETag"] = etag
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    if media_type is None:
+        media_type = blobs.sniff_mime_type(b"".join([chunk async for chunk in blobs.stream(key, 0, 15)]))
+
+    start, end, status_code = 0, length - 1, 200
+    byte_range = request.headers.get("range")
+    if byte_range and request.headers.get("if-range", etag) == etag:
+        try:
+            parsed = blobs.parse_range(byte_range, length)
+        except ValueError:
+            parsed = (0, length - 1)
+        if parsed is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+        if parsed != (0, length - 1):
+            start, end = parsed
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(blobs.stream(key, start, end), status_code=status_code, media_type=media_type, headers=headers)
+
+# bulk import of already scored reports (municipal surveys, partner data) from a csv upload, see bulk_ingest.py
+# for the columns. loaded with COPY in batches, the response counts added / rejected rows.
+# Example curl:
+# curl -X POST "http://127.0.0.1:8000/posts/bulk" -F "file=@survey.csv" -F "scored_by=municipal_survey"
+@app.post("/posts/bulk")
+async def bulk_add_posts(file: UploadFile = File(...), scored_by: str = Form("import")):
+    text_file = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    try:
+        result = await bulk_ingest.ingest_csv(text_file, scored_by)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return JSONResponse(content={"message": f"Could not read the csv: {e}"}, status_code=400)
+    finally:
+        text_file.detach()
+    return JSONResponse(content=jsonable_encoder(result), status_code=200 if result["failed_batches"] == 0 else 500)
+
+# status of a scoring job created by /addPost?mode=job
+@app.get("/posts/jobs/{job_id}")
+async def get_post_job(job_id: str):
+    job = await db.getJob(job_id)
+    if job is None:
+        return JSONResponse(content=jsonable_encoder({"message": "Job Not Found!"}), status_code=404)
+    return JSONResponse(content=jsonable_encoder(job), status_code=200)
+
+# same as above but as server-sent events, one event per status/stage change until the job finishes
+@app.get("/posts/jobs/{job_id}/events")
+async def post_job_events(job_id: str):
+    async def events():
+        last = None
+        while True:
+            job = await db.getJob(job_id)
+            if job is None:
+                yield "event: error\ndata: {\"message\": \"Job Not Found!\"}\n\n"
+                return
+            state = (job['status'], job['stage'])
+            if state != last:
+                last = state
+                yield f"data: {json.dumps(jsonable_encoder(job))}\n\n"
+            if job['status'] in ("done", "failed"):
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
  # get a location (if it exists) from the database   
 # Example curl:
 # curl -X GET "http://127.0.0.1:8000/getLocation/location_id" 
 @app.get("/getLocation/{location_id}")
-def get_location(location_id: str):
-    location: Location = db.getLocation(location_id)
+async def get_location(location_id: str):
+    location: Location = await location_cache.get_location(location_id)
     exists = location['location_id'] is not None
 
     if exists:
@@ -193,34 +355,131 @@ def get_location(location_id: str):
 #      -H "Content-Type: application/json" \
 #      -d '{"location_ids": ["loc_id1", "loc_id2", "loc_id3"]}'
 @app.get("/getLocations")
-def get_locations(locationIDsBody: RequestLocationsIDModel):
+async def get_locations(locationIDsBody: RequestLocationsIDModel):
     locationIds = locationIDsBody.location_ids
 
-    locations = db.getLocations(locationIds)
+    locations = await location_cache.get_locations(locationIds)
 
     if len(locations) == 0:
         return JSONResponse(content=jsonable_encoder(locations), status_code=204)
     else:
         return JSONResponse(content=jsonable_encoder(locations), status_code=200)
 
+# bulk lookup, one query per LOCATIONS_CHUNK_SIZE ids instead of two per id. POST with a json body, or GET with
+# the ids in the query (?ids=a&ids=b or ?ids=a,b) for clients/proxies that drop GET bodies.
+# with stream=true the locations are sent as NDJSON (one per line) chunk by chunk as they are read.
+# Example curl:
+# curl -X POST "http://127.0.0.1:8000/locations?stream=true" \
+#      -H "Content-Type: application/json" \
+#      -d '{"location_ids": ["loc_id1", "loc_id2", "loc_id3"]}'
+LOCATIONS_MAX_IDS = int(os.getenv("LOCATIONS_MAX_IDS", "50000"))
+
+async def _ndjson_locations(location_ids: List[str]):
+    try:
+        for start in range(0, len(location_ids), db.LOCATIONS_CHUNK_SIZE):
+            chunk = await location_cache.get_locations(location_ids[start:start + db.LOCATIONS_CHUNK_SIZE])
+            yield "".join(json.dumps(jsonable_encoder(location)) + "\n" for location in chunk)
+    except Exception as e:
+        # the status line is already sent, the client sees a short stream
+        print("Error: ", e)
+
+async def _locations_response(location_ids: List[str], stream: bool):
+    if len(location_ids) > LOCATIONS_MAX_IDS:
+        return JSONResponse(content={"message": f"At most {LOCATIONS_MAX_IDS} ids per request."}, status_code=413)
+    if stream:
+        return StreamingResponse(_ndjson_locations(location_ids), media_type="application/x-ndjson")
+    return JSONResponse(content=jsonable_encoder(await location_cache.get_locations(location_ids)), status_code=200)
+
+@app.post("/locations")
+async def post_locations(locationIDsBody: RequestLocationsIDModel, stream: bool = Query(False)):
+    return await _locations_response(locationIDsBody.location_ids, stream)
+
+@app.get("/locations")
+async def get_locations_by_query(ids: List[str] = Query(...), stream: bool = Query(False)):
+    location_ids = [i for value in ids for i in value.split(",") if i]
+    return await _locations_response(location_ids, stream)
+
+# everything scored inside the visible map region. from zoom BBOX_DETAIL_ZOOM on the single locations, further out
+# (or when there are too many) clusters with their centroid, counts and average RQI / PSI (see tiles.py)
+# Example curl:
+# curl "http://127.0.0.1:8000/locations/bbox?min_lat=25.40&min_lng=81.75&max_lat=25.46&max_lng=81.82&zoom=14"
+@app.get("/locations/bbox")
+async def locations_bbox(min_lat: float = Query(..., ge=-90, le=90), min_lng: float = Query(..., ge=-180, le=180),
+                         max_lat: float = Query(..., ge=-90, le=90), max_lng: float = Query(..., ge=-180, le=180),
+                         zoom: int = Query(..., ge=0, le=22)):
+    if min_lat > max_lat or min_lng > max_lng:
+        return JSONResponse(content={"message": "min_lat/min_lng must be below max_lat/max_lng"}, status_code=400)
+    return await tiles.locations_in_bbox(min_lat, min_lng, max_lat, max_lng, zoom)
+
+# heat-map overlay tile (web mercator z/x/y): the aggregated score cells inside it. cached by the client with
+# the etag, an unchanged tile is a 304 without a body.
+@app.get("/tiles/{z}/{x}/{y}")
+async def heatmap_tile(z: int, x: int, y: int, request: Request):
+    if not 0 <= z <= 22 or not 0 <= x < (1 << z) or not 0 <= y < (1 << z):
+        return JSONResponse(content={"message": "Tile Not Found!"}, status_code=404)
+    content, etag = await tiles.heatmap_tile(z, x, y)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={int(tiles.TILE_REFRESH_SECONDS)}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=content, headers=headers)
+
+# both are cached server side (see places.py)
 @app.get("/api/autocomplete")
 async def api_autocomplete(input_text: str = Query(..., min_length=1)):
-    params = {"input": input_text, "key": GOOGLE_ROADS_API_KEY}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(PLACES_AUTOCOMPLETE_URL, params=params)
-    return response.json()
+    return await places.autocomplete(input_text)
 
 @app.get("/api/place_details")
 async def api_place_details(place_id: str = Query(...)):
-    params = {"place_id": place_id, "key": GOOGLE_ROADS_API_KEY, "fields": "formatted_address,geometry"}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(PLACES_DETAILS_URL, params=params)
-    return response.json()
+    return await places.place_details(place_id)
 
+# the polyline plus per-segment road quality (RQI) / pedestrian safety (PSI) from the scored locations
+# along it, and a summary of the whole route (see location_index.py)
 @app.get("/route")
-async def route(origin: str = Query(...), destination: str = Query(...)):
+async def route(origin: str = Query(...), destination: str = Query(...),
+                profile: str = Query("drive", pattern="^(drive|cycle|walk)$"), safety: float = Query(None, ge=0)):
     try:
-        points = await get_route(origin, destination)
-        return {"polyline": points}
+        # refreshed first, the local routing engine weighs roads by these scores too
+        try:
+            await location_index.refresh_if_stale()
+        except Exception as e:
+            print("Error: ", e)  # route and annotate with what we already have
+        points = await get_route(origin, destination, profile, safety)
+        return {"polyline": points, **location_index.annotate_route(points)}
     except Exception as e:
-        return JSONResponse(content={"error": str(e)}, status_code=500)
\ No newline at end of file
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+# runtime stats of the backend (inference batching etc.), handy while load testing
+@app.get("/metrics")
+def metrics():
+    return {
+        "vision_backend": backend_vision.VISION_BACKEND if backend_vision.remote is None else None,
+        "vision_batcher": backend_vision.batcher.stats(),
+        "vision_remote": backend_vision.remote.stats() if backend_vision.remote is not None else None,
+        "scoring_jobs": jobs.queue_stats(),
+        "score_cache": score_cache.stats(),
+        "blob_storage": blobs.stats(),
+        "image_variants": image_variants.stats(),
+        "geocode": directions.geocode_stats(),
+        "places": places.stats(),
+        "road_index": road_index.stats(),
+        "road_graph": road_graph.stats(),
+        "location_index": location_index.stats(),
+        "location_cache": location_cache.stats(),
+        "score_tiles": tiles.stats(),
+        "database_pool": db.stats(),
+    }
+
+# liveness: the process is up and the event loop answers. never depends on the heavy subsystems.
+@app.get("/health/live")
+def health_live():
+    return {"status": "alive"}
+
+# readiness: only report ready once every subsystem is loaded (and the model warmed up),
+# so that the load balancer only sends scoring traffic to workers that can serve it quickly.
+@app.get("/health/ready")
+def health_ready():
+    subsystems = {name: is_ready() for name, (_, is_ready) in SUBSYSTEMS.items()}
+    ready = all(subsystems.values())
+    content = {"ready": ready, "subsystems": subsystems}
+    if backend_vision.load_error:
+        content["vision_error"] = backend_vision.load_error
+    return JSONResponse(content=content, status_code=200 if ready else 503)
@@ -0,0 +1,76 @@
+import os
+import re
+from dotenv import load_dotenv
+import http_client
+from caching import LRUCache, SingleFlight
+
+load_dotenv()
+
+# places autocomplete / details with server side caching.
+# SearchBar.js asks for suggestions on every keystroke, most of those are prefixes other users (or the same
+# user a second ago) already typed, so answers are cached per normalized input. only the answer to exactly that
+# input is reused: google's matching is fuzzy and ranked, the answer to a prefix doesn't tell what a longer input gets.
+# place details hardly ever change, they are kept for a long time.
+
+API_KEY = os.getenv("GOOGLE_API_KEY", "")
+PLACES_AUTOCOMPLETE_URL = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
+PLACES_DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
+
+AUTOCOMPLETE_CACHE_SIZE = int(os.getenv("AUTOCOMPLETE_CACHE_SIZE", "50000"))
+AUTOCOMPLETE_CACHE_TTL = float(os.getenv("AUTOCOMPLETE_CACHE_TTL", str(6 * 3600)))
+PLACE_DETAILS_CACHE_SIZE = int(os.getenv("PLACE_DETAILS_CACHE_SIZE", "20000"))
+PLACE_DETAILS_CACHE_TTL = float(os.getenv("PLACE_DETAILS_CACHE_TTL", str(30 * 24 * 3600)))
+
+CACHEABLE_STATUSES = ("OK", "ZERO_RESULTS")
+
+autocomplete_cache = LRUCache(AUTOCOMPLETE_CACHE_SIZE, ttl=AUTOCOMPLETE_CACHE_TTL, name="autocomplete")
+details_cache = LRUCache(PLACE_DETAILS_CACHE_SIZE, ttl=PLACE_DETAILS_CACHE_TTL, name="place-details")
+autocomplete_inflight = SingleFlight()
+details_inflight = SingleFlight()
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+async def _autocomplete_upstream(query: str, input_text: str) -> dict:
+    response = await http_client.get(PLACES_AUTOCOMPLETE_URL, params={"input": input_text, "key": API_KEY})
+    data = response.json()
+    if data.get("status") in CACHEABLE_STATUSES:
+        autocomplete_cache.set(query, {"status": data["status"], "predictions": data.get("predictions", [])})
+    return data
+
+
+async def autocomplete(input_text: str) -> dict:
+    query = normalize_query(input_text)
+    if not query:
+        return {"status": "ZERO_RESULTS", "predictions": []}
+
+    cached = autocomplete_cache.get(query)
+    if cached is not None:
+        return cached
+
+    return await autocomplete_inflight.do(query, lambda: _autocomplete_upstream(query, input_text))
+
+
+async def _details_upstream(place_id: str) -> dict:
+    params = {"place_id": place_id, "key": API_KEY, "fields": "formatted_address,geometry"}
+    response = await http_client.get(PLACES_DETAILS_URL, params=params)
+    data = response.json()
+    if data.get("status") == "OK":
+        details_cache.set(place_id, data)
+    return data
+
+
+async def place_details(place_id: str) -> dict:
+    cached = details_cache.get(place_id)
+    if cached is not None:
+        return cached
+    return await details_inflight.do(place_id, lambda: _details_upstream(place_id))
+
+
+def stats() -> dict:
+    return {
+        "autocomplete": dict(autocomplete_cache.stats(), in_flight=autocomplete_inflight.stats()),
+        "place_details": dict(details_cache.stats(), in_flight=details_inflight.stats()),
+    }
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import aiofiles
+from fastapi import UploadFile
+from typing import List, Callable, Awaitable
+import image_pipeline
+import image_variants
+import scoring
+import http_client
+import road_index
+from database.models import Location
+from database import db
+import location_cache
+from storage import blobs
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the whole "new post" flow (store uploads -> score -> find location_id -> save) lives here, so that it
+# can be run both inside the /addPost request and by the background job workers in jobs.py.
+
+GOOGLE_ROADS_API_KEY = os.getenv("GOOGLE_API_KEY", "") #keep naming as google api key for consistnecy
+UPLOADS_DIR = blobs.STORAGE_LOCAL_DIR
+
+
+async def prepare_images(sources: List, mime_types: List[str], hashes: List[str] = None) -> List[dict]:
+    # sources: the image bytes or the paths of files with them
+    hashes = hashes or [None] * len(sources)
+    prepared = await asyncio.gather(*(asyncio.to_thread(image_pipeline.prepare_image, src, h) for src, h in zip(sources, hashes)))
+
+    images = []
+    for src, mime_type, entry in zip(sources, mime_types, prepared):
+        if entry.get("llm_bytes") is None:
+            # pillow couldn't decode it (heic, ...), gemini gets the original bytes
+            entry["llm_bytes"] = await _read_source(src)
+            entry["llm_mime_type"] = mime_type
+        entry["file_location"] = src if isinstance(src, str) else None
+        entry["mime_type"] = mime_type
+        images.append(entry)
+    return images
+
+
+async def _read_source(src) -> bytes:
+    if not isinstance(src, str):
+        return src
+    async with aiofiles.open(src, "rb") as f:
+        return await f.read()
+
+
+async def ingest_uploads(uploads: List[UploadFile]):
+    # the uploads are streamed into spool files (storage/blobs.py) and stored concurrently with scoring, the scorers
+    # only use the decoded in-memory copies from image_pipeline. the caller awaits `write_task` before saving the post.
+    # raises blobs.UploadTooLarge.
+    spooled = await blobs.spool_all(uploads)
+    commit = asyncio.ensure_future(blobs.commit(spooled))
+
+    async def finish():
+        try:
+            await commit
+        finally:
+            blobs.discard(spooled)
+        image_variants.submit([s["sha256"] for s in spooled])
+
+    try:
+        images = await prepare_images([s["path"] for s in spooled], [s["mime_type"] for s in spooled], [s["sha256"] for s in spooled])
+    except BaseException:
+        await asyncio.shield(finish())
+        raise
+    images_dir = blobs.join_keys([s["key"] for s in spooled])
+    return images_dir, images, asyncio.ensure_future(finish())
+
+
+async def store_uploads(uploads: List[UploadFile]):
+    # stores the uploads and waits for it (used by the job mode, where the blobs are the job input)
+    spooled = await blobs.spool_all(uploads)
+    try:
+        await blobs.commit(spooled)
+    finally:
+        blobs.discard(spooled)
+    image_variants.submit([s["sha256"] for s in spooled])
+    return blobs.join_keys([s["key"] for s in spooled]), [s["mime_type"] for s in spooled]
+
+
+def legacy_image_paths(images_dir: str, count: int) -> List[str]:
+    # posts / jobs from before the blob store: uploads/upload_<uuid>/<ct>
+    return [f"{UPLOADS_DIR}/{images_dir}/{ct}" for ct in range(count)]
+
+
+async def load_stored_images(images_dir: str, mime_types: List[str]) -> List[dict]:
+    keys = blobs.split_keys(images_dir)
+    if keys:
+        sources = await asyncio.gather(*(blobs.load(key) for key in keys))
+        return await prepare_images(list(sources), mime_types, [blobs.key_sha256(key) for key in keys])
+    return await prepare_images(legacy_image_paths(images_dir, len(mime_types)), mime_types)
+
+
+SNAP_TO_ROADS_URL = "https://roads.googleapis.com/v1/snapToRoads"
+
+async def snap_to_road(latitude: str, longitude: str) -> str:
+    response = await http_client.get(SNAP_TO_ROADS_URL, params={"path": f"{latitude},{longitude}", "key": GOOGLE_ROADS_API_KEY})
+
+    data = response.json()
+    return data["snappedPoints"][0]["placeId"]
+
+
+def _to_float(value: str):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def resolve_location_id(latitude: str, longitude: str) -> str:
+    # the local road index answers without a network call, google is only asked for
+    # points outside the loaded road network (or when no index is configured)
+    lat, lng = _to_float(latitude), _to_float(longitude)
+    location_id = None
+    if lat is not None and lng is not None:
+        # in a thread, the first call loads the index from disk (seconds) and would block every other request
+        location_id = await asyncio.to_thread(road_index.snap_point, lat, lng)
+    if location_id is not None:
+        return location_id
+    return await snap_to_road(latitude, longitude)
+
+
+async def score_and_store(images: List[dict], text_descr: str, latitude: str, longitude: str, images_dir: str,
+                          progress: Callable[[str], Awaitable[None]] = None, write_task=None) -> dict:
+    # returns {"saved": bool, "location_id": ..., "scores": {...}, "scored_by": [...]}.
+    # raises scoring.ScoringFailed when neither scorer returned anything. `progress` is awaited with the name of each stage.
+    async def stage(name):
+        if progress is not None:
+            await progress(name)
+
+    await stage("scoring")
+    scores, contributors = await scoring.score_post(images, text_descr)
+    if write_task is not None:
+        await write_task
+
+    await stage("locating")
+    location_id = await resolve_location_id(latitude, longitude)
+
+    newLocation = Location(location_id=location_id,
+                           images_dir=images_dir,
+                           images = len(images),
+                           text_descr=text_descr,
+                           surface_damage=scores['surface_damage'],
+                           traffic_safety_risk=scores['traffic_safety_risk'],
+                           ride_discomfort=scores['ride_discomfort'],
+                           waterlogging=scores['waterlogging'],
+                           urgency_for_repair=scores['urgency_for_repair'],
+                           scored_by=",".join(contributors),
+                           latitude=_to_float(latitude),
+                           longitude=_to_float(longitude),
+                           posted_by='Sa12')
+
+    await stage("saving")
+    done = await db.addPost(newLocation)
+    if done:
+        await location_cache.invalidate([location_id])
+
+    return {"saved": done, "location_id": location_id, "scores": scores, "scored_by": contributors}
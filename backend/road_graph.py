@@ -0,0 +1,494 @@
+import argparse
+import heapq
+import os
+import threading
+import numpy as np
+from dotenv import load_dotenv
+import geo
+import road_index
+
+load_dotenv()
+
+# local routing engine over an OSM road graph, with edge costs that combine travel time with the road quality
+# reported by users (location_scores), so routes prefer smoother and safer roads.
+#
+# the graph is built once from an extract into a directory of flat .npy arrays (compressed sparse row adjacency):
+#   python road_graph.py build city.osm graph/ --landmarks 12
+# and loaded with mmap_mode="r", so every api worker on the host shares the same pages instead of a copy each.
+# point the api at it with ROAD_GRAPH_PATH=graph/ (and ROUTING_ENGINE=local to use it for /route).
+#
+# queries run A* with ALT (landmark) lower bounds. the landmark distances are precomputed per profile at build time
+# on pure travel time; quality penalties only make edges more expensive (cost = time * (1 + weight * badness)),
+# so the bounds stay admissible and the routes stay optimal for the penalized costs.
+
+ROAD_GRAPH_PATH = os.getenv("ROAD_GRAPH_PATH")
+# how strongly bad roads are avoided: with 1.0 a road with the worst possible score costs twice its travel time
+ROUTING_SAFETY_WEIGHT = float(os.getenv("ROUTING_SAFETY_WEIGHT", "1.0"))
+# geocoded origins/destinations farther than this from every graph node are treated as outside the graph
+ROUTING_SNAP_MAX_METERS = float(os.getenv("ROUTING_SNAP_MAX_METERS", "500"))
+NODE_CELL_DEGREES = 0.005  # ~550 m, must be larger than ROUTING_SNAP_MAX_METERS
+
+HIGHWAY_CLASSES = [
+    "motorway", "trunk", "primary", "secondary", "tertiary", "unclassified", "residential", "service",
+    "motorway_link", "trunk_link", "primary_link", "secondary_link", "tertiary_link", "living_street",
+    "pedestrian", "track", "road", "footway", "cycleway", "path", "bridleway", "steps",
+]
+CLASS_CODES = {name: i for i, name in enumerate(HIGHWAY_CLASSES)}
+
+# km/h per highway class, a class missing from a profile can't be used by it
+PROFILES = {
+    "drive": {
+        "bit": 1,
+        "oneway": True,
+        "speeds": {"motorway": 100, "trunk": 80, "primary": 60, "secondary": 50, "tertiary": 40, "unclassified": 30,
+                   "residential": 25, "service": 15, "motorway_link": 50, "trunk_link": 40, "primary_link": 40,
+                   "secondary_link": 35, "tertiary_link": 30, "living_street": 10, "road": 30},
+        # which index makes a road "bad" for this profile (see location_index.compute_indices)
+        "index": "rqi",
+    },
+    "cycle": {
+        "bit": 2,
+        "oneway": True,
+        "speeds": {"primary": 16, "secondary": 16, "tertiary": 16, "unclassified": 15, "residential": 15, "service": 12,
+                   "primary_link": 15, "secondary_link": 15, "tertiary_link": 15, "living_street": 12, "road": 15,
+                   "track": 10, "cycleway": 18, "path": 10},
+        "index": "rqi",
+    },
+    "walk": {
+        "bit": 4,
+        "oneway": False,
+        "speeds": {"primary": 5, "secondary": 5, "tertiary": 5, "unclassified": 5, "residential": 5, "service": 5,
+                   "primary_link": 5, "secondary_link": 5, "tertiary_link": 5, "living_street": 5, "road": 5,
+                   "pedestrian": 5, "track": 4.5, "footway": 5, "path": 4.5, "bridleway": 4.5, "steps": 2},
+        "index": "psi",
+    },
+}
+# osm access tags that close a way for a profile
+ACCESS_TAGS = {"drive": "motor_vehicle", "cycle": "bicycle", "walk": "foot"}
+
+GRAPH_ARRAYS = ["node_lat", "node_lng", "indptr", "adj_to", "arc_len", "arc_class", "arc_mask", "arc_seg_key",
+                "seg_key_order", "node_cell_keys", "node_cell_starts", "node_cell_items"]
+
+
+def segment_key(way_ids, seg_nums):
+    # one int64 per road segment, the same segment ids as road_index ("osm:<way>:<n>")
+    return np.asarray(way_ids, dtype=np.int64) * (1 << 20) + np.asarray(seg_nums, dtype=np.int64)
+
+
+def _profile_mask(tags: dict, highway: str) -> int:
+    mask = 0
+    for name, profile in PROFILES.items():
+        if highway in profile["speeds"] and tags.get(ACCESS_TAGS[name]) not in ("no", "private"):
+            mask |= profile["bit"]
+    return mask
+
+
+def _oneway(tags: dict) -> int:
+    # 1 forward only, -1 backward only, 0 both ways
+    value = tags.get("oneway")
+    if value in ("yes", "true", "1") or (value is None and (tags.get("junction") == "roundabout" or tags.get("highway") == "motorway")):
+        return 1
+    if value == "-1":
+        return -1
+    return 0
+
+
+def _arc_time(length, arc_class, speeds: dict):
+    speed_table = np.zeros(len(HIGHWAY_CLASSES), dtype=np.float64)
+    for name, kmh in speeds.items():
+        speed_table[CLASS_CODES[name]] = kmh / 3.6
+    speed = speed_table[arc_class]
+    with np.errstate(divide="ignore"):
+        return np.where(speed > 0, length / speed, np.inf)
+
+
+def _dijkstra_all(indptr, adj_to, weights, source: int):
+    # single source shortest travel times to every node, used for the landmark precomputation
+    try:
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+        n = len(indptr) - 1
+        finite = np.isfinite(weights)
+        rows = np.repeat(np.arange(n), np.diff(indptr))[finite]
+        cols = np.asarray(adj_to)[finite]
+        # zero length arcs would vanish from a sparse matrix, give them a tiny cost
+        costs = np.maximum(weights[finite], 1e-6)
+        # a sparse matrix sums duplicate entries, and overlapping / duplicated osm ways give parallel arcs: keep the
+        # cheapest of them, a sum would overestimate the distances and the ALT bounds wouldn't be admissible anymore
+        order = np.lexsort((cols, rows))
+        rows, cols, costs = rows[order], cols[order], costs[order]
+        first = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])]) if len(rows) else np.zeros(0, dtype=np.int64)
+        costs = np.minimum.reduceat(costs, first) if len(first) else costs
+        matrix = csr_matrix((costs, (rows[first], cols[first])), shape=(n, n))
+        return dijkstra(matrix, indices=source)
+    except ImportError:
+        pass
+
+    dist = np.full(len(indptr) - 1, np.inf)
+    dist[source] = 0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for k in range(indptr[u], indptr[u + 1]):
+            nd = d + weights[k]
+            v = adj_to[k]
+            if nd < dist[v]:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
+
+
+def _reverse(indptr, adj_to, weights):
+    n = len(indptr) - 1
+    sources = np.repeat(np.arange(n), np.diff(indptr))
+    order = np.argsort(adj_to, kind="stable")
+    rev_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(rev_indptr, adj_to + 1, 1)
+    return np.cumsum(rev_indptr), sources[order], weights[order]
+
+
+def _select_landmarks(indptr, adj_to, weights, count: int, seed: int = 0):
+    # farthest point selection: each new landmark is the node farthest (in travel time) from the ones picked so far
+    n = len(indptr) - 1
+    rng = np.random.default_rng(seed)
+    rev = _reverse(indptr, adj_to, weights)
+    landmarks, from_l, to_l = [], [], []
+    nearest = np.full(n, np.inf)
+    current = int(rng.integers(n))
+    for _ in range(count):
+        d_from = _dijkstra_all(indptr, adj_to, weights, current)
+        d_to = _dijkstra_all(*rev, current)
+        landmarks.append(current)
+        from_l.append(d_from)
+        to_l.append(d_to)
+        nearest = np.minimum(nearest, np.where(np.isfinite(d_from), d_from, np.inf))
+        reachable = np.isfinite(nearest)
+        if not reachable.any():
+            break
+        current = int(np.argmax(np.where(reachable, nearest, -1)))
+    # (n, L) layout: one row per node
+    return np.asarray(landmarks), np.stack(from_l, axis=1).astype(np.float32), np.stack(to_l, axis=1).astype(np.float32)
+
+
+def build_graph(ways, out_dir: str, landmarks: int = 12):
+    node_ids = {}
+    lats, lngs = [], []
+    arc_from, arc_to, arc_len, arc_class, arc_mask, arc_way, arc_num = [], [], [], [], [], [], []
+
+    def node(coord):
+        i = node_ids.get(coord)
+        if i is None:
+            i = node_ids[coord] = len(lats)
+            lats.append(coord[0])
+            lngs.append(coord[1])
+        return i
+
+    for way_id, coords, tags in ways:
+        highway = tags.get("highway")
+        if highway not in CLASS_CODES:
+            continue
+        mask = _profile_mask(tags, highway)
+        if mask == 0:
+            continue
+        oneway = _oneway(tags)
+        # profiles that respect oneway lose the direction that is closed
+        oneway_bits = sum(p["bit"] for p in PROFILES.values() if p["oneway"])
+        forward = mask & ~oneway_bits if oneway == -1 else mask
+        backward = mask & ~oneway_bits if oneway == 1 else mask
+
+        for i in range(len(coords) - 1):
+            if coords[i] is None or coords[i + 1] is None:
+                continue
+            u, v = node(coords[i]), node(coords[i + 1])
+            length = float(geo.point_distance(coords[i][0], coords[i][1], coords[i + 1][0], coords[i + 1][1]))
+            for a, b, m in ((u, v, forward), (v, u, backward)):
+                if m:
+                    arc_from.append(a)
+                    arc_to.append(b)
+                    arc_len.append(length)
+                    arc_class.append(CLASS_CODES[highway])
+                    arc_mask.append(m)
+                    arc_way.append(way_id)
+                    arc_num.append(i)
+
+    n = len(lats)
+    arc_from = np.asarray(arc_from, dtype=np.int64)
+    order = np.argsort(arc_from, kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(indptr, arc_from + 1, 1)
+    indptr = np.cumsum(indptr)
+
+    arrays = {
+        "node_lat": np.asarray(lats, dtype=np.float64),
+        "node_lng": np.asarray(lngs, dtype=np.float64),
+        "indptr": indptr,
+        "adj_to": np.asarray(arc_to, dtype=np.int32)[order],
+        "arc_len": np.asarray(arc_len, dtype=np.float32)[order],
+        "arc_class": np.asarray(arc_class, dtype=np.uint8)[order],
+        "arc_mask": np.asarray(arc_mask, dtype=np.uint8)[order],
+        "arc_seg_key": segment_key(np.asarray(arc_way)[order], np.asarray(arc_num)[order]),
+    }
+    arrays["seg_key_order"] = np.argsort(arrays["arc_seg_key"], kind="stable")
+    arrays["node_cell_keys"], arrays["node_cell_starts"], arrays["node_cell_items"] = geo.build_grid(
+        geo.cell_keys(arrays["node_lat"], arrays["node_lng"], NODE_CELL_DEGREES), np.arange(n))
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), array)
+
+    for name, profile in PROFILES.items():
+        allowed = (arrays["arc_mask"] & profile["bit"]) != 0
+        times = np.where(allowed, _arc_time(arrays["arc_len"].astype(np.float64), arrays["arc_class"], profile["speeds"]), np.inf)
+        if landmarks > 0 and allowed.any():
+            ids, lm_from, lm_to = _select_landmarks(indptr, arrays["adj_to"].astype(np.int64), times, landmarks)
+            np.save(os.path.join(out_dir, f"landmarks_{name}.npy"), ids)
+            np.save(os.path.join(out_dir, f"lm_from_{name}.npy"), lm_from)
+            np.save(os.path.join(out_dir, f"lm_to_{name}.npy"), lm_to)
+
+    return n, len(arc_from)
+
+
+class RoadGraph:
+    def __init__(self, path: str):
+        self.path = path
+        for name in GRAPH_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self.landmarks = {}
+        for name in PROFILES:
+            lm_path = os.path.join(path, f"lm_from_{name}.npy")
+            if os.path.exists(lm_path):
+                self.landmarks[name] = (np.load(lm_path, mmap_mode="r"),
+                                        np.load(os.path.join(path, f"lm_to_{name}.npy"), mmap_mode="r"))
+
+        self._times = {}
+        # per-arc badness (0 = fine / unknown, 1 = worst) for each quality index, updated from the location scores
+        self.badness = {"rqi": np.zeros(len(self.adj_to), dtype=np.float32), "psi": np.zeros(len(self.adj_to), dtype=np.float32)}
+        self.penalties_version = None
+
+    @property
+    def nodes(self) -> int:
+        return len(self.node_lat)
+
+    def travel_times(self, profile: str):
+        times = self._times.get(profile)
+        if times is None:
+            spec = PROFILES[profile]
+            allowed = (np.asarray(self.arc_mask) & spec["bit"]) != 0
+            times = np.where(allowed, _arc_time(np.asarray(self.arc_len, dtype=np.float64), self.arc_class, spec["speeds"]), np.inf)
+            self._times[profile] = times
+        return times
+
+    def nearest_node(self, lat: float, lng: float) -> int:
+        lats, lngs = np.asarray([lat], dtype=np.float64), np.asarray([lng], dtype=np.float64)
+        points, nodes = geo.grid_candidates(self.node_cell_keys, self.node_cell_starts, self.node_cell_items, lats, lngs, NODE_CELL_DEGREES)
+        dist = geo.point_distance(lats[points], lngs[points], self.node_lat[nodes], self.node_lng[nodes])
+        best, _ = geo.nearest_per_point(1, points, nodes, dist, ROUTING_SNAP_MAX_METERS)
+        return int(best[0])
+
+    def set_badness(self, segment_keys, rqi, psi):
+        # scores of road segments (keys from segment_key) -> per-arc badness. several scores on one arc: the worst wins
+        keys = np.asarray(segment_keys, dtype=np.int64)
+        sorted_keys = np.asarray(self.arc_seg_key)[self.seg_key_order]
+        lo = np.searchsorted(sorted_keys, keys, side="left")
+        hi = np.searchsorted(sorted_keys, keys, side="right")
+        counts = hi - lo
+        total = int(counts.sum())
+        new = {name: np.zeros(len(self.adj_to), dtype=np.float32) for name in self.badness}
+        if total:
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            arcs = np.asarray(self.seg_key_order)[np.repeat(lo, counts) + within]
+            for name, values in (("rqi", rqi), ("psi", psi)):
+                bad = np.clip((100 - np.asarray(values, dtype=np.float32)) / 100, 0, 1)
+                np.maximum.at(new[name], arcs, np.repeat(bad, counts))
+        self.badness = new
+
+    def route(self, o_lat: float, o_lng: float, d_lat: float, d_lng: float, profile: str = "drive",
+              safety: float = ROUTING_SAFETY_WEIGHT):
+        # list of (lat, lng) along the best route, None when either end is outside the graph or there is no route
+        source, target = self.nearest_node(o_lat, o_lng), self.nearest_node(d_lat, d_lng)
+        if source < 0 or target < 0:
+            return None
+
+        # the penalized costs and the bounds are only computed for the arcs and nodes the search reaches, a short
+        # route touches a tiny part of the graph
+        badness = self.badness[PROFILES[profile]["index"]] if safety > 0 else None
+        heuristic = self._heuristic(profile, target)
+        path = _astar(self.indptr, self.adj_to, self.travel_times(profile), badness, safety, heuristic, source, target)
+        if path is None:
+            return None
+        return list(zip(np.asarray(self.node_lat)[path].tolist(), np.asarray(self.node_lng)[path].tolist()))
+
+    def _heuristic(self, profile: str, target: int):
+        # node -> ALT lower bound of the remaining travel time, by the triangle inequality over the landmarks:
+        #   d(v, t) >= d(L, t) - d(L, v)   and   d(v, t) >= d(v, L) - d(t, L)
+        # bounds involving an unreachable landmark (inf) are skipped
+        landmarks = self.landmarks.get(profile)
+        if landmarks is None:
+            return None
+        lm_from, lm_to = landmarks
+        from_target, to_target = lm_from[target].tolist(), lm_to[target].tolist()
+
+        def bound(v: int) -> float:
+            best = 0.0
+            for ft, fv, tv, tt in zip(from_target, lm_from[v].tolist(), lm_to[v].tolist(), to_target):
+                for b in (ft - fv, tv - tt):
+                    if best < b < np.inf:
+                        best = b
+            return best
+
+        return bound
+
+
+def _astar(indptr, adj_to, times, badness, safety: float, heuristic, source: int, target: int):
+    dist = {source: 0.0}
+    parent = {source: -1}
+    bounds = {}
+    closed = set()
+    heap = [(0.0, 0.0, source)]
+    while heap:
+        _, g, u = heapq.heappop(heap)
+        if u == target:
+            break
+        if u in closed:
+            continue
+        closed.add(u)
+        a, b = int(indptr[u]), int(indptr[u + 1])
+        costs = times[a:b].tolist()
+        if badness is not None:
+            costs = [t * (1 + safety * bad) for t, bad in zip(costs, badness[a:b].tolist())]
+        for v, c in zip(adj_to[a:b].tolist(), costs):
+            if c == np.inf or v in closed:
+                continue
+            ng = g + c
+            if ng < dist.get(v, np.inf):
+                dist[v] = ng
+                parent[v] = u
+                h = 0.0
+                if heuristic is not None:
+                    h = bounds.get(v)
+                    if h is None:
+                        h = bounds[v] = heuristic(v)
+                heapq.heappush(heap, (ng + h, ng, v))
+    else:
+        return None
+
+    path = [target]
+    while parent[path[-1]] != -1:
+        path.append(parent[path[-1]])
+    path.reverse()
+    return np.asarray(path, dtype=np.int64)
+
+
+# the graph used by the api, loaded on first use from ROAD_GRAPH_PATH (None when not configured)
+_graph = None
+_graph_lock = threading.Lock()
+_graph_loaded = False
+local_routes = 0
+misses = 0
+
+
+def get_graph():
+    global _graph, _graph_loaded
+    if not _graph_loaded:
+        with _graph_lock:
+            if not _graph_loaded:
+                if ROAD_GRAPH_PATH:
+                    try:
+                        _graph = RoadGraph(ROAD_GRAPH_PATH)
+                        print(f"Road graph loaded: {_graph.nodes} nodes, {len(_graph.adj_to)} arcs")
+                    except Exception as e:
+                        print(f"[ERROR] Could not load road graph {ROAD_GRAPH_PATH}: {e}")
+                _graph_loaded = True
+    return _graph
+
+
+def is_ready() -> bool:
+    return _graph_loaded
+
+
+def update_penalties(locations) -> None:
+    # refresh the per-arc badness from a location_index.LocationIndex when it changed since the last call. pass a
+    # snapshot when running off the event loop, the live index is updated in place by the refreshes.
+    # locations snapped by road_index already carry "osm:<way>:<n>" ids, the others are snapped here by coordinates.
+    graph = get_graph()
+    if graph is None or graph.penalties_version == locations.version or len(locations) == 0:
+        return
+    import location_index
+
+    ids = locations.ids
+    way_ids = np.full(len(ids), -1, dtype=np.int64)
+    seg_nums = np.zeros(len(ids), dtype=np.int64)
+    unsnapped = []
+    for i, location_id in enumerate(ids):
+        parts = location_id.split(":") if location_id.startswith("osm:") else None
+        if parts is not None and len(parts) == 3:
+            way_ids[i], seg_nums[i] = int(parts[1]), int(parts[2])
+        else:
+            unsnapped.append(i)
+
+    index = road_index.get_index()
+    if unsnapped and index is not None:
+        unsnapped = np.asarray(unsnapped)
+        segs, _ = index.snap_many(locations.lat[unsnapped], locations.lng[unsnapped])
+        found = segs >= 0
+        way_ids[unsnapped[found]] = index.way_ids[segs[found]]
+        seg_nums[unsnapped[found]] = index.seg_nums[segs[found]]
+
+    known = way_ids >= 0
+    rqi, psi = location_index.compute_indices(locations.scores[known])
+    graph.set_badness(segment_key(way_ids[known], seg_nums[known]), rqi, psi)
+    graph.penalties_version = locations.version
+
+
+def route(o_lat: float, o_lng: float, d_lat: float, d_lng: float, profile: str = "drive", safety: float = None):
+    global local_routes, misses
+    graph = get_graph()
+    if graph is None:
+        return None
+    points = graph.route(o_lat, o_lng, d_lat, d_lng, profile, ROUTING_SAFETY_WEIGHT if safety is None else safety)
+    if points is None:
+        misses += 1
+    else:
+        local_routes += 1
+    return points
+
+
+def stats() -> dict:
+    graph = _graph
+    return {
+        "nodes": graph.nodes if graph is not None else 0,
+        "arcs": len(graph.adj_to) if graph is not None else 0,
+        "landmark_profiles": sorted(graph.landmarks) if graph is not None else [],
+        "local_routes": local_routes,
+        "misses": misses,
+    }
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="local safety-weighted routing graph")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="build the graph from an .osm / .geojson road network")
+    build.add_argument("source")
+    build.add_argument("output")
+    build.add_argument("--landmarks", type=int, default=12, help="ALT landmarks per profile (0 to skip)")
+    query = sub.add_parser("route", help="route between two lat,lng points with a built graph")
+    query.add_argument("graph")
+    query.add_argument("origin")
+    query.add_argument("destination")
+    query.add_argument("--profile", choices=list(PROFILES), default="drive")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        nodes, arcs = build_graph(road_index.iter_osm_ways(args.source), args.output, args.landmarks)
+        print(f"{nodes} nodes, {arcs} arcs -> {args.output}")
+    else:
+        graph = RoadGraph(args.graph)
+        (o_lat, o_lng), (d_lat, d_lng) = (tuple(float(v) for v in p.split(",")) for p in (args.origin, args.destination))
+        started = time.perf_counter()
+        points = graph.route(o_lat, o_lng, d_lat, d_lng, args.profile)
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"{len(points) if points else 0} points in {elapsed:.1f} ms")
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+import numpy as np
+from dotenv import load_dotenv
+import geo
+
+load_dotenv()
+
+# local snap-to-road index.
+# the road network (an OSM extract, .osm xml or a geojson of LineStrings) is split into straight segments
+# (consecutive node pairs of a way) and the segments are bucketed in a uniform lat/lng grid. snapping a point
+# only looks at the 3x3 grid cells around it, and a whole batch of points is snapped with numpy in one go.
+# a segment's id is "osm:<way id>:<segment number within the way>", which stays the same for a given extract,
+# and is used as the location_id of posts. points farther than ROAD_SNAP_MAX_METERS from every loaded segment
+# (outside the loaded network) return None and the caller falls back to google's snapToRoads.
+#
+# build the index once from an extract:
+#   python road_index.py build city.osm roads.npz
+# and point the api at it with ROAD_INDEX_PATH=roads.npz
+
+ROAD_INDEX_PATH = os.getenv("ROAD_INDEX_PATH")
+ROAD_SNAP_MAX_METERS = float(os.getenv("ROAD_SNAP_MAX_METERS", "30"))
+
+# grid cells must be at least as large as the max snap distance so the 3x3 neighbourhood covers it
+DEFAULT_CELL_DEGREES = 0.002  # ~220 m of latitude
+
+# osm highway values that are roads / paths people travel on (not e.g. proposed or abandoned ones)
+ROAD_HIGHWAY_TYPES = {
+    "motorway", "trunk", "primary", "secondary", "tertiary", "unclassified", "residential", "service",
+    "motorway_link", "trunk_link", "primary_link", "secondary_link", "tertiary_link", "living_street",
+    "pedestrian", "track", "road", "footway", "cycleway", "path", "bridleway", "steps",
+}
+
+
+def iter_osm_ways(path: str):
+    # yields (way_id, [(lat, lng), ...], tags) for every road way of the file.
+    # a None in the coordinates is a break (multi-line geojson features), there is no segment across it
+    if path.endswith(".geojson") or path.endswith(".json"):
+        yield from _iter_geojson_ways(path)
+        return
+
+    nodes = {}
+    for _, elem in ET.iterparse(path, events=("end",)):
+        if elem.tag == "node":
+            nodes[int(elem.get("id"))] = (float(elem.get("lat")), float(elem.get("lon")))
+            elem.clear()
+        elif elem.tag == "way":
+            tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+            if tags.get("highway") in ROAD_HIGHWAY_TYPES:
+                coords = [nodes[int(nd.get("ref"))] for nd in elem.iter("nd") if int(nd.get("ref")) in nodes]
+                if len(coords) >= 2:
+                    yield int(elem.get("id")), coords, tags
+            elem.clear()
+
+
+def _iter_geojson_ways(path: str):
+    with open(path) as f:
+        data = json.load(f)
+    for n, feature in enumerate(data.get("features", [])):
+        geometry = feature.get("geometry") or {}
+        props = feature.get("properties") or {}
+        way_id = int(props.get("osm_id", props.get("id", n)))
+        if geometry.get("type") == "LineString":
+            lines = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiLineString":
+            lines = geometry["coordinates"]
+        else:
+            continue
+        # geojson is [lng, lat]. several lines of one feature are numbered one after another,
+        # with a None between them so no segment joins the end of one line to the start of the next
+        coords = []
+        for line in lines:
+            if coords:
+                coords.append(None)
+            coords.extend((lat, lng) for lng, lat, *_ in line)
+        if len(coords) >= 2:
+            yield way_id, coords, props
+
+
+class RoadIndex:
+    def __init__(self, a, b, way_ids, seg_nums, cell_keys, cell_starts, cell_segments, cell_size):
+        self.a = a                      # (n, 2) lat/lng of segment starts
+        self.b = b                      # (n, 2) lat/lng of segment ends
+        self.way_ids = way_ids          # (n,) osm way id of each segment
+        self.seg_nums = seg_nums        # (n,) number of the segment within its way
+        self.cell_keys = cell_keys      # (c,) sorted grid cell keys
+        self.cell_starts = cell_starts  # (c + 1,) offsets into cell_segments
+        self.cell_segments = cell_segments
+        self.cell_size = float(cell_size)
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    @classmethod
+    def build(cls, ways, cell_size: float = DEFAULT_CELL_DEGREES):
+        a, b, way_ids, seg_nums = [], [], [], []
+        for way_id, coords, _ in ways:
+            for i in range(len(coords) - 1):
+                if coords[i] is None or coords[i + 1] is None:
+                    continue
+                a.append(coords[i])
+                b.append(coords[i + 1])
+                way_ids.append(way_id)
+                seg_nums.append(i)
+
+        a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+        b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+
+        # every segment goes in each cell its bounding box touches
+        lo = np.floor(np.minimum(a, b) / cell_size).astype(np.int64)
+        hi = np.floor(np.maximum(a, b) / cell_size).astype(np.int64)
+        keys, segs = [], []
+        for i in range(len(a)):
+            for cy in range(lo[i, 0], hi[i, 0] + 1):
+                for cx in range(lo[i, 1], hi[i, 1] + 1):
+                    keys.append(geo.cell_key(cy, cx))
+                    segs.append(i)
+        cell_keys, cell_starts, cell_segments = geo.build_grid(keys, segs)
+
+        return cls(a, b, np.asarray(way_ids, dtype=np.int64), np.asarray(seg_nums, dtype=np.int32),
+                   cell_keys, cell_starts, cell_segments, cell_size)
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        return cls(data["a"], data["b"], data["way_ids"], data["seg_nums"], data["cell_keys"],
+                   data["cell_starts"], data["cell_segments"], float(data["cell_size"]))
+
+    def save(self, path: str):
+        np.savez(path, a=self.a, b=self.b, way_ids=self.way_ids, seg_nums=self.seg_nums, cell_keys=self.cell_keys,
+                 cell_starts=self.cell_starts, cell_segments=self.cell_segments, cell_size=self.cell_size)
+
+    def segment_id(self, i: int) -> str:
+        return f"osm:{self.way_ids[i]}:{self.seg_nums[i]}"
+
+    def snap_many(self, lats, lngs, max_distance: float = ROAD_SNAP_MAX_METERS):
+        # returns (segment index per point, -1 where nothing is in range; distance in meters per point)
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lngs = np.asarray(lngs, dtype=np.float64).ravel()
+        pair_points, pair_segs = geo.grid_candidates(self.cell_keys, self.cell_starts, self.cell_segments, lats, lngs, self.cell_size)
+        dist = geo.point_segment_distance(lats[pair_points], lngs[pair_points], self.a[pair_segs, 0], self.a[pair_segs, 1],
+                                          self.b[pair_segs, 0], self.b[pair_segs, 1])
+        return geo.nearest_per_point(len(lats), pair_points, pair_segs, dist, max_distance)
+
+    def snap_ids(self, lats, lngs, max_distance: float = ROAD_SNAP_MAX_METERS):
+        segs, _ = self.snap_many(lats, lngs, max_distance)
+        return [self.segment_id(s) if s >= 0 else None for s in segs]
+
+
+# the index used by the api, loaded on first use from ROAD_INDEX_PATH (None when not configured)
+_index = None
+_index_lock = threading.Lock()
+_index_loaded = False
+local_snaps = 0
+misses = 0
+
+
+def get_index():
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                if ROAD_INDEX_PATH:
+                    try:
+                        _index = RoadIndex.load(ROAD_INDEX_PATH)
+                        print(f"Road index loaded: {len(_index)} segments")
+                    except Exception as e:
+                        print(f"[ERROR] Could not load road index {ROAD_INDEX_PATH}: {e}")
+                _index_loaded = True
+    return _index
+
+
+def is_ready() -> bool:
+    # not configured counts as ready, snapping then simply goes to google
+    return _index_loaded
+
+
+def snap_point(lat: float, lng: float):
+    # segment id of the closest road, None if there is no index or the point is outside the loaded network
+    global local_snaps, misses
+    index = get_index()
+    if index is None:
+        return None
+    segment_id = index.snap_ids([lat], [lng])[0]
+    if segment_id is None:
+        misses += 1
+    else:
+        local_snaps += 1
+    return segment_id
+
+
+def stats() -> dict:
+    index = _index
+    return {"segments": len(index) if index is not None else 0, "local_snaps": local_snaps, "misses": misses}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local snap-to-road index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="build an index from an .osm / .geojson road network")
+    build.add_argument("source")
+    build.add_argument("output")
+    build.add_argument("--cell", type=float, default=DEFAULT_CELL_DEGREES, help="grid cell size in degrees")
+    snap = sub.add_parser("snap", help="snap lat,lng points with a built index")
+    snap.add_argument("index")
+    snap.add_argument("points", nargs="+", help="lat,lng")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = RoadIndex.build(iter_osm_ways(args.source), args.cell)
+        index.save(args.output)
+        print(f"{len(index)} segments, {len(index.cell_keys)} grid cells -> {args.output}")
+    else:
+        index = RoadIndex.load(args.index)
+        lats, lngs = zip(*(tuple(float(v) for v in p.split(",")) for p in args.points))
+        segs, dists = index.snap_many(lats, lngs)
+        for point, s, d in zip(args.points, segs, dists):
+            print(point, index.segment_id(s) if s >= 0 else None, f"{d:.1f} m")
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import threading
+from typing import List
+from caching import LRUCache, MISSING
+from database import db
+
+# cache of scoring results keyed by the content hash (sha256) of the uploaded image bytes, so a photo that
+# is submitted again (user resubmits, mobile client retries) doesn't pay for another gemini call or ssd run.
+#   llm:    gemini model + prompt version, sha256 of every image of the post (in order) + normalized text
+#           description -> llm scores
+#   vision: vision backend + model file, sha256 of one image -> its detections
+# the model / prompt identity is part of the key, so a new model or prompt doesn't get the old one's answers.
+# the in-process tier is an LRU; with SCORE_CACHE_PERSIST=1 entries are also kept in the score_cache table
+# so that every api worker shares them.
+
+SCORE_CACHE_SIZE = int(os.getenv("SCORE_CACHE_SIZE", "10000"))
+SCORE_CACHE_PERSIST = os.getenv("SCORE_CACHE_PERSIST", "0") == "1"
+
+NAMESPACES = ("llm", "vision")
+_caches = {ns: LRUCache(SCORE_CACHE_SIZE, name=f"score-cache-{ns}") for ns in NAMESPACES}
+
+_counters_lock = threading.Lock()
+_db_hits = {ns: 0 for ns in NAMESPACES}
+
+
+def content_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def normalize_text(text: str) -> str:
+    return " ".join((text or "").lower().split())
+
+
+def llm_key(images: List[dict], text_descr: str, version: str):
+    hashes = [img.get("sha256") for img in images]
+    if any(h is None for h in hashes):
+        return None
+    return content_hash((version + "\n" + "|".join(hashes) + "\n" + normalize_text(text_descr)).encode())
+
+
+def vision_key(sha256: str, model: str):
+    if sha256 is None or model is None:
+        return None
+    return content_hash((model + "\n" + sha256).encode())
+
+
+# blocking when the persistent tier is enabled (it waits for the db on the event loop), call it from a thread
+def get(ns: str, key: str):
+    value = _caches[ns].get(key, MISSING)
+    if value is not MISSING:
+        return value
+    if SCORE_CACHE_PERSIST:
+        try:
+            value = db.run_sync(db.getCachedScore(f"{ns}:{key}"))
+        except Exception as e:
+            print("Error: ", e)
+            value = None
+        if value is not None:
+            with _counters_lock:
+                _db_hits[ns] += 1
+            _caches[ns].set(key, value)
+            return value
+    return None
+
+
+def put(ns: str, key: str, value):
+    _caches[ns].set(key, value)
+    if SCORE_CACHE_PERSIST:
+        try:
+            db.run_sync(db.setCachedScore(f"{ns}:{key}", value))
+        except Exception as e:
+            print("Error: ", e)
+
+
+def stats() -> dict:
+    result = {"persistent": SCORE_CACHE_PERSIST}
+    with _counters_lock:
+        for ns in NAMESPACES:
+            result[ns] = dict(_caches[ns].stats(), db_hits=_db_hits[ns])
+    return result
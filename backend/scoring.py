@@ -0,0 +1,103 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import backend_llm
+import backend_vision
+import score_cache
+
+# runs the llm (gemini) and vision (ssd) scorers concurrently, each with its own deadline.
+# if one of them times out or errors, the post is scored with whatever the other one returned,
+# so a gemini outage doesn't stall ingestion and the latency is max(llm, vision) instead of llm + vision.
+
+LLM_SCORE_TIMEOUT = float(os.getenv("LLM_SCORE_TIMEOUT", "20"))
+VISION_SCORE_TIMEOUT = float(os.getenv("VISION_SCORE_TIMEOUT", "10"))
+# each scorer runs in its own bounded pool instead of the default executor: a call that timed out can't be
+# interrupted, during a gemini stall those would otherwise fill the shared pool and everything else using
+# asyncio.to_thread (the db's run_sync, image decoding) would queue behind them. the deadline is also passed
+# to the scorer itself, so the abandoned calls end soon after it.
+LLM_SCORE_THREADS = int(os.getenv("LLM_SCORE_THREADS", "16"))
+VISION_SCORE_THREADS = int(os.getenv("VISION_SCORE_THREADS", "8"))
+
+# relative weight of each scorer in the combined score, renormalized over the scorers that actually returned
+LLM_SCORE_WEIGHT = float(os.getenv("LLM_SCORE_WEIGHT", "0.5"))
+VISION_SCORE_WEIGHT = float(os.getenv("VISION_SCORE_WEIGHT", "0.5"))
+
+SCORE_KEYS = ["surface_damage", "traffic_safety_risk", "ride_discomfort", "waterlogging", "urgency_for_repair"]
+
+
+class ScoringFailed(Exception):
+    pass
+
+
+_executors = {
+    "llm": ThreadPoolExecutor(LLM_SCORE_THREADS, thread_name_prefix="llm-scorer"),
+    "vision": ThreadPoolExecutor(VISION_SCORE_THREADS, thread_name_prefix="vision-scorer"),
+}
+
+
+def cached_llm_scores(images: List[dict], text_descr: str, timeout: float = None) -> dict:
+    # same photos + same description -> same gemini answer, don't pay for it twice
+    key = score_cache.llm_key(images, text_descr, backend_llm.CACHE_VERSION)
+    if key is not None:
+        scores = score_cache.get("llm", key)
+        if scores is not None:
+            return scores
+
+    scores = backend_llm.get_scores(images, text_descr, timeout)
+    if key is not None and isinstance(scores, dict):
+        score_cache.put("llm", key, scores)
+    return scores
+
+
+async def _run_scorer(name: str, fn, timeout: float, images: List[dict], text_descr: str):
+    try:
+        # a call still waiting for a thread is dropped on timeout, a running one can't be interrupted: we stop
+        # waiting for it and it ends at its own deadline
+        call = asyncio.get_running_loop().run_in_executor(_executors[name], fn, images, text_descr, timeout)
+        scores = await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        print(f"[ERROR] {name} scorer timed out after {timeout}s")
+        return None
+    except Exception as e:
+        print(f"[ERROR] {name} scorer failed: {e}")
+        return None
+
+    if not isinstance(scores, dict):
+        print(f"[ERROR] {name} scorer returned {type(scores).__name__} instead of a dict")
+        return None
+    return scores
+
+
+def combine_scores(results: dict, weights: dict) -> dict:
+    # weighted average per category over the scorers that have a numeric value for it
+    scores = {}
+    for key in SCORE_KEYS:
+        total = weight_sum = 0
+        for name, result in results.items():
+            value = result.get(key)
+            if isinstance(value, (int, float)):
+                total += weights[name] * value
+                weight_sum += weights[name]
+        scores[key] = total / weight_sum if weight_sum else 0
+
+    return scores
+
+
+async def score_post(images: List[dict], text_descr: str):
+    # returns (scores, contributors), contributors being the names of the scorers that were used
+    scorers = {"llm": (cached_llm_scores, LLM_SCORE_TIMEOUT)}
+    if len(images) != 0:
+        # with no images the detector has nothing to look at, its all-zero scores would only dilute the llm's
+        scorers["vision"] = (backend_vision.get_scores_cv, VISION_SCORE_TIMEOUT)
+    weights = {"llm": LLM_SCORE_WEIGHT, "vision": VISION_SCORE_WEIGHT}
+
+    names = list(scorers.keys())
+    outputs = await asyncio.gather(*(_run_scorer(name, fn, timeout, images, text_descr) for name, (fn, timeout) in scorers.items()))
+    results = {name: output for name, output in zip(names, outputs) if output is not None}
+
+    if len(results) == 0:
+        raise ScoringFailed("no scorer returned a result")
+
+    contributors = sorted(results.keys())
+    return combine_scores(results, weights), contributors
@@ -1,6 +1,7 @@
 -- sql file to setup the database with all the tables and the schema as planned. Refer: https://www.notion.so/PathFinder-27be411adede80d2a368ca2e30917884
 -- run it inside psql shell using: \i /path/to/your/script.sql 
 -- like this one: \i D:/Programming/Projects/PathFinder/backend/setup.sql
+-- a database created from an older version of this file: run the new files of database/migrations/ in order instead
 
 CREATE TABLE users (
 id TEXT PRIMARY KEY,
@@ -9,11 +10,21 @@ reputation INT DEFAULT 0,
 created_at TIMESTAMP DEFAULT now()
 );
 
+-- user search (db.searchForUser): trigram index for word similarity ordering, prefix index for short queries
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX users_name_trgm_idx ON users USING gist (name gist_trgm_ops);
+CREATE INDEX users_name_prefix_idx ON users ((lower(name) COLLATE "C"), id);
+
 CREATE TABLE location (
 id TEXT PRIMARY KEY,
-posts SMALLINT
+posts INT, -- SMALLINT overflowed at 32767 posts in bulk imports
+lat DOUBLE PRECISION, -- coordinates of the first post at this location
+lng DOUBLE PRECISION,
+updated_at TIMESTAMP DEFAULT now() -- last time a post changed the scores, for incremental refreshes
 );
 
+CREATE INDEX location_updated_at_idx ON location (updated_at);
+
 CREATE TABLE posts (
 id BIGSERIAL PRIMARY KEY,
 posted_by TEXT REFERENCES users (id),
@@ -26,6 +37,7 @@ traffic_safety_risk SMALLINT,
 ride_discomfort SMALLINT,
 waterlogging SMALLINT,
 urgency_for_repair SMALLINT,
+scored_by TEXT, -- which scorers contributed to the scores, e.g. 'llm,vision'
 created_at TIMESTAMP DEFAULT now()
 );
 
@@ -36,4 +48,89 @@ traffic_safety_risk FLOAT,
 ride_discomfort FLOAT,
 waterlogging FLOAT,
 urgency_for_repair FLOAT
-);
\ No newline at end of file
+);
+
+-- background scoring jobs for /addPost?mode=job (status: queued, running, done, failed)
+CREATE TABLE scoring_jobs (
+id TEXT PRIMARY KEY,
+status TEXT NOT NULL DEFAULT 'queued',
+stage TEXT,
+text_descr TEXT,
+latitude TEXT,
+longitude TEXT,
+images_dir TEXT,
+mime_types TEXT[],
+result JSONB,
+error TEXT,
+attempts SMALLINT DEFAULT 0,
+created_at TIMESTAMP DEFAULT now(),
+updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX scoring_jobs_queued_idx ON scoring_jobs (created_at) WHERE status = 'queued';
+
+-- scoring results keyed by image content hash, shared by all api workers when SCORE_CACHE_PERSIST=1
+CREATE TABLE score_cache (
+key TEXT PRIMARY KEY,
+value JSONB NOT NULL,
+created_at TIMESTAMP DEFAULT now()
+);
+
+-- web mercator (slippy map) tile of a coordinate at zoom z, and the west / north edge of a tile
+CREATE FUNCTION tile_x(lng DOUBLE PRECISION, z INT) RETURNS INT AS
+$$ SELECT least(floor((lng + 180) / 360 * (1 << z)), (1 << z) - 1)::int $$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE FUNCTION tile_y(lat DOUBLE PRECISION, z INT) RETURNS INT AS
+$$ SELECT least(greatest(floor((1 - ln(tan(radians(r)) + 1 / cos(radians(r))) / pi()) / 2 * (1 << z)), 0), (1 << z) - 1)::int
+   FROM (SELECT greatest(least(lat, 85.0511), -85.0511) AS r) c $$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE FUNCTION tile_lng(x INT, z INT) RETURNS DOUBLE PRECISION AS
+$$ SELECT x::float8 / (1 << z) * 360 - 180 $$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE FUNCTION tile_lat(y INT, z INT) RETURNS DOUBLE PRECISION AS
+$$ SELECT degrees(atan(sinh(pi() * (1 - 2 * y::float8 / (1 << z))))) $$ LANGUAGE sql IMMUTABLE STRICT;
+
+-- spatial index for viewport (bbox) queries: point(lng, lat) <@ box(...)
+CREATE INDEX location_point_idx ON location USING gist (point(lng, lat)) WHERE lat IS NOT NULL;
+
+-- locations whose scores changed since the tile pyramid was last refreshed (see tiles.py)
+CREATE TABLE location_dirty (
+location_id TEXT PRIMARY KEY
+);
+
+-- pyramid of aggregated scores per map tile (zoom z, tile x / y), for the heat-map overlay and the
+-- low zoom clusters of /locations/bbox. the score columns are sums of the locations' averaged scores.
+CREATE SEQUENCE score_tiles_version_seq;
+
+CREATE TABLE score_tiles (
+z SMALLINT,
+x INT,
+y INT,
+locations INT,
+posts INT,
+sum_lat DOUBLE PRECISION,
+sum_lng DOUBLE PRECISION,
+surface_damage FLOAT,
+traffic_safety_risk FLOAT,
+ride_discomfort FLOAT,
+waterlogging FLOAT,
+urgency_for_repair FLOAT,
+version BIGINT, -- from score_tiles_version_seq, changes every time the tile does (used for ETags)
+updated_at TIMESTAMP DEFAULT now(),
+PRIMARY KEY (z, x, y)
+);
+
+-- generation of cached data per kind ('locations'), bumped by a process that changes a lot of it at once. the api
+-- workers poll it to drop their in-process copies (see location_cache.py)
+CREATE TABLE cache_generation (
+name TEXT PRIMARY KEY,
+generation BIGINT NOT NULL DEFAULT 0
+);
+
+-- ids invalidated in cached data, an append-only log the api workers read every few seconds to drop just those
+-- entries (see location_cache.py). big invalidations bump cache_generation instead. old rows are pruned.
+CREATE TABLE cache_invalidation (
+id BIGSERIAL PRIMARY KEY,
+name TEXT NOT NULL,
+key TEXT NOT NULL,
+created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX cache_invalidation_created_at_idx ON cache_invalidation (name, created_at);
@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# local stand-in for the gemini generateContent api, enough for backend_llm.get_scores: it answers every prompt
+# with the five road scores as a ```json block, like the real model does. the scores are fake but deterministic
+# (same request body -> same scores), so the llm path of /addPost can be load tested offline and for free.
+#
+# run it with: python -m standins.fake_gemini --port 9300
+# and point the backend at it with GEMINI_BASE_URL=http://127.0.0.1:9300 (GEMINI_API_KEY can be anything)
+#
+# STANDIN_LATENCY_MS / STANDIN_JITTER_MS / STANDIN_ERROR_RATE as in standins/google_api.py. gemini is slow,
+# something like STANDIN_LATENCY_MS=1500 STANDIN_JITTER_MS=1000 is closer to the real thing than 0.
+
+STANDIN_LATENCY_MS = float(os.getenv("STANDIN_LATENCY_MS", "0"))
+STANDIN_JITTER_MS = float(os.getenv("STANDIN_JITTER_MS", "0"))
+STANDIN_ERROR_RATE = float(os.getenv("STANDIN_ERROR_RATE", "0"))
+
+SCORE_KEYS = ["surface_damage", "traffic_safety_risk", "ride_discomfort", "waterlogging", "urgency_for_repair"]
+
+app = FastAPI()
+calls = 0
+
+
+@app.middleware("http")
+async def latency_and_errors(request: Request, call_next):
+    delay = STANDIN_LATENCY_MS + random.uniform(0, STANDIN_JITTER_MS)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if STANDIN_ERROR_RATE > 0 and random.random() < STANDIN_ERROR_RATE:
+        return JSONResponse(content={"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}},
+                            status_code=503)
+    return await call_next(request)
+
+
+@app.post("/{version}/models/{model}:generateContent")
+async def generate_content(version: str, model: str, request: Request):
+    global calls
+    body = await request.body()
+    calls += 1
+    digest = hashlib.sha256(body).digest()
+    scores = {key: digest[i] * 100 // 255 for i, key in enumerate(SCORE_KEYS)}
+    text = "```json\n" + json.dumps(scores, indent=4) + "\n```"
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": {"promptTokenCount": len(body) // 4, "candidatesTokenCount": len(text) // 4,
+                          "totalTokenCount": (len(body) + len(text)) // 4},
+        "modelVersion": model,
+    }
+
+
+@app.get("/stats")
+def stats():
+    return {"calls": calls}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="local stand-in for the gemini api")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9300)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import fnmatch
+import time
+
+# tiny in-memory stand-in for redis, enough of the protocol (RESP2, and RESP3 after HELLO 3) for the shared caches
+# to run against it in tests and load tests without a real redis: PING, GET, SET (EX/PX/NX/XX), MGET, MSET, DEL, EXISTS, EXPIRE, TTL,
+# KEYS, FLUSHALL, DBSIZE, INFO, SELECT, CLIENT, HELLO and MULTI/EXEC pipelines. single process, nothing is persisted.
+#
+# run it with: python -m standins.fake_redis --port 6390
+# and point the backend at it with LOCATION_CACHE_REDIS_URL=redis://127.0.0.1:6390/0
+
+
+class Store:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def set(self, key, value, ttl: float = None):
+        self.data[key] = value
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = time.monotonic() + ttl
+
+    def delete(self, key) -> int:
+        alive = self._alive(key)
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+        return int(alive)
+
+
+class Error(Exception):
+    pass
+
+
+def _encode(value, resp3: bool = False) -> bytes:
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, Error):
+        return b"-ERR " + str(value).encode() + b"\r\n"
+    if isinstance(value, str):  # simple strings (OK, PONG, QUEUED)
+        return b"+" + value.encode() + b"\r\n"
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(v, resp3) for v in value)
+    if isinstance(value, dict):
+        if not resp3:
+            return _encode([x for kv in value.items() for x in kv])
+        return b"%%%d\r\n" % len(value) + b"".join(_encode(k, resp3) + _encode(v, resp3) for k, v in value.items())
+    return b"$%d\r\n" % len(value) + bytes(value) + b"\r\n"
+
+
+async def _read_command(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # inline command (redis-cli / telnet)
+        return line.strip().split()
+    args = []
+    for _ in range(int(line[1:])):
+        size = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+
+def execute(store: Store, args):
+    name = args[0].decode().upper()
+    rest = args[1:]
+
+    if name == "PING":
+        return rest[0] if rest else "PONG"
+    if name in ("SELECT", "CLIENT"):
+        return "OK"
+    if name == "GET":
+        return store.get(rest[0])
+    if name == "MGET":
+        return [store.get(k) for k in rest]
+    if name == "SET":
+        key, value, options = rest[0], rest[1], [o.decode().upper() for o in rest[2:]]
+        ttl = None
+        if "EX" in options:
+            ttl = float(options[options.index("EX") + 1])
+        elif "PX" in options:
+            ttl = float(options[options.index("PX") + 1]) / 1000
+        exists = store._alive(key)
+        if ("NX" in options and exists) or ("XX" in options and not exists):
+            return None
+        store.set(key, value, ttl)
+        return "OK"
+    if name == "MSET":
+        for key, value in zip(rest[::2], rest[1::2]):
+            store.set(key, value)
+        return "OK"
+    if name in ("DEL", "UNLINK"):
+        return sum(store.delete(k) for k in rest)
+    if name == "EXISTS":
+        return sum(store._alive(k) for k in rest)
+    if name == "EXPIRE":
+        if not store._alive(rest[0]):
+            return 0
+        store.expires[rest[0]] = time.monotonic() + float(rest[1])
+        return 1
+    if name == "TTL":
+        if not store._alive(rest[0]):
+            return -2
+        deadline = store.expires.get(rest[0])
+        return -1 if deadline is None else max(int(deadline - time.monotonic()), 0)
+    if name == "KEYS":
+        pattern = rest[0].decode()
+        return [k for k in list(store.data) if store._alive(k) and fnmatch.fnmatchcase(k.decode(), pattern)]
+    if name == "DBSIZE":
+        return sum(store._alive(k) for k in list(store.data))
+    if name in ("FLUSHALL", "FLUSHDB"):
+        store.data.clear()
+        store.expires.clear()
+        return "OK"
+    if name == "INFO":
+        return b"# Server\r\nredis_version:7.0.0-standin\r\n"
+    return Error(f"unknown command '{name}'")
+
+
+async def handle(store: Store, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    queued = None  # commands between MULTI and EXEC
+    resp3 = False
+    try:
+        while True:
+            args = await _read_command(reader)
+            if args is None:
+                break
+            if not args:
+                continue
+            name = args[0].decode().upper()
+            if name == "HELLO":
+                version = int(args[1]) if len(args) > 1 else (3 if resp3 else 2)
+                if version in (2, 3):
+                    resp3 = version == 3
+                    reply = {b"server": b"redis", b"version": b"7.0.0", b"proto": version, b"id": 1,
+                             b"mode": b"standalone", b"role": b"master", b"modules": []}
+                else:
+                    reply = Error("NOPROTO unsupported protocol version")
+            elif name == "MULTI":
+                queued, reply = [], "OK"
+            elif name == "EXEC":
+                reply = [execute(store, a) for a in queued] if queued is not None else Error("EXEC without MULTI")
+                queued = None
+            elif name == "DISCARD":
+                queued, reply = None, "OK"
+            elif queued is not None:
+                queued.append(args)
+                reply = "QUEUED"
+            elif name == "QUIT":
+                writer.write(_encode("OK", resp3))
+                break
+            else:
+                reply = execute(store, args)
+            writer.write(_encode(reply, resp3))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int):
+    store = Store()
+    server = await asyncio.start_server(lambda r, w: handle(store, r, w), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="in-memory redis stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
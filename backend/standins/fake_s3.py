@@ -0,0 +1,128 @@
+import argparse
+import hashlib
+import time
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+from fastapi import FastAPI, Query, Request, Response
+
+# in-memory stand-in for an s3 compatible object store (minio style, path addressing), enough of the api for
+# storage/s3.py to run against it in tests and load tests: create bucket, put / head / get (with Range) / delete
+# object and ListObjectsV2. signatures aren't checked, nothing is persisted.
+#
+# run it with: python -m standins.fake_s3 --port 9200
+# and point the backend at it with STORAGE_BACKEND=s3 STORAGE_S3_ENDPOINT_URL=http://127.0.0.1:9200
+# (boto3 still wants some credentials: AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x)
+
+app = FastAPI()
+buckets = {}  # bucket -> {key: (data, content_type, etag, last_modified)}
+
+
+def _error(code: str, message: str, status: int, head: bool = False) -> Response:
+    body = b"" if head else f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{message}</Message></Error>'.encode()
+    return Response(content=body, status_code=status, media_type="application/xml")
+
+
+def _decode_aws_chunked(body: bytes) -> bytes:
+    # newer sdks send streaming uploads as aws-chunked: "<hex size>[;chunk-signature=..]\r\n<data>\r\n" ... "0\r\n<trailers>"
+    out = bytearray()
+    pos = 0
+    while True:
+        line_end = body.index(b"\r\n", pos)
+        size = int(body[pos:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(out)
+        out += body[line_end + 2:line_end + 2 + size]
+        pos = line_end + 2 + size + 2
+
+
+def _parse_range(header: str, size: int):
+    # "bytes=a-b" / "bytes=a-" / "bytes=-n" -> (start, end) or None when it can't be satisfied
+    start, _, end = header.removeprefix("bytes=").partition("-")
+    if start == "":
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    return (start, end) if start <= end and start < size else None
+
+
+@app.put("/{bucket}")
+async def create_bucket(bucket: str):
+    buckets.setdefault(bucket, {})
+    return Response(status_code=200, headers={"Location": f"/{bucket}"})
+
+
+@app.get("/{bucket}")
+async def list_objects(bucket: str, prefix: str = "", max_keys: int = Query(1000, alias="max-keys"),
+                       start_after: str = Query("", alias="start-after")):
+    if bucket not in buckets:
+        return _error("NoSuchBucket", "The specified bucket does not exist", 404)
+    keys = sorted(k for k in buckets[bucket] if k.startswith(prefix) and k > start_after)
+    page = keys[:max_keys]
+    contents = "".join(
+        f"<Contents><Key>{escape(k)}</Key><Size>{len(buckets[bucket][k][0])}</Size><ETag>{buckets[bucket][k][2]}</ETag></Contents>"
+        for k in page)
+    body = (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+            f'<IsTruncated>{"true" if len(keys) > max_keys else "false"}</IsTruncated>{contents}</ListBucketResult>')
+    return Response(content=body, media_type="application/xml")
+
+
+@app.put("/{bucket}/{key:path}")
+async def put_object(bucket: str, key: str, request: Request):
+    if bucket not in buckets:
+        return _error("NoSuchBucket", "The specified bucket does not exist", 404)
+    body = await request.body()
+    if "aws-chunked" in request.headers.get("content-encoding", "") or \
+            request.headers.get("x-amz-content-sha256", "").startswith("STREAMING-"):
+        body = _decode_aws_chunked(body)
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    buckets[bucket][key] = (body, request.headers.get("content-type", "binary/octet-stream"), etag, time.time())
+    return Response(status_code=200, headers={"ETag": etag})
+
+
+def _object_headers(entry) -> dict:
+    return {"ETag": entry[2], "Last-Modified": formatdate(entry[3], usegmt=True), "Accept-Ranges": "bytes"}
+
+
+@app.head("/{bucket}/{key:path}")
+async def head_object(bucket: str, key: str):
+    entry = buckets.get(bucket, {}).get(key)
+    if entry is None:
+        return _error("NoSuchKey", "", 404, head=True)
+    return Response(status_code=200, media_type=entry[1], headers={**_object_headers(entry), "Content-Length": str(len(entry[0]))})
+
+
+@app.get("/{bucket}/{key:path}")
+async def get_object(bucket: str, key: str, request: Request):
+    entry = buckets.get(bucket, {}).get(key)
+    if entry is None:
+        return _error("NoSuchKey", "The specified key does not exist.", 404)
+    data = entry[0]
+    byte_range = request.headers.get("range")
+    if byte_range:
+        parsed = _parse_range(byte_range, len(data))
+        if parsed is None:
+            return _error("InvalidRange", "The requested range is not satisfiable", 416)
+        start, end = parsed
+        return Response(content=data[start:end + 1], status_code=206, media_type=entry[1],
+                        headers={**_object_headers(entry), "Content-Range": f"bytes {start}-{end}/{len(data)}"})
+    return Response(content=data, media_type=entry[1], headers=_object_headers(entry))
+
+
+@app.delete("/{bucket}/{key:path}")
+async def delete_object(bucket: str, key: str):
+    buckets.get(bucket, {}).pop(key, None)
+    return Response(status_code=204)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="in-memory s3 stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--bucket", action="append", default=[], help="bucket(s) to create up front")
+    args = parser.parse_args()
+    for name in args.bucket or ["pathfinder-uploads"]:
+        buckets.setdefault(name, {})
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
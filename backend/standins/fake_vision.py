@@ -0,0 +1,95 @@
+import argparse
+import hashlib
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import numpy as np
+import vision_remote
+
+# stand-in for inference_server.py: speaks the same unix socket protocol (vision_remote.py) but instead of running
+# the ssd it makes up a few detections per image from a hash of its pixels (same image -> same detections). lets
+# the vision path of /addPost run in load tests without tensorflow or the model files.
+#
+# run it with: python -m standins.fake_vision --socket /tmp/pathfinder-fake-vision.sock
+# and point the backend at it with VISION_INFERENCE_SOCKET=/tmp/pathfinder-fake-vision.sock
+#
+# STANDIN_LATENCY_MS / STANDIN_JITTER_MS / STANDIN_ERROR_RATE as in standins/google_api.py, the latency is per
+# request plus STANDIN_IMAGE_MS for every image in it (a real model costs per image).
+
+STANDIN_LATENCY_MS = float(os.getenv("STANDIN_LATENCY_MS", "0"))
+STANDIN_JITTER_MS = float(os.getenv("STANDIN_JITTER_MS", "0"))
+STANDIN_ERROR_RATE = float(os.getenv("STANDIN_ERROR_RATE", "0"))
+STANDIN_IMAGE_MS = float(os.getenv("STANDIN_IMAGE_MS", "0"))
+MAX_DETECTIONS = 100  # like the exported ssd graph
+CLASSES = 8
+
+
+def fake_result(image):
+    rng = np.random.default_rng(int.from_bytes(hashlib.sha256(image.tobytes()).digest()[:8], "big"))
+    num = int(rng.integers(0, 6))
+    boxes = np.zeros((MAX_DETECTIONS, 4), dtype=np.float32)
+    scores = np.zeros(MAX_DETECTIONS, dtype=np.float32)
+    classes = np.zeros(MAX_DETECTIONS, dtype=np.float32)
+    corners = rng.uniform(0, 0.5, (num, 2))
+    boxes[:num] = np.hstack([corners, corners + rng.uniform(0.1, 0.5, (num, 2))])
+    scores[:num] = np.sort(rng.uniform(0.2, 0.95, num))[::-1]
+    classes[:num] = rng.integers(1, CLASSES + 1, num)
+    return boxes, scores, classes, np.float32(num)
+
+
+def _handle(conn: socket.socket):
+    with conn:
+        while True:
+            try:
+                header, payload = vision_remote.recv_frame(conn)
+            except (ConnectionError, OSError, ValueError):
+                return
+            if header.get("op") == "ping":
+                response = {"ok": True, "pid": os.getpid(), "ready": True, "model": "fake_vision"}, b""
+            elif header.get("op") == "detect":
+                images = vision_remote.decode_images(header, payload)
+                time.sleep((STANDIN_LATENCY_MS + random.uniform(0, STANDIN_JITTER_MS) + STANDIN_IMAGE_MS * len(images)) / 1000)
+                if STANDIN_ERROR_RATE > 0 and random.random() < STANDIN_ERROR_RATE:
+                    response = {"ok": False, "error": "injected error"}, b""
+                else:
+                    response = vision_remote.encode_results([fake_result(image) for image in images])
+            else:
+                response = {"ok": False, "error": f"unknown op {header.get('op')!r}"}, b""
+            try:
+                vision_remote.send_frame(conn, *response)
+            except OSError:
+                return
+
+
+def serve(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(256)
+    print(f"fake inference server on {path}", flush=True)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=_handle, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="stand-in for the ssd inference server")
+    parser.add_argument("--socket", default="/tmp/pathfinder-fake-vision.sock")
+    args = parser.parse_args()
+    serve(args.socket)
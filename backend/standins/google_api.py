@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import polyline
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse
+
+# local stand-in for the google apis we call (geocode, routes, roads, places autocomplete/details).
+# answers are fake but deterministic (same input -> same output) and shaped like the real ones, so the
+# backend can be load tested offline. point the backend at it with GOOGLE_STANDIN_URL=http://127.0.0.1:9100
+#
+# run it with: python -m standins.google_api --port 9100
+#
+# STANDIN_LATENCY_MS / STANDIN_JITTER_MS add an artificial delay to every answer, STANDIN_ERROR_RATE makes
+# that fraction of the calls fail with a 503 (to exercise the retry / fallback paths).
+
+STANDIN_LATENCY_MS = float(os.getenv("STANDIN_LATENCY_MS", "0"))
+STANDIN_JITTER_MS = float(os.getenv("STANDIN_JITTER_MS", "0"))
+STANDIN_ERROR_RATE = float(os.getenv("STANDIN_ERROR_RATE", "0"))
+# every fake coordinate lands within ~10 km of this point
+STANDIN_CENTER = tuple(float(v) for v in os.getenv("STANDIN_CENTER", "25.4310,81.7703").split(","))
+
+app = FastAPI()
+
+
+def _unit(text: str, salt: str = "") -> float:
+    # deterministic number in [0, 1) from a string
+    digest = hashlib.sha256((salt + text).encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def fake_location(text: str):
+    return (STANDIN_CENTER[0] + (_unit(text, "lat") - 0.5) * 0.2,
+            STANDIN_CENTER[1] + (_unit(text, "lng") - 0.5) * 0.2)
+
+
+@app.middleware("http")
+async def latency_and_errors(request: Request, call_next):
+    delay = STANDIN_LATENCY_MS + random.uniform(0, STANDIN_JITTER_MS)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if STANDIN_ERROR_RATE > 0 and random.random() < STANDIN_ERROR_RATE:
+        return JSONResponse(content={"error": {"code": 503, "status": "UNAVAILABLE"}}, status_code=503)
+    return await call_next(request)
+
+
+@app.get("/maps/api/geocode/json")
+def geocode(address: str = Query(...)):
+    lat, lng = fake_location(address.strip().lower())
+    return {
+        "status": "OK",
+        "results": [{
+            "formatted_address": address,
+            "place_id": "standin_" + hashlib.sha1(address.encode()).hexdigest()[:16],
+            "geometry": {"location": {"lat": lat, "lng": lng}},
+        }],
+    }
+
+
+@app.post("/directions/v2:computeRoutes")
+async def compute_routes(request: Request):
+    body = await request.json()
+    o = body["origin"]["location"]["latLng"]
+    d = body["destination"]["location"]["latLng"]
+    # a straight line with a point roughly every 20 m, like a dense real polyline
+    steps = max(2, int((abs(o["latitude"] - d["latitude"]) + abs(o["longitude"] - d["longitude"])) / 0.0002))
+    points = [(o["latitude"] + (d["latitude"] - o["latitude"]) * i / steps,
+               o["longitude"] + (d["longitude"] - o["longitude"]) * i / steps) for i in range(steps + 1)]
+    return {"routes": [{"polyline": {"encodedPolyline": polyline.encode(points)}}]}
+
+
+@app.get("/v1/snapToRoads")
+def snap_to_roads(path: str = Query(...)):
+    snapped = []
+    for i, point in enumerate(path.split("|")):
+        lat, lng = (float(v) for v in point.split(","))
+        # ~100 m cells behave like road segments: nearby points share a place id
+        cell = f"{round(lat, 3)},{round(lng, 3)}"
+        snapped.append({
+            "location": {"latitude": lat, "longitude": lng},
+            "originalIndex": i,
+            "placeId": "standin_" + hashlib.sha1(cell.encode()).hexdigest()[:16],
+        })
+    return {"snappedPoints": snapped}
+
+
+@app.get("/maps/api/place/autocomplete/json")
+def autocomplete(input: str = Query(...)):
+    predictions = []
+    for i in range(5):
+        description = f"{input.strip().title()} {['Road', 'Street', 'Market', 'Colony', 'Chowk'][i]}, Prayagraj"
+        predictions.append({
+            "description": description,
+            "place_id": "standin_" + hashlib.sha1(description.encode()).hexdigest()[:16],
+        })
+    return {"status": "OK", "predictions": predictions}
+
+
+@app.get("/maps/api/place/details/json")
+def place_details(place_id: str = Query(...)):
+    lat, lng = fake_location(place_id)
+    return {
+        "status": "OK",
+        "result": {"formatted_address": f"Stand-in place {place_id}", "geometry": {"location": {"lat": lat, "lng": lng}}},
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="local stand-in for the google apis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
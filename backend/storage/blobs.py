@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import List
+import aiofiles
+from fastapi import UploadFile
+from storage.local import LocalStorage
+from storage.s3 import S3Storage
+
+# the uploaded photos. a blob is stored under the sha256 of its bytes (blobs/ab/<sha256>), so the same photo
+# uploaded again (client retry, one photo in several posts) is stored once.
+# an upload is copied into a spool file in UPLOAD_CHUNK_BYTES chunks and hashed on the way, it is never held in
+# memory as a whole, and it is rejected (UploadTooLarge -> 413) as soon as it passes UPLOAD_MAX_BYTES. the spool
+# file is then handed to the backend (STORAGE_BACKEND):
+#   local: files under STORAGE_LOCAL_DIR (uploads/, served as /uploads)
+#   s3:    STORAGE_S3_BUCKET on STORAGE_S3_ENDPOINT_URL (aws, minio, ... or standins/fake_s3.py), for several api nodes
+# posts.images_dir holds the comma separated blob keys of the post's photos. posts from before this hold the
+# name of their upload_<uuid> directory under uploads/.
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", "uploads")
+# next to STORAGE_LOCAL_DIR (uploads-tmp/), on the same disk so the local backend can hard link the spool files
+# instead of copying them, but not inside it: everything under STORAGE_LOCAL_DIR is served as /uploads, and the
+# spool holds in-flight and rejected uploads
+STORAGE_TMP_DIR = os.getenv("STORAGE_TMP_DIR", STORAGE_LOCAL_DIR.rstrip("/\\") + "-tmp")
+STORAGE_S3_BUCKET = os.getenv("STORAGE_S3_BUCKET", "pathfinder-uploads")
+STORAGE_S3_ENDPOINT_URL = os.getenv("STORAGE_S3_ENDPOINT_URL")
+STORAGE_S3_REGION = os.getenv("STORAGE_S3_REGION", "us-east-1")
+STORAGE_S3_PREFIX = os.getenv("STORAGE_S3_PREFIX", "")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(256 * 1024)))
+
+KEY_PREFIX = "blobs/"
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+_backend = None
+
+stored_blobs = 0
+stored_bytes = 0
+deduplicated_blobs = 0
+rejected_uploads = 0
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == "s3":
+            _backend = S3Storage(STORAGE_S3_BUCKET, STORAGE_S3_ENDPOINT_URL, STORAGE_S3_REGION, STORAGE_S3_PREFIX)
+        else:
+            _backend = LocalStorage(STORAGE_LOCAL_DIR)
+    return _backend
+
+
+def blob_key(sha256: str) -> str:
+    return f"{KEY_PREFIX}{sha256[:2]}/{sha256}"
+
+
+def key_sha256(key: str) -> str:
+    return key.rsplit("/", 1)[-1]
+
+
+def join_keys(keys: List[str]) -> str:
+    return ",".join(keys)
+
+
+def split_keys(images_dir: str) -> List[str]:
+    # [] for the upload_<uuid> directories of older posts
+    if not images_dir or not images_dir.startswith(KEY_PREFIX):
+        return []
+    return [key for key in images_dir.split(",") if key]
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def spool(upload: UploadFile) -> dict:
+    # -> {"path": spool file, "sha256", "key", "size", "mime_type"}
+    global rejected_uploads
+    if upload.size is not None and upload.size > UPLOAD_MAX_BYTES:
+        rejected_uploads += 1
+        raise UploadTooLarge(f"{upload.filename} is larger than {UPLOAD_MAX_BYTES} bytes")
+
+    os.makedirs(STORAGE_TMP_DIR, exist_ok=True)
+    path = os.path.join(STORAGE_TMP_DIR, uuid.uuid4().hex)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(path, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    rejected_uploads += 1
+                    raise UploadTooLarge(f"{upload.filename} is larger than {UPLOAD_MAX_BYTES} bytes")
+                hasher.update(chunk)
+                await out.write(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+
+    sha256 = hasher.hexdigest()
+    return {"path": path, "sha256": sha256, "key": blob_key(sha256), "size": size, "mime_type": upload.content_type}
+
+
+async def spool_all(uploads: List[UploadFile]) -> List[dict]:
+    spooled = []
+    try:
+        for upload in uploads:
+            spooled.append(await spool(upload))
+    except BaseException:
+        discard(spooled)
+        raise
+    return spooled
+
+
+async def commit(spooled: List[dict]):
+    # stores the spooled uploads that aren't stored yet (the spool files are left for discard)
+    global stored_blobs, stored_bytes, deduplicated_blobs
+    backend = get_backend()
+    unique = {s["key"]: s for s in spooled}
+    created = await asyncio.gather(*(asyncio.to_thread(backend.put_file, key, s["path"], s["mime_type"])
+                                     for key, s in unique.items()))
+    for s, new in zip(unique.values(), created):
+        if new:
+            stored_blobs += 1
+            stored_bytes += s["size"]
+    deduplicated_blobs += len(spooled) - sum(created)
+
+
+def discard(spooled: List[dict]):
+    for s in spooled:
+        _remove(s["path"])
+
+
+def read(key: str):
+    # what image_pipeline.prepare_image takes: the path of the blob on local disk, else its bytes. blocking
+    backend = get_backend()
+    if isinstance(backend, LocalStorage):
+        return backend.path(key)
+    return backend.get_bytes(key)
+
+
+async def load(key: str):
+    if isinstance(get_backend(), LocalStorage):
+        return read(key)
+    return await asyncio.to_thread(read, key)
+
+
+async def exists(key: str) -> bool:
+    return await asyncio.to_thread(get_backend().exists, key)
+
+
+async def put_bytes(key: str, data: bytes, content_type: str = None):
+    # for derived files (image_variants.py), the blobs themselves go through spool + commit
+    await asyncio.to_thread(get_backend().put_bytes, key, data, content_type)
+
+
+async def size(key: str):
+    # None when there's no such blob
+    return await asyncio.to_thread(get_backend().size, key)
+
+
+def stream(key: str, start: int = 0, end: int = None):
+    return get_backend().stream(key, start, end, UPLOAD_CHUNK_BYTES)
+
+
+def parse_range(header: str, size: int):
+    # a single "bytes=a-b" / "bytes=a-" / "bytes=-n" range -> (start, end) inclusive, None when it can't be
+    # satisfied, ValueError when it isn't a single byte range (the caller then answers with the whole blob)
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError(header)
+    start, _, end = spec.strip().partition("-")
+    if start == "":
+        if not end:
+            raise ValueError(header)
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    return (start, end) if start <= end and start < size else None
+
+
+def sniff_mime_type(head: bytes) -> str:
+    # blobs are stored without metadata on the local backend, the first bytes tell the image format
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in (b"avif", b"avis"):
+            return "image/avif"
+        if brand in (b"heic", b"heix", b"mif1", b"msf1"):
+            return "image/heic"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+def stats() -> dict:
+    return {
+        "backend": STORAGE_BACKEND,
+        "stored_blobs": stored_blobs,
+        "stored_bytes": stored_bytes,
+        "deduplicated_blobs": deduplicated_blobs,
+        "rejected_uploads": rejected_uploads,
+    }
@@ -0,0 +1,74 @@
+import os
+import shutil
+import uuid
+import aiofiles
+
+# blobs as plain files under one directory (uploads/ by default, which is also served as /uploads).
+# fine for a single api node, or several ones sharing that directory over nfs.
+
+
+class LocalStorage:
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def size(self, key: str):
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError:
+            return None
+
+    def put_file(self, key: str, src: str, content_type: str = None) -> bool:
+        # returns False when the blob was already there. the spooled file lives on the same disk (tmp/ below the
+        # root) so this is a hard link, no data is copied
+        dst = self.path(key)
+        if os.path.isfile(dst):
+            return False
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        part = f"{dst}.{uuid.uuid4().hex}.part"
+        try:
+            os.link(src, part)
+        except OSError:
+            shutil.copyfile(src, part)
+        # atomic: a concurrent upload of the same photo just replaces it with identical bytes
+        os.replace(part, dst)
+        return True
+
+    def put_bytes(self, key: str, data: bytes, content_type: str = None):
+        dst = self.path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        part = f"{dst}.{uuid.uuid4().hex}.part"
+        with open(part, "wb") as f:
+            f.write(data)
+        os.replace(part, dst)
+
+    def get_bytes(self, key: str) -> bytes:
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    async def stream(self, key: str, start: int = 0, end: int = None, chunk_size: int = 256 * 1024):
+        # yields the bytes start..end (inclusive, end None = to the end of the blob)
+        async with aiofiles.open(self.path(key), "rb") as f:
+            await f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = await f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
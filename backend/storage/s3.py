@@ -0,0 +1,75 @@
+import asyncio
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed with STORAGE_BACKEND=s3
+    boto3 = None
+
+# blobs in an s3 compatible bucket (aws s3, minio, r2, ... or standins/fake_s3.py), so every api node sees
+# the same uploads. boto3 is blocking, blobs.py calls these methods from a thread.
+
+
+class S3Storage:
+    name = "s3"
+
+    def __init__(self, bucket: str, endpoint_url: str = None, region: str = None, prefix: str = ""):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix
+        # path style addressing works with every s3 clone, virtual host style needs dns for each bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region,
+                                   config=Config(s3={"addressing_style": "path"}, retries={"max_attempts": 3},
+                                                 max_pool_connections=32))
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _head(self, key: str):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str):
+        head = self._head(key)
+        return None if head is None else head["ContentLength"]
+
+    def put_file(self, key: str, src: str, content_type: str = None) -> bool:
+        # keys are content hashes, so an existing object already has these bytes
+        if self.exists(key):
+            return False
+        extra = {"ContentType": content_type} if content_type else {}
+        with open(src, "rb") as f:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=f, **extra)
+        return True
+
+    def put_bytes(self, key: str, data: bytes, content_type: str = None):
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, **extra)
+
+    def get_bytes(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+
+    async def stream(self, key: str, start: int = 0, end: int = None, chunk_size: int = 256 * 1024):
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        response = await asyncio.to_thread(self.client.get_object, Bucket=self.bucket, Key=self._key(key), Range=byte_range)
+        body = response["Body"]
+        try:
+            while True:
+                chunk = await asyncio.to_thread(body.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
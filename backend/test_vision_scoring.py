@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+import vision_scoring
+
+# the vectorized scoring must give what the per detection compute_*_score functions it replaced gave.
+# those functions are copied here as they were (minus the docstrings), fed the same detections as dicts.
+
+CLASS_MAP = {1: "D00", 2: "D01", 3: "D10", 4: "D11", 5: "D20", 6: "D40", 7: "D43", 8: "D44"}
+
+
+def old_detections(scores, classes, num):
+    detections = []
+    for i in range(int(num)):
+        if scores[i] < vision_scoring.CONFIDENCE_THRESHOLD:
+            continue
+        detections.append({"class": CLASS_MAP.get(int(classes[i]), "Unknown"), "confidence": float(scores[i])})
+    return detections
+
+
+def compute_surface_damage_score(detections):
+    if len(detections) == 0:
+        return 0
+    weights = {"D00": 8, "D01": 8, "D10": 10, "D11": 10, "D20": 25, "D40": 40, "D43": 5, "D44": 5}
+    total_weight = sum(weights.get(d["class"], 5) * d["confidence"] for d in detections)
+    return round(min(100, (total_weight / len(detections)) * 2), 2)
+
+
+def compute_traffic_safety_score(detections):
+    if len(detections) == 0:
+        return 0
+    safety_weights = {"D40": 50, "D20": 30, "D43": 15, "D44": 10, "D00": 5, "D01": 5, "D10": 5, "D11": 5}
+    total_weight = sum(safety_weights.get(d["class"], 0) * d["confidence"] for d in detections if d["class"] in safety_weights)
+    return round(min(100, total_weight / len(detections)), 2)
+
+
+def compute_ride_discomfort_score(detections):
+    if len(detections) == 0:
+        return 0
+    comfort_weights = {"D00": 5, "D01": 5, "D10": 8, "D11": 8, "D20": 20, "D40": 45, "D43": 2, "D44": 2}
+    total_weight = sum(comfort_weights.get(d["class"], 2) * d["confidence"] for d in detections)
+    return round(min(100, (total_weight / len(detections)) * 1.8), 2)
+
+
+def compute_waterlogging_score(detections):
+    if len(detections) == 0:
+        return 0
+    comfort_weights = {"D00": 0, "D01": 0, "D10": 10, "D11": 8, "D20": 15, "D40": 70, "D43": 0, "D44": 0}
+    total_weight = sum(comfort_weights.get(d["class"], 2) * d["confidence"] for d in detections)
+    return round(min(100, (total_weight / len(detections)) * 1.8), 2)
+
+
+def compute_urgency_score(detections):
+    if len(detections) == 0:
+        return 0
+    urgency_weights = {"D40": 100, "D20": 70, "D10": 25, "D11": 25, "D00": 15, "D01": 15, "D43": 20, "D44": 10}
+    total_weight = sum(urgency_weights.get(d["class"], 10) * d["confidence"] for d in detections)
+    return round(min(100, total_weight / len(detections)), 2)
+
+
+OLD_SCORES = {
+    "surface_damage": compute_surface_damage_score,
+    "traffic_safety_risk": compute_traffic_safety_score,
+    "ride_discomfort": compute_ride_discomfort_score,
+    "waterlogging": compute_waterlogging_score,
+    "urgency_for_repair": compute_urgency_score,
+}
+
+# (scores, classes, num) of one image, padded to the same number of detections like sess.run returns them
+IMAGES = {
+    "no detections": ([0.0, 0.0, 0.0, 0.0], [0, 0, 0, 0], 0),
+    "all below the threshold": ([0.39, 0.2, 0.1, 0.0], [6, 5, 1, 0], 3),
+    "one pothole": ([0.93, 0.0, 0.0, 0.0], [6, 0, 0, 0], 1),
+    "mixed": ([0.97, 0.81, 0.55, 0.41], [6, 5, 3, 8], 4),
+    "unknown class ids": ([0.9, 0.7, 0.6, 0.5], [0, 9, 17, 2], 4),
+    "past num is padding": ([0.8, 0.75, 0.99, 0.99], [7, 4, 6, 6], 2),
+    "capped at 100": ([0.99, 0.98, 0.97, 0.96], [6, 6, 6, 6], 4),
+}
+
+
+# the scale is applied before the division now, so a score that lands on x.xx5 may round the other way
+TOLERANCE = 0.01 + 1e-9
+
+
+def expected(detections):
+    return [OLD_SCORES[category](detections) for category in vision_scoring.CATEGORIES]
+
+
+@pytest.mark.parametrize("name", list(IMAGES))
+def test_one_image_matches_old_formulas(name):
+    scores, classes, num = IMAGES[name]
+    sums, counts = vision_scoring.class_sums(scores, classes, [num])
+    result = vision_scoring.category_scores(sums, counts, vision_scoring.load_weights())
+    assert result.shape == (1, len(vision_scoring.CATEGORIES))
+    assert result[0] == pytest.approx(expected(old_detections(scores, classes, num)), abs=TOLERANCE)
+
+
+def test_batch_of_posts_matches_old_formulas():
+    # every image its own post, plus one post made of two images (their detections are pooled, like the old loop)
+    names = list(IMAGES)
+    scores = np.array([IMAGES[n][0] for n in names] + [IMAGES["mixed"][0], IMAGES["unknown class ids"][0]])
+    classes = np.array([IMAGES[n][1] for n in names] + [IMAGES["mixed"][1], IMAGES["unknown class ids"][1]], dtype=np.float32)
+    num = np.array([IMAGES[n][2] for n in names] + [IMAGES["mixed"][2], IMAGES["unknown class ids"][2]], dtype=np.float32)
+    post_index = list(range(len(names))) + [len(names), len(names)]
+
+    sums, counts = vision_scoring.class_sums(scores, classes, num, post_index, len(names) + 1)
+    result = vision_scoring.category_scores(sums, counts, vision_scoring.load_weights())
+
+    for post, name in enumerate(names):
+        assert result[post] == pytest.approx(expected(old_detections(*IMAGES[name])), abs=TOLERANCE), name
+    pooled = old_detections(*IMAGES["mixed"]) + old_detections(*IMAGES["unknown class ids"])
+    assert result[-1] == pytest.approx(expected(pooled), abs=TOLERANCE)
+
+
+def test_no_images():
+    sums, counts = vision_scoring.class_sums(np.zeros((0, 4)), np.zeros((0, 4)), [], [], 1)
+    result = vision_scoring.category_scores(sums, counts, vision_scoring.load_weights())
+    assert result.tolist() == [[0.0] * len(vision_scoring.CATEGORIES)]
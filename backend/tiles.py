@@ -0,0 +1,186 @@
+import asyncio
+import math
+import os
+import time
+from typing import List
+import numpy as np
+import location_index
+from database import db
+
+# viewport queries for the map: the scored locations inside a bbox, or, when zoomed out, clusters of them,
+# plus a heat-map tile endpoint. both read a pyramid of score tiles (web mercator z/x/y, table score_tiles) with
+# the summed scores of every zoom level from TILE_MIN_ZOOM to TILE_MAX_ZOOM, so panning around a city is a few
+# primary key range reads whatever the number of locations.
+# the pyramid is maintained incrementally: addPost / bulk imports mark the location dirty (location_dirty) and a
+# background task recomputes only the tiles above dirty locations every TILE_REFRESH_SECONDS (db.refreshScoreTiles).
+#
+# rebuild everything (after the first deploy or a restore):  python tiles.py rebuild
+
+TILE_MIN_ZOOM = int(os.getenv("TILE_MIN_ZOOM", "0"))
+TILE_MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "16"))
+TILE_REFRESH_SECONDS = float(os.getenv("TILE_REFRESH_SECONDS", "10"))
+TILE_REFRESH_BATCH = int(os.getenv("TILE_REFRESH_BATCH", "5000"))
+# a heat-map tile at zoom z carries the cells of zoom z + TILE_DETAIL_LEVELS inside it (8x8 cells for 3)
+TILE_DETAIL_LEVELS = int(os.getenv("TILE_DETAIL_LEVELS", "3"))
+
+# /locations/bbox returns single locations from this zoom on (when there aren't too many), clusters below it
+BBOX_DETAIL_ZOOM = int(os.getenv("BBOX_DETAIL_ZOOM", "15"))
+BBOX_MAX_LOCATIONS = int(os.getenv("BBOX_MAX_LOCATIONS", "2000"))
+# clusters are the tiles CLUSTER_LEVELS below the view's zoom (~ 64 px on screen for 2), at most BBOX_MAX_CLUSTERS
+CLUSTER_LEVELS = 2
+BBOX_MAX_CLUSTERS = 4096
+
+MAX_LAT = 85.0511
+
+SCORE_COLUMNS = location_index.SCORE_COLUMNS
+
+_task: asyncio.Task = None
+refreshed_locations = 0
+last_refresh = None
+
+
+def tile_xy(lat: float, lng: float, z: int):
+    # same as the tile_x / tile_y sql functions (setup.sql)
+    n = 1 << z
+    lat = min(max(lat, -MAX_LAT), MAX_LAT)
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(z: int, x: int, y: int):
+    # (min_lat, min_lng, max_lat, max_lng)
+    n = 1 << z
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+    return lat(y + 1), x / n * 360 - 180, lat(y), (x + 1) / n * 360 - 180
+
+
+def _summaries(rows) -> List[dict]:
+    # tile rows (sums) -> one entry per tile with its centroid, counts and averaged scores / indices
+    if not rows:
+        return []
+    counts = np.asarray([r['locations'] for r in rows], dtype=np.float64)
+    scores = np.asarray([[r[c] for c in SCORE_COLUMNS] for r in rows], dtype=np.float64) / counts[:, None]
+    rqi, psi = location_index.compute_indices(scores)
+    return [{
+        "x": r['x'],
+        "y": r['y'],
+        "lat": round(r['sum_lat'] / r['locations'], 6),
+        "lng": round(r['sum_lng'] / r['locations'], 6),
+        "locations": r['locations'],
+        "posts": r['posts'],
+        "rqi": round(float(rqi[i]), 1),
+        "psi": round(float(psi[i]), 1),
+    } for i, r in enumerate(rows)]
+
+
+def etag(rows) -> str:
+    # changes whenever one of the tiles does: versions come from one sequence, so the max moves with any update,
+    # and the count catches tiles appearing
+    return f'"{max((r["version"] for r in rows), default=0)}-{len(rows)}"'
+
+
+async def heatmap_tile(z: int, x: int, y: int):
+    # cells of zoom z + TILE_DETAIL_LEVELS (capped at TILE_MAX_ZOOM) inside tile z/x/y, and the etag of the answer
+    cell_z = min(z + TILE_DETAIL_LEVELS, TILE_MAX_ZOOM)
+    if cell_z < z:
+        # zoomed in past the pyramid: the one max zoom cell this tile lies in
+        shift = z - cell_z
+        cx, cy = x >> shift, y >> shift
+        rows = await db.getScoreTiles(cell_z, cx, cx, cy, cy)
+    else:
+        shift = cell_z - z
+        rows = await db.getScoreTiles(cell_z, x << shift, ((x + 1) << shift) - 1, y << shift, ((y + 1) << shift) - 1)
+    return {"z": z, "x": x, "y": y, "cell_zoom": cell_z, "cells": _summaries(rows)}, etag(rows)
+
+
+async def locations_in_bbox(min_lat: float, min_lng: float, max_lat: float, max_lng: float, zoom: int) -> dict:
+    if zoom >= BBOX_DETAIL_ZOOM:
+        rows = await db.getLocationsInBox(min_lat, min_lng, max_lat, max_lng, BBOX_MAX_LOCATIONS + 1)
+        if len(rows) <= BBOX_MAX_LOCATIONS:
+            scores = np.asarray([[r[c] for c in SCORE_COLUMNS] for r in rows], dtype=np.float64)
+            rqi, psi = location_index.compute_indices(scores)
+            return {"type": "locations", "locations": [{
+                "location_id": r['location_id'],
+                "lat": r['lat'],
+                "lng": r['lng'],
+                "posts": r['posts'],
+                **{c: r[c] for c in SCORE_COLUMNS},
+                "rqi": round(float(rqi[i]), 1),
+                "psi": round(float(psi[i]), 1),
+            } for i, r in enumerate(rows)]}
+
+    # too far out (or too many locations): clusters from the pyramid
+    z = min(max(zoom + CLUSTER_LEVELS, TILE_MIN_ZOOM), TILE_MAX_ZOOM)
+    while True:
+        min_x, min_y = tile_xy(max_lat, min_lng, z)
+        max_x, max_y = tile_xy(min_lat, max_lng, z)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) <= BBOX_MAX_CLUSTERS or z == TILE_MIN_ZOOM:
+            break
+        z -= 1
+    rows = await db.getScoreTiles(z, min_x, max_x, min_y, max_y)
+    return {"type": "clusters", "cluster_zoom": z, "clusters": _summaries(rows)}
+
+
+async def refresh() -> int:
+    # works through all dirty locations, returns how many were handled
+    global refreshed_locations, last_refresh
+    total = 0
+    while True:
+        handled = await db.refreshScoreTiles(TILE_MIN_ZOOM, TILE_MAX_ZOOM, TILE_REFRESH_BATCH)
+        total += handled
+        if handled < TILE_REFRESH_BATCH:
+            break
+    refreshed_locations += total
+    last_refresh = time.time()
+    return total
+
+
+async def _refresher():
+    while True:
+        try:
+            await refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Could not refresh the score tiles: {e}")
+        await asyncio.sleep(TILE_REFRESH_SECONDS)
+
+
+def start():
+    global _task
+    _task = asyncio.create_task(_refresher(), name="score-tiles-refresher")
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+def stats() -> dict:
+    return {"refreshed_locations": refreshed_locations, "last_refresh": last_refresh}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="score tile pyramid")
+    parser.add_argument("command", choices=["refresh", "rebuild"],
+                        help="refresh: recompute the tiles of dirty locations, rebuild: mark every location dirty first")
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            if args.command == "rebuild":
+                await db.markAllLocationsDirty()
+            started = time.perf_counter()
+            handled = await refresh()
+            print(f"refreshed the tiles of {handled} locations in {time.perf_counter() - started:.1f} s")
+        finally:
+            await db.close_pool()
+
+    asyncio.run(run())
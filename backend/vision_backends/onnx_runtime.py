@@ -0,0 +1,41 @@
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:  # only needed with VISION_BACKEND=onnx
+    ort = None
+
+# the ssd graph converted to onnx by convert_model.py (tf2onnx, optionally with int8 weights), run by onnx runtime on
+# the cpu. the converted graph keeps the tensorflow input / output names and takes a batch of any size.
+
+OUTPUTS = ["detection_boxes", "detection_scores", "detection_classes", "num_detections"]
+
+
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        if ort is None:
+            raise RuntimeError("VISION_BACKEND=onnx needs onnxruntime (pip install onnxruntime)")
+        self.model_path = model_path
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        names = {o.name.split(":")[0]: o.name for o in self.session.get_outputs()}
+        missing = [name for name in OUTPUTS if name not in names]
+        if missing:
+            raise ValueError(f"{model_path}: missing outputs {missing}")
+        self.output_names = [names[name] for name in OUTPUTS]
+
+    def run(self, batch):
+        # onnx runtime sessions are thread safe, no lock needed
+        boxes, scores, classes, num = self.session.run(self.output_names, {self.input_name: np.ascontiguousarray(batch, dtype=np.uint8)})
+        return boxes, scores, classes, num
+
+    def close(self):
+        self.session = None
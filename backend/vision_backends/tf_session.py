@@ -0,0 +1,33 @@
+# the frozen ssd graph in a tf1 session, what backend_vision always ran. the reference the other backends are
+# compared against (benchmarks/vision_backends_bench.py).
+
+OUTPUTS = ["detection_boxes:0", "detection_scores:0", "detection_classes:0", "num_detections:0"]
+
+
+class TFSessionBackend:
+    name = "tf"
+
+    def __init__(self, model_path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        import tensorflow as tf
+
+        self.model_path = model_path
+        graph = tf.Graph()
+        with graph.as_default():
+            od_graph_def = tf.compat.v1.GraphDef()
+            with tf.compat.v1.gfile.GFile(model_path, "rb") as fid:
+                od_graph_def.ParseFromString(fid.read())
+                tf.import_graph_def(od_graph_def, name="")
+
+        self.image_tensor = graph.get_tensor_by_name("image_tensor:0")
+        self.output_tensors = [graph.get_tensor_by_name(name) for name in OUTPUTS]
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                          inter_op_parallelism_threads=inter_op_threads)
+        self.sess = tf.compat.v1.Session(graph=graph, config=config)
+
+    def run(self, batch):
+        # batch: (n, h, w, 3) uint8 -> boxes (n, d, 4), scores (n, d), classes (n, d), num (n,)
+        boxes, scores, classes, num = self.sess.run(self.output_tensors, feed_dict={self.image_tensor: batch})
+        return boxes, scores, classes, num
+
+    def close(self):
+        self.sess.close()
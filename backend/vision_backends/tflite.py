@@ -0,0 +1,82 @@
+import threading
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:  # the full tensorflow package ships the same interpreter (and the flex delegate)
+    try:
+        from tensorflow.lite import Interpreter
+    except ImportError:
+        Interpreter = None
+
+# the ssd graph converted to a tflite flatbuffer by convert_model.py, int8 quantized by default. tflite_runtime is
+# enough for a model made of builtin ops only; a model that needed SELECT_TF_OPS (convert_model.py says so) runs
+# with the flex delegate of the full tensorflow package.
+#
+# two output layouts are understood: the names of the frozen graph (detection_boxes, ... , what convert_model.py
+# keeps) and the TFLite_Detection_PostProcess op of an ssd exported for tflite, whose class ids start at 0.
+
+OUTPUTS = ["detection_boxes", "detection_scores", "detection_classes", "num_detections"]
+POSTPROCESS = "TFLite_Detection_PostProcess"
+
+
+def _dequantize(value, detail):
+    scale, zero_point = detail["quantization"]
+    if scale and value.dtype != np.float32:
+        return (value.astype(np.float32) - zero_point) * scale
+    return value
+
+
+class TFLiteBackend:
+    name = "tflite"
+
+    def __init__(self, model_path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        if Interpreter is None:
+            raise RuntimeError("VISION_BACKEND=tflite needs tflite-runtime or tensorflow (pip install tflite-runtime)")
+        self.model_path = model_path
+        # tflite has a single thread pool, inter op threads don't apply
+        self.interpreter = Interpreter(model_path=model_path, num_threads=intra_op_threads or None)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        outputs = self.interpreter.get_output_details()
+        by_name = {d["name"].split(":")[0]: d for d in outputs}
+        if all(name in by_name for name in OUTPUTS):
+            self.outputs = [by_name[name] for name in OUTPUTS]
+            self.class_offset = 0
+        elif any(d["name"].startswith(POSTPROCESS) for d in outputs):
+            # boxes, classes, scores, num
+            boxes, classes, scores, num = sorted(outputs, key=lambda d: d["name"])
+            self.outputs = [boxes, scores, classes, num]
+            self.class_offset = 1
+        else:
+            raise ValueError(f"{model_path}: unexpected outputs {[d['name'] for d in outputs]}")
+        # one interpreter holds one set of tensors, invoke can't run from two threads at once
+        self._lock = threading.Lock()
+
+    def _input(self, image):
+        detail = self.input
+        if detail["dtype"] == np.uint8:
+            return image[None]
+        # float input: the mobilenet preprocessing ([-1, 1]) isn't part of the graph
+        value = image[None].astype(np.float32) / 127.5 - 1.0
+        scale, zero_point = detail["quantization"]
+        if detail["dtype"] == np.int8 and scale:
+            value = np.clip(np.round(value / scale + zero_point), -128, 127)
+        return value.astype(detail["dtype"])
+
+    def run(self, batch):
+        # the converted graph has a fixed batch of 1, the images of a batch are invoked one after the other
+        results = [[] for _ in self.outputs]
+        with self._lock:
+            for image in batch:
+                if tuple(image.shape) != tuple(self.input["shape"][1:]):
+                    raise ValueError(f"tflite model input is {tuple(self.input['shape'][1:])}, got {image.shape}")
+                self.interpreter.set_tensor(self.input["index"], self._input(image))
+                self.interpreter.invoke()
+                for values, detail in zip(results, self.outputs):
+                    values.append(_dequantize(self.interpreter.get_tensor(detail["index"])[0], detail))
+        boxes, scores, classes, num = (np.stack(values) for values in results)
+        return boxes, scores, classes + self.class_offset, num
+
+    def close(self):
+        self.interpreter = None
@@ -0,0 +1,93 @@
+import threading
+import queue
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Any
+
+
+# small helper that collects work items coming from many threads (one per /addPost request)
+# and hands them over to `run_batch` in groups, so the model sees one big feed instead of many batch-size-1 feeds.
+# a batch is flushed when it reaches `max_batch_size` items or when the oldest item has waited `max_wait_ms`.
+class MicroBatcher:
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait_ms: float = 10, name: str = "batcher"):
+        self.run_batch = run_batch  # takes a list of items, must return a list of results in the same order
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._batch_size_hist = {}  # batch size -> how many batches had that size
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        # the deadline is counted from when the first item was queued, not from when we picked it up
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            self._record(len(batch), [started - enqueued for _, _, enqueued in batch])
+
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+
+    def _record(self, size: int, waits: List[float]):
+        with self._stats_lock:
+            self._batches += 1
+            self._items += size
+            self._batch_size_hist[size] = self._batch_size_hist.get(size, 0) + 1
+            self._wait_total += sum(waits)
+            self._wait_max = max(self._wait_max, max(waits))
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": self._batches,
+                "items": self._items,
+                "queued": self._queue.qsize(),
+                "avg_batch_size": round(self._items / self._batches, 3) if self._batches else 0,
+                "batch_size_histogram": dict(sorted(self._batch_size_hist.items())),
+                "avg_queue_wait_ms": round(self._wait_total / self._items * 1000, 3) if self._items else 0,
+                "max_queue_wait_ms": round(self._wait_max * 1000, 3),
+            }
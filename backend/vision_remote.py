@@ -0,0 +1,209 @@
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+# client side (and the wire format) of inference_server.py. with VISION_INFERENCE_SOCKET set, backend_vision sends
+# the decoded model inputs to the inference server over that unix socket instead of running its own tensorflow
+# session, so the api workers stay small and the inference processes are sized (and pinned to threads) on their own.
+#
+# a frame is: 4 byte header length, 8 byte payload length (both big endian), json header, raw payload.
+#   request  {"op": "detect", "shapes": [[h, w, 3], ...]}   payload: the uint8 images, back to back
+#            {"op": "ping"}   -> {"ok": true, "pid": ..., "ready": ..., "model": backend_vision.model_identity()}
+#   response {"ok": true, "boxes": [n, d, 4], "scores": [n, d], "classes": [n, d]}
+#            payload: float32 boxes, scores, classes and num (n), back to back
+#            {"ok": false, "error": "..."}
+
+FRAME = struct.Struct("!IQ")
+# while the server doesn't answer, is_ready pings it again in the background, first after this many seconds and
+# then twice as long every time up to the max
+RECHECK_MIN_SECONDS = 1.0
+RECHECK_MAX_SECONDS = 30.0
+
+
+class RemoteError(Exception):
+    pass
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:])
+        if n == 0:
+            raise ConnectionError("connection closed")
+        got += n
+    return bytes(buf)
+
+
+def send_frame(sock: socket.socket, header: dict, payload: bytes = b""):
+    head = json.dumps(header).encode()
+    sock.sendall(FRAME.pack(len(head), len(payload)) + head)
+    if payload:
+        sock.sendall(payload)
+
+
+def recv_frame(sock: socket.socket):
+    head_size, payload_size = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+    header = json.loads(_recv_exactly(sock, head_size))
+    payload = _recv_exactly(sock, payload_size) if payload_size else b""
+    return header, payload
+
+
+def encode_images(images):
+    images = [np.ascontiguousarray(image, dtype=np.uint8) for image in images]
+    return {"op": "detect", "shapes": [list(image.shape) for image in images]}, b"".join(image.tobytes() for image in images)
+
+
+def decode_images(header: dict, payload: bytes):
+    images, offset = [], 0
+    for shape in header["shapes"]:
+        size = int(np.prod(shape))
+        images.append(np.frombuffer(payload, dtype=np.uint8, count=size, offset=offset).reshape(shape))
+        offset += size
+    return images
+
+
+def encode_results(results):
+    # [(boxes, scores, classes, num)] per image, as backend_vision.run_many returns them
+    boxes = np.stack([r[0] for r in results]).astype(np.float32)
+    scores = np.stack([r[1] for r in results]).astype(np.float32)
+    classes = np.stack([r[2] for r in results]).astype(np.float32)
+    num = np.asarray([r[3] for r in results], dtype=np.float32)
+    header = {"ok": True, "boxes": list(boxes.shape), "scores": list(scores.shape), "classes": list(classes.shape)}
+    return header, boxes.tobytes() + scores.tobytes() + classes.tobytes() + num.tobytes()
+
+
+def decode_results(header: dict, payload: bytes):
+    arrays, offset = [], 0
+    for name in ("boxes", "scores", "classes"):
+        shape = header[name]
+        count = int(np.prod(shape))
+        arrays.append(np.frombuffer(payload, dtype=np.float32, count=count, offset=offset).reshape(shape))
+        offset += count * 4
+    boxes, scores, classes = arrays
+    num = np.frombuffer(payload, dtype=np.float32, count=len(scores), offset=offset)
+    return [(boxes[i], scores[i], classes[i], num[i]) for i in range(len(scores))]
+
+
+class RemoteVision:
+    # blocking client, safe to use from many threads: every call borrows a connection from a small pool
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.ready = False
+        self.model = None  # the server's backend_vision.model_identity(), from the last ping
+        self._rechecking = False
+        self._recheck_at = 0.0
+        self._recheck_delay = RECHECK_MIN_SECONDS
+        self.calls = 0
+        self.images = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _call(self, header: dict, payload: bytes = b"", timeout: float = None):
+        # an idle connection may have been closed by a restarted server, so one retry on a fresh one. not after a
+        # timeout though, the server is busy (or hung) and a retry would only double the wait
+        for attempt in range(2):
+            try:
+                sock = self._idle.get_nowait()
+            except queue.Empty:
+                sock = self._connect()
+            try:
+                sock.settimeout(timeout if timeout is not None else self.timeout)
+                send_frame(sock, header, payload)
+                response = recv_frame(sock)
+            except socket.timeout:
+                sock.close()
+                raise
+            except (OSError, ConnectionError, ValueError):
+                sock.close()
+                if attempt == 1:
+                    raise
+                continue
+            self._idle.put(sock)
+            return response
+
+    def detect(self, images, timeout: float = None):
+        # -> [(boxes, scores, classes, num)] per image, like the local session
+        if not images:
+            return []
+        started = time.perf_counter()
+        try:
+            header, payload = self._call(*encode_images(images), timeout=timeout)
+            if not header.get("ok"):
+                raise RemoteError(header.get("error", "inference failed"))
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            self.ready = False
+            raise
+        with self._lock:
+            self.calls += 1
+            self.images += len(images)
+            self.total_seconds += time.perf_counter() - started
+        self.ready = True
+        return decode_results(header, payload)
+
+    def ping(self) -> dict:
+        try:
+            header, _ = self._call({"op": "ping"})
+        except Exception:
+            self.ready = False
+            raise
+        self.ready = bool(header.get("ok"))
+        self.model = header.get("model", self.model)
+        return header
+
+    def recheck(self) -> bool:
+        # -> ready. when not, starts a ping in the background (never blocks the caller on a hung server), backing
+        # off while the server stays down. a failed detect sets ready to False, this is how it comes back.
+        if self.ready:
+            return True
+        with self._lock:
+            if self._rechecking or time.monotonic() < self._recheck_at:
+                return False
+            self._rechecking = True
+        threading.Thread(target=self._recheck, name="vision-recheck", daemon=True).start()
+        return False
+
+    def _recheck(self):
+        try:
+            self.ping()
+        except Exception as e:
+            print(f"[ERROR] inference server {self.path}: {e}")
+        with self._lock:
+            if self.ready:
+                self._recheck_delay = RECHECK_MIN_SECONDS
+            else:
+                self._recheck_at = time.monotonic() + self._recheck_delay
+                self._recheck_delay = min(self._recheck_delay * 2, RECHECK_MAX_SECONDS)
+            self._rechecking = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "socket": self.path,
+                "ready": self.ready,
+                "calls": self.calls,
+                "images": self.images,
+                "errors": self.errors,
+                "idle_connections": self._idle.qsize(),
+                "avg_ms": round(self.total_seconds / self.calls * 1000, 2) if self.calls else 0,
+            }
@@ -0,0 +1,90 @@
+import json
+import os
+import numpy as np
+
+# turns ssd detections into the five 0-100 category scores. every category is a weighted average of the
+# detection confidences, so the whole scoring is one class x category weight matrix:
+#   score[post, category] = min(100, sum over detections(weight[class, category] * confidence) / detections)
+# the per category "scale" of the old compute_*_score functions is folded into the matrix.
+# the defaults below can be overridden per category / class with a json file (VISION_WEIGHTS_PATH), e.g.
+#   {"waterlogging": {"D40": 80, "scale": 2.0}, "urgency_for_repair": {"unknown": 0}}
+#
+# the pass works on the raw sess.run arrays of any number of images of any number of posts:
+#   sums, counts = class_sums(scores, classes, num, post_index, posts)   # (posts, classes), (posts,)
+#   category_scores(sums, counts)                                        # (posts, 5)
+# per image class sums are also what the vision score cache keeps, they add up across the images of a post.
+
+VISION_WEIGHTS_PATH = os.getenv("VISION_WEIGHTS_PATH")
+CONFIDENCE_THRESHOLD = float(os.getenv("VISION_CONFIDENCE_THRESHOLD", "0.4"))
+
+CATEGORIES = ["surface_damage", "traffic_safety_risk", "ride_discomfort", "waterlogging", "urgency_for_repair"]
+# row 0 is for class ids the model map doesn't know, row i for model class id i
+CLASSES = ["unknown", "D00", "D01", "D10", "D11", "D20", "D40", "D43", "D44"]
+
+DEFAULT_WEIGHTS = {
+    # longitudinal cracks 8, lateral cracks 10, alligator 25, potholes 40, line / crosswalk blur 5
+    "surface_damage": {"scale": 2.0, "unknown": 5, "D00": 8, "D01": 8, "D10": 10, "D11": 10, "D20": 25, "D40": 40, "D43": 5, "D44": 5},
+    # potholes and alligator cracks cause accidents, crosswalk / line blur matters for pedestrians and lane keeping
+    "traffic_safety_risk": {"scale": 1.0, "unknown": 0, "D00": 5, "D01": 5, "D10": 5, "D11": 5, "D20": 30, "D40": 50, "D43": 15, "D44": 10},
+    "ride_discomfort": {"scale": 1.8, "unknown": 2, "D00": 5, "D01": 5, "D10": 8, "D11": 8, "D20": 20, "D40": 45, "D43": 2, "D44": 2},
+    # water collects in potholes, and to a lesser degree in alligator / lateral cracks
+    "waterlogging": {"scale": 1.8, "unknown": 2, "D00": 0, "D01": 0, "D10": 10, "D11": 8, "D20": 15, "D40": 70, "D43": 0, "D44": 0},
+    "urgency_for_repair": {"scale": 1.0, "unknown": 10, "D00": 15, "D01": 15, "D10": 25, "D11": 25, "D20": 70, "D40": 100, "D43": 20, "D44": 10},
+}
+
+
+def load_weights(path: str = None) -> np.ndarray:
+    # -> (len(CLASSES), len(CATEGORIES)) matrix with the scales applied
+    config = {category: dict(weights) for category, weights in DEFAULT_WEIGHTS.items()}
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        for category, weights in overrides.items():
+            if category not in config:
+                raise ValueError(f"unknown vision score category {category!r} in {path}")
+            config[category].update(weights)
+
+    matrix = np.zeros((len(CLASSES), len(CATEGORIES)))
+    for col, category in enumerate(CATEGORIES):
+        weights = config[category]
+        for row, name in enumerate(CLASSES):
+            matrix[row, col] = weights.get(name, 0) * weights.get("scale", 1.0)
+    return matrix
+
+
+WEIGHTS = load_weights(VISION_WEIGHTS_PATH)
+
+
+def class_sums(scores, classes, num=None, post_index=None, posts: int = None):
+    # scores / classes: (images, detections) as returned by the graph (or one image's (detections,) arrays),
+    # num: valid detections per image, post_index: the post of every image (default: all one post).
+    # -> (posts, len(CLASSES)) summed confidences of the kept detections, (posts,) their counts
+    scores = np.atleast_2d(np.asarray(scores, dtype=np.float64))
+    classes = np.atleast_2d(np.asarray(classes)).astype(np.int64)
+    images, detections = scores.shape
+    post_index = np.zeros(images, dtype=np.int64) if post_index is None else np.asarray(post_index, dtype=np.int64)
+    posts = int(post_index.max()) + 1 if posts is None and images else (posts or 1)
+
+    keep = scores >= CONFIDENCE_THRESHOLD
+    if num is not None:
+        keep &= np.arange(detections) < np.asarray(num, dtype=np.int64).reshape(-1, 1)
+    classes = np.where((classes > 0) & (classes < len(CLASSES)), classes, 0)
+
+    rows = np.broadcast_to(post_index.reshape(-1, 1), scores.shape)[keep]
+    sums = np.bincount(rows * len(CLASSES) + classes[keep], weights=scores[keep],
+                       minlength=posts * len(CLASSES)).reshape(posts, len(CLASSES))
+    counts = np.bincount(rows, minlength=posts)
+    return sums, counts
+
+
+def category_scores(sums, counts, weights: np.ndarray = None) -> np.ndarray:
+    # (posts, len(CLASSES)) sums and (posts,) counts -> (posts, len(CATEGORIES)) scores, 0 for posts without detections
+    sums = np.atleast_2d(np.asarray(sums, dtype=np.float64))
+    counts = np.asarray(counts, dtype=np.float64).reshape(-1)
+    totals = sums @ (WEIGHTS if weights is None else weights)
+    scores = np.divide(totals, counts[:, None], out=np.zeros_like(totals), where=counts[:, None] > 0)
+    return np.round(np.minimum(scores, 100), 2)
+
+
+def to_dict(row) -> dict:
+    return {category: float(value) for category, value in zip(CATEGORIES, row)}